@@ -3,7 +3,26 @@ import pandas as pd
 import libsql
 import re
 import os
-from datetime import datetime, timedelta
+import csv
+import base64
+import gzip
+import hashlib
+import html
+import json
+import sqlite3
+import tempfile
+import threading
+import time
+import unicodedata
+import uuid
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from datetime import datetime
+from difflib import SequenceMatcher
+from functools import wraps
+from zoneinfo import ZoneInfo, ZoneInfoNotFoundError
+from dateutil import tz as dateutil_tz
 
 # ── Page Config ──────────────────────────────────────────────────────────────
 st.set_page_config(
@@ -114,6 +133,12 @@ st.markdown("""
 #
 # ══════════════════════════════════════════════════════════════════════════════
 
+# xlsxwriter (modo constant_memory) para exportar XLSX em streaming; sem ele só CSV
+try:
+    import xlsxwriter
+except ImportError:
+    xlsxwriter = None
+
 # Tenta carregar do .env se existir
 try:
     from dotenv import load_dotenv
@@ -133,45 +158,59 @@ def _get_secret(key: str) -> str:
 TURSO_DATABASE_URL = _get_secret("TURSO_DATABASE_URL")
 TURSO_AUTH_TOKEN = _get_secret("TURSO_AUTH_TOKEN")
 
-LOCAL_DB_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "camda_local.db")
+LOCAL_DB_PATH = _get_secret("CAMDA_DB_PATH") or os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), "camda_local.db"
+)
 
 # Flag para saber se estamos conectados à nuvem
 _using_cloud = bool(TURSO_DATABASE_URL and TURSO_AUTH_TOKEN)
 
+# Retenção: linhas mais antigas que isso saem das tabelas "quentes" e viram
+# resumos diários (reposicao_resumo_diario / uploads_resumo_diario).
+RETENCAO_DIAS = int(_get_secret("CAMDA_RETENCAO_DIAS") or 90)
 
-@st.cache_resource
-def _get_connection():
-    """
-    Retorna uma conexão libSQL.
-    - Se tem credenciais Turso → Embedded Replica (local + sync com nuvem)
-    - Se não tem → SQLite local puro (fallback para desenvolvimento)
-    """
-    if _using_cloud:
-        conn = libsql.connect(
-            LOCAL_DB_PATH,
-            sync_url=TURSO_DATABASE_URL,
-            auth_token=TURSO_AUTH_TOKEN,
-        )
-        conn.sync()  # Sincroniza na inicialização
-    else:
-        conn = libsql.connect(LOCAL_DB_PATH)
-    return conn
-
+# Snapshots do estoque (reconstrução "como estava em"): quantos manter por filial
+# e a cada quantos movimentos tirar um novo mesmo sem upload MESTRE
+SNAPSHOTS_MANTER = int(_get_secret("CAMDA_SNAPSHOTS_MANTER") or 12)
+SNAPSHOT_A_CADA_MOVIMENTOS = int(_get_secret("CAMDA_SNAPSHOT_A_CADA") or 20000)
 
-def get_db():
-    """Retorna conexão e garante que as tabelas existem."""
-    conn = _get_connection()
 
-    # Sync antes de ler (pega alterações de outros colegas)
-    if _using_cloud:
-        try:
-            conn.sync()
-        except Exception:
-            pass  # Se falhar o sync, usa o cache local
+# Intervalo mínimo entre syncs de leitura (pull do Turso). Sem isso, cada rerun
+# de cada celular pagaria um round-trip de rede antes de ler.
+SYNC_INTERVALO_S = float(_get_secret("CAMDA_SYNC_INTERVALO_S") or 10)
 
-    conn.execute("""
+# Diário de escritas (offline) e backoff exponencial do replay para o Turso
+JOURNAL_PATH = _get_secret("CAMDA_JOURNAL_PATH") or os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), "camda_journal.db"
+)
+BACKOFF_BASE_S = 2.0
+BACKOFF_MAX_S = 300.0
+# Entradas com erro que não dá para classificar (nem rede nem SQL) saem do
+# diário depois de tantas tentativas, para não segurar as escritas seguintes
+DIARIO_TENTATIVAS_MAX = int(_get_secret("CAMDA_DIARIO_TENTATIVAS_MAX") or 10)
+
+# Conexões de leitura ociosas guardadas para reuso (as demais são fechadas)
+LEITORES_MAX = int(_get_secret("CAMDA_LEITORES_MAX") or 8)
+
+
+# Filial padrão: bancos de antes do loja_id têm todas as linhas migradas para ela
+LOJA_PADRAO = _get_secret("CAMDA_LOJA") or "QUIRINOPOLIS"
+LOJA_PADRAO_NOME = _get_secret("CAMDA_LOJA_NOME") or "QUIRINÓPOLIS"
+
+# Schema (aplicado uma vez por processo na conexão de escrita — não passa pelo diário).
+# Toda tabela tem loja_id, e toda chave/índice começa por ele: cada filial lê só
+# a sua fatia, e uma filial nova não deixa as consultas das outras mais lentas.
+SCHEMA_TABLES = {
+    "lojas": """
+        CREATE TABLE IF NOT EXISTS lojas (
+            loja_id TEXT PRIMARY KEY,
+            nome TEXT NOT NULL
+        )
+    """,
+    "estoque_mestre": """
         CREATE TABLE IF NOT EXISTS estoque_mestre (
-            codigo TEXT PRIMARY KEY,
+            loja_id TEXT NOT NULL,
+            codigo TEXT NOT NULL,
             produto TEXT NOT NULL,
             categoria TEXT NOT NULL,
             qtd_sistema INTEGER NOT NULL DEFAULT 0,
@@ -180,10 +219,15 @@ def get_db():
             nota TEXT DEFAULT '',
             status TEXT DEFAULT 'ok',
             ultima_contagem TEXT DEFAULT '',
-            criado_em TEXT NOT NULL
+            criado_em TEXT NOT NULL,
+            versao INTEGER NOT NULL DEFAULT 0,
+            ultima_contagem_ts INTEGER,
+            criado_em_ts INTEGER,
+            busca TEXT,
+            PRIMARY KEY (loja_id, codigo)
         )
-    """)
-    conn.execute("""
+    """,
+    "historico_uploads": """
         CREATE TABLE IF NOT EXISTS historico_uploads (
             id INTEGER PRIMARY KEY AUTOINCREMENT,
             data TEXT NOT NULL,
@@ -192,10 +236,12 @@ def get_db():
             total_produtos_lote INTEGER DEFAULT 0,
             novos INTEGER DEFAULT 0,
             atualizados INTEGER DEFAULT 0,
-            divergentes INTEGER DEFAULT 0
+            divergentes INTEGER DEFAULT 0,
+            data_ts INTEGER,
+            loja_id TEXT NOT NULL DEFAULT ''
         )
-    """)
-    conn.execute("""
+    """,
+    "reposicao_loja": """
         CREATE TABLE IF NOT EXISTS reposicao_loja (
             id INTEGER PRIMARY KEY AUTOINCREMENT,
             codigo TEXT NOT NULL,
@@ -204,12 +250,760 @@ def get_db():
             qtd_vendida INTEGER NOT NULL DEFAULT 0,
             criado_em TEXT NOT NULL,
             reposto INTEGER DEFAULT 0,
-            reposto_em TEXT DEFAULT ''
+            reposto_em TEXT DEFAULT '',
+            criado_em_ts INTEGER,
+            reposto_em_ts INTEGER,
+            loja_id TEXT NOT NULL DEFAULT ''
+        )
+    """,
+    "reposicao_resumo_diario": """
+        CREATE TABLE IF NOT EXISTS reposicao_resumo_diario (
+            loja_id TEXT NOT NULL,
+            dia TEXT NOT NULL,
+            categoria TEXT NOT NULL,
+            itens INTEGER NOT NULL DEFAULT 0,
+            repostos INTEGER NOT NULL DEFAULT 0,
+            expirados INTEGER NOT NULL DEFAULT 0,
+            qtd_vendida INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (loja_id, dia, categoria)
         )
-    """)
+    """,
+    "uploads_resumo_diario": """
+        CREATE TABLE IF NOT EXISTS uploads_resumo_diario (
+            loja_id TEXT NOT NULL,
+            dia TEXT NOT NULL,
+            tipo TEXT NOT NULL,
+            uploads INTEGER NOT NULL DEFAULT 0,
+            total_produtos_lote INTEGER NOT NULL DEFAULT 0,
+            novos INTEGER NOT NULL DEFAULT 0,
+            atualizados INTEGER NOT NULL DEFAULT 0,
+            divergentes INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (loja_id, dia, tipo)
+        )
+    """,
+    "manutencao": """
+        CREATE TABLE IF NOT EXISTS manutencao (
+            chave TEXT PRIMARY KEY,
+            valor TEXT NOT NULL
+        )
+    """,
+    # Entradas do diário (WriteJournal) já aplicadas, gravadas na mesma transação
+    "diario_aplicado": """
+        CREATE TABLE IF NOT EXISTS diario_aplicado (
+            id TEXT PRIMARY KEY,
+            ts INTEGER NOT NULL
+        )
+    """,
+    "resumo_categoria": """
+        CREATE TABLE IF NOT EXISTS resumo_categoria (
+            loja_id TEXT NOT NULL,
+            categoria TEXT NOT NULL,
+            total_itens INTEGER NOT NULL DEFAULT 0,
+            n_ok INTEGER NOT NULL DEFAULT 0,
+            n_falta INTEGER NOT NULL DEFAULT 0,
+            n_sobra INTEGER NOT NULL DEFAULT 0,
+            n_danificado INTEGER NOT NULL DEFAULT 0,
+            n_sem_contagem INTEGER NOT NULL DEFAULT 0,
+            qtd_sistema INTEGER NOT NULL DEFAULT 0,
+            qtd_fisica INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (loja_id, categoria)
+        )
+    """,
+    # Razão de movimentos: só recebe inserts (a compactação apaga o que ficou antes
+    # do snapshot mais antigo). Cada linha guarda só os campos que mudaram naquele
+    # upload (NULL = igual ao anterior); categoria vai sempre, para os resumos.
+    # evento: N = novo, A = alterado, R = removido por um MESTRE
+    "movimentos_estoque": """
+        CREATE TABLE IF NOT EXISTS movimentos_estoque (
+            loja_id TEXT NOT NULL,
+            codigo TEXT NOT NULL,
+            ts INTEGER NOT NULL,
+            evento TEXT NOT NULL,
+            categoria TEXT NOT NULL,
+            produto TEXT,
+            qtd_sistema INTEGER,
+            qtd_fisica INTEGER,
+            diferenca INTEGER,
+            nota TEXT,
+            status TEXT,
+            PRIMARY KEY (loja_id, codigo, ts)
+        ) WITHOUT ROWID
+    """,
+    # Divergências por dia/categoria/status: itens e qtd_diferenca são o estado
+    # no fim do dia; mudancas conta quantos itens entraram no status naquele dia
+    "divergencias_resumo_diario": """
+        CREATE TABLE IF NOT EXISTS divergencias_resumo_diario (
+            loja_id TEXT NOT NULL,
+            dia TEXT NOT NULL,
+            categoria TEXT NOT NULL,
+            status TEXT NOT NULL,
+            itens INTEGER NOT NULL DEFAULT 0,
+            qtd_diferenca INTEGER NOT NULL DEFAULT 0,
+            mudancas INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (loja_id, dia, categoria, status)
+        )
+    """,
+    # Estoque inteiro da filial logo ANTES dos movimentos gravados em ts
+    # (JSON colunar montado no SQL; os de versões anteriores estão em zlib + base64)
+    "snapshots_estoque": """
+        CREATE TABLE IF NOT EXISTS snapshots_estoque (
+            loja_id TEXT NOT NULL,
+            ts INTEGER NOT NULL,
+            motivo TEXT NOT NULL,
+            itens INTEGER NOT NULL DEFAULT 0,
+            dados TEXT NOT NULL,
+            PRIMARY KEY (loja_id, ts)
+        )
+    """,
+    # Índice nome normalizado → código, para resolver linhas AUTO_ (sem código).
+    # bloco = primeira palavra do nome: a busca aproximada só compara dentro dele
+    "nomes_produto": """
+        CREATE TABLE IF NOT EXISTS nomes_produto (
+            loja_id TEXT NOT NULL,
+            nome_norm TEXT NOT NULL,
+            codigo TEXT NOT NULL,
+            bloco TEXT NOT NULL,
+            PRIMARY KEY (loja_id, nome_norm)
+        ) WITHOUT ROWID
+    """,
+    "contadores": """
+        CREATE TABLE IF NOT EXISTS contadores (
+            loja_id TEXT NOT NULL,
+            chave TEXT NOT NULL,
+            valor INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (loja_id, chave)
+        )
+    """,
+}
+
+# Tabelas cuja chave primária ganhou loja_id: em bancos antigos são recriadas
+# (cópia das linhas para a LOJA_PADRAO), já que o SQLite não altera PK.
+SCHEMA_REBUILD_LOJA = [
+    "estoque_mestre", "resumo_categoria", "contadores",
+    "reposicao_resumo_diario", "uploads_resumo_diario",
+]
+
+# Colunas adicionadas depois da criação original: (tabela, coluna, definição)
+SCHEMA_MIGRATIONS = [
+    ("estoque_mestre", "versao", "INTEGER NOT NULL DEFAULT 0"),
+    ("estoque_mestre", "ultima_contagem_ts", "INTEGER"),
+    ("estoque_mestre", "criado_em_ts", "INTEGER"),
+    ("historico_uploads", "data_ts", "INTEGER"),
+    ("reposicao_loja", "criado_em_ts", "INTEGER"),
+    ("reposicao_loja", "reposto_em_ts", "INTEGER"),
+    ("historico_uploads", "loja_id", "TEXT NOT NULL DEFAULT ''"),
+    ("reposicao_loja", "loja_id", "TEXT NOT NULL DEFAULT ''"),
+    ("estoque_mestre", "busca", "TEXT"),
+]
+
+# Timestamps: as colunas *_ts (epoch, segundos) são as usadas em filtros e
+# contas de data. As TEXT antigas continuam sendo gravadas durante a transição;
+# linhas gravadas só com TEXT (versões antigas do app) são preenchidas uma vez
+# (_migrate_schema marca manutencao.backfill_ts).
+SCHEMA_BACKFILL = [
+    ("estoque_mestre", "ultima_contagem_ts", "ultima_contagem"),
+    ("estoque_mestre", "criado_em_ts", "criado_em"),
+    ("historico_uploads", "data_ts", "data"),
+    ("reposicao_loja", "criado_em_ts", "criado_em"),
+    ("reposicao_loja", "reposto_em_ts", "reposto_em"),
+]
+
+# Índices de antes do loja_id (não começavam pela filial)
+SCHEMA_DROP_INDEXES = [
+    "idx_estoque_versao", "idx_estoque_contagem_ts",
+    "idx_uploads_data_ts", "idx_reposicao_pendente_ts",
+]
+
+SCHEMA_INDEXES = [
+    "CREATE INDEX IF NOT EXISTS idx_estoque_loja_versao ON estoque_mestre (loja_id, versao)",
+    "CREATE INDEX IF NOT EXISTS idx_estoque_loja_cat ON estoque_mestre (loja_id, categoria, produto)",
+    "CREATE INDEX IF NOT EXISTS idx_estoque_loja_contagem_ts ON estoque_mestre (loja_id, ultima_contagem_ts)",
+    # Tabelas paginadas por status (Divergências / Danificados): filtro + ordem pelo índice
+    "CREATE INDEX IF NOT EXISTS idx_estoque_loja_status_cat "
+    "ON estoque_mestre (loja_id, status, categoria, produto, codigo)",
+    "CREATE INDEX IF NOT EXISTS idx_estoque_loja_status_contagem "
+    "ON estoque_mestre (loja_id, status, ultima_contagem_ts, codigo)",
+    "CREATE INDEX IF NOT EXISTS idx_uploads_loja_data_ts ON historico_uploads (loja_id, data_ts)",
+    "CREATE INDEX IF NOT EXISTS idx_reposicao_loja_pendente ON reposicao_loja (loja_id, reposto, criado_em_ts)",
+    "CREATE INDEX IF NOT EXISTS idx_reposicao_criado_ts ON reposicao_loja (criado_em_ts)",
+    "CREATE INDEX IF NOT EXISTS idx_movimentos_loja_ts ON movimentos_estoque (loja_id, ts)",
+]
+
+# Visões agregadas entre filiais (leem os resumos, não o estoque bruto)
+SCHEMA_VIEWS = [
+    """
+        CREATE VIEW IF NOT EXISTS vw_resumo_lojas AS
+        SELECT l.loja_id, l.nome,
+               COALESCE(SUM(r.total_itens), 0) AS total_itens,
+               COALESCE(SUM(r.n_ok), 0) AS n_ok,
+               COALESCE(SUM(r.n_falta), 0) AS n_falta,
+               COALESCE(SUM(r.n_sobra), 0) AS n_sobra,
+               COALESCE(SUM(r.n_danificado), 0) AS n_danificado,
+               COALESCE(SUM(r.qtd_sistema), 0) AS qtd_sistema,
+               COALESCE(SUM(r.qtd_fisica), 0) AS qtd_fisica
+        FROM lojas l LEFT JOIN resumo_categoria r ON r.loja_id = l.loja_id
+        GROUP BY l.loja_id, l.nome
+    """,
+    """
+        CREATE VIEW IF NOT EXISTS vw_resumo_categoria_rede AS
+        SELECT categoria,
+               SUM(total_itens) AS total_itens, SUM(n_falta) AS n_falta,
+               SUM(n_sobra) AS n_sobra, SUM(n_danificado) AS n_danificado,
+               SUM(qtd_sistema) AS qtd_sistema, SUM(qtd_fisica) AS qtd_fisica
+        FROM resumo_categoria
+        GROUP BY categoria
+    """,
+]
+
+
+def _loja_seed_ops(loja_id: str, nome: str) -> list:
+    """Ops que cadastram uma filial e seus contadores de versão."""
+    return [
+        ("INSERT OR IGNORE INTO lojas (loja_id, nome) VALUES (?, ?)", (loja_id, nome)),
+        ("""
+            INSERT OR IGNORE INTO contadores (loja_id, chave, valor)
+            VALUES (?, 'estoque_versao', 0), (?, 'estoque_base', 0)
+        """, (loja_id, loja_id)),
+    ]
+
+
+def _recriar_com_loja(conn, tabela: str):
+    """
+    Recria uma tabela de antes do loja_id com a chave nova, numa transação só:
+    uma falha no meio volta a tabela original e a próxima inicialização tenta
+    de novo. Uma *_sem_loja que sobrou de versões que não usavam transação
+    termina de ser copiada (INSERT OR IGNORE pula o que já passou).
+    """
+    colunas = [row[1] for row in conn.execute(f"PRAGMA table_info({tabela})").fetchall()]
+    sobrou = conn.execute(
+        "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = ?", (f"{tabela}_sem_loja",)
+    ).fetchone()
+    if not sobrou and (not colunas or "loja_id" in colunas):
+        return
     conn.commit()
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        if not sobrou:
+            conn.execute(f"ALTER TABLE {tabela} RENAME TO {tabela}_sem_loja")
+        conn.execute(SCHEMA_TABLES[tabela])
+        antigas = [row[1] for row in conn.execute(f"PRAGMA table_info({tabela}_sem_loja)").fetchall()]
+        lista = ", ".join(c for c in antigas if c != "loja_id")
+        conn.execute(
+            f"INSERT OR IGNORE INTO {tabela} (loja_id, {lista}) SELECT ?, {lista} FROM {tabela}_sem_loja",
+            (LOJA_PADRAO,),
+        )
+        conn.execute(f"DROP TABLE {tabela}_sem_loja")
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+
+
+def _migrate_schema(conn):
+    """
+    Cria/atualiza o schema: recria tabelas sem loja_id, adiciona colunas que
+    faltam em bancos antigos, preenche os *_ts, índices, visões e resumos.
+    """
+    for tabela in SCHEMA_REBUILD_LOJA:
+        _recriar_com_loja(conn, tabela)
+
+    for ddl in SCHEMA_TABLES.values():
+        conn.execute(ddl)
+    for tabela, coluna, definicao in SCHEMA_MIGRATIONS:
+        existentes = {row[1] for row in conn.execute(f"PRAGMA table_info({tabela})").fetchall()}
+        if coluna not in existentes:
+            conn.execute(f"ALTER TABLE {tabela} ADD COLUMN {coluna} {definicao}")
+    for tabela in ("historico_uploads", "reposicao_loja"):
+        conn.execute(f"UPDATE {tabela} SET loja_id = ? WHERE loja_id = ''", (LOJA_PADRAO,))
+    # Backfill dos *_ts: varre as tabelas inteiras, então só roda até dar certo uma vez
+    if not conn.execute("SELECT 1 FROM manutencao WHERE chave = 'backfill_ts'").fetchone():
+        for tabela, coluna_ts, coluna_txt in SCHEMA_BACKFILL:
+            # TEXT gravado com datetime.now() (hora local) → epoch UTC
+            conn.execute(f"""
+                UPDATE {tabela} SET {coluna_ts} = CAST(strftime('%s', {coluna_txt}, 'utc') AS INTEGER)
+                WHERE {coluna_ts} IS NULL AND {coluna_txt} != ''
+            """)
+        conn.execute(
+            "INSERT OR REPLACE INTO manutencao (chave, valor) VALUES ('backfill_ts', ?)",
+            (datetime.now().strftime("%Y-%m-%d %H:%M:%S"),)
+        )
+    # busca não tem equivalente em SQL: linhas de versões antigas (ou de um diário
+    # gravado antes delas) são preenchidas aqui
+    sem_busca = conn.execute(
+        "SELECT loja_id, codigo, produto FROM estoque_mestre WHERE busca IS NULL"
+    ).fetchall()
+    if sem_busca:
+        conn.executemany(
+            "UPDATE estoque_mestre SET busca = ? WHERE loja_id = ? AND codigo = ?",
+            [(chave_busca(codigo, produto), loja_id, codigo) for loja_id, codigo, produto in sem_busca],
+        )
+
+    for nome in SCHEMA_DROP_INDEXES:
+        conn.execute(f"DROP INDEX IF EXISTS {nome}")
+    for ddl in SCHEMA_INDEXES + SCHEMA_VIEWS:
+        conn.execute(ddl)
+
+    for sql, params in _loja_seed_ops(LOJA_PADRAO, LOJA_PADRAO_NOME):
+        conn.execute(sql, params)
+    # Filiais com estoque mas sem cadastro (ex.: migradas) também ganham contadores
+    for (loja_id,) in conn.execute("SELECT DISTINCT loja_id FROM estoque_mestre").fetchall():
+        for sql, params in _loja_seed_ops(loja_id, loja_id):
+            conn.execute(sql, params)
+
+    # Bancos de antes do resumo_categoria: popula a partir do mestre uma vez
+    if not conn.execute("SELECT 1 FROM resumo_categoria LIMIT 1").fetchone():
+        for sql, params in _resumo_ops():
+            conn.execute(sql, params)
+    # Índice de nomes vazio: parte dos produtos que já estão no mestre
+    if not conn.execute("SELECT 1 FROM nomes_produto LIMIT 1").fetchone():
+        for loja_id, in conn.execute("SELECT DISTINCT loja_id FROM estoque_mestre").fetchall():
+            registros = conn.execute(
+                "SELECT codigo, produto FROM estoque_mestre WHERE loja_id = ?", (loja_id,)
+            ).fetchall()
+            for sql, params in _nomes_ops(loja_id, [{"codigo": c, "produto": p} for c, p in registros]):
+                conn.execute(sql, params)
+    # Sem histórico de divergências: o estado de hoje vira o primeiro ponto da série
+    if not conn.execute("SELECT 1 FROM divergencias_resumo_diario LIMIT 1").fetchone():
+        dia, _ = _inicio_do_dia()
+        conn.execute("""
+            INSERT INTO divergencias_resumo_diario (loja_id, dia, categoria, status, itens, qtd_diferenca)
+            SELECT loja_id, ?, categoria, status, COUNT(*), COALESCE(SUM(diferenca), 0)
+            FROM estoque_mestre GROUP BY loja_id, categoria, status
+        """, (dia,))
+    conn.commit()
+
+
+class WriteJournal:
+    """
+    Diário durável de escritas ainda não aplicadas no remoto (camda_journal.db).
+
+    Cada entrada é uma transação: uma lista de (sql, params) que é reaplicada
+    inteira, na ordem de seq. O diário só é limpo depois do commit remoto, então
+    uma queda entre os dois reaplicaria a entrada; por isso cada uma tem um id
+    único que o remoto grava em diario_aplicado na mesma transação
+    (_aplicar_transacao), e um id já visto é pulado.
+
+    Entradas que o remoto recusa por erro de SQL (ou que passam de
+    DIARIO_TENTATIVAS_MAX) vão para a tabela descartadas — ficam guardadas
+    para conferência, mas não bloqueiam a fila.
+    """
+
+    def __init__(self, path: str):
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("""
+            CREATE TABLE IF NOT EXISTS journal (
+                seq INTEGER PRIMARY KEY AUTOINCREMENT,
+                criado_em TEXT NOT NULL,
+                descricao TEXT DEFAULT '',
+                ops TEXT NOT NULL,
+                tentativas INTEGER DEFAULT 0,
+                ultimo_erro TEXT DEFAULT '',
+                id TEXT
+            )
+        """)
+        colunas = {row[1] for row in self._conn.execute("PRAGMA table_info(journal)").fetchall()}
+        if "id" not in colunas:
+            self._conn.execute("ALTER TABLE journal ADD COLUMN id TEXT")
+        # Entradas de diários antigos, gravadas antes do id
+        self._conn.execute("UPDATE journal SET id = lower(hex(randomblob(16))) WHERE id IS NULL")
+        self._conn.execute("""
+            CREATE TABLE IF NOT EXISTS descartadas (
+                seq INTEGER PRIMARY KEY,
+                id TEXT,
+                criado_em TEXT NOT NULL,
+                descricao TEXT DEFAULT '',
+                ops TEXT NOT NULL,
+                tentativas INTEGER DEFAULT 0,
+                erro TEXT DEFAULT '',
+                descartada_em TEXT NOT NULL
+            )
+        """)
+        self._conn.commit()
+
+    def append(self, descricao: str, ops: list) -> int:
+        payload = json.dumps([[sql, list(params)] for sql, params in ops])
+        with self._lock:
+            cur = self._conn.execute(
+                "INSERT INTO journal (criado_em, descricao, ops, id) VALUES (?, ?, ?, ?)",
+                (datetime.now().strftime("%Y-%m-%d %H:%M:%S"), descricao, payload, uuid.uuid4().hex),
+            )
+            self._conn.commit()
+            return cur.lastrowid
+
+    def next(self):
+        """Entrada mais antiga pendente: (seq, id, ops) ou None."""
+        with self._lock:
+            row = self._conn.execute("SELECT seq, id, ops FROM journal ORDER BY seq LIMIT 1").fetchone()
+        if not row:
+            return None
+        return row[0], row[1], [(sql, tuple(params)) for sql, params in json.loads(row[2])]
+
+    def remove(self, seq: int):
+        with self._lock:
+            self._conn.execute("DELETE FROM journal WHERE seq = ?", (seq,))
+            self._conn.commit()
+
+    def mark_failure(self, seq: int, erro: str) -> int:
+        """Registra a falha da entrada; retorna quantas tentativas ela já teve."""
+        with self._lock:
+            self._conn.execute(
+                "UPDATE journal SET tentativas = tentativas + 1, ultimo_erro = ? WHERE seq = ?",
+                (erro[:500], seq),
+            )
+            self._conn.commit()
+            row = self._conn.execute("SELECT tentativas FROM journal WHERE seq = ?", (seq,)).fetchone()
+        return row[0] if row else 0
+
+    def discard(self, seq: int, erro: str):
+        """Tira a entrada da fila e a guarda em descartadas (uma transação)."""
+        with self._lock:
+            self._conn.execute("""
+                INSERT OR REPLACE INTO descartadas
+                    (seq, id, criado_em, descricao, ops, tentativas, erro, descartada_em)
+                SELECT seq, id, criado_em, descricao, ops, tentativas, ?, ?
+                FROM journal WHERE seq = ?
+            """, (erro[:500], datetime.now().strftime("%Y-%m-%d %H:%M:%S"), seq))
+            self._conn.execute("DELETE FROM journal WHERE seq = ?", (seq,))
+            self._conn.commit()
+
+    def status(self) -> tuple:
+        """(pendentes, último erro da entrada mais antiga, descartadas, erro da última descartada)"""
+        with self._lock:
+            n = self._conn.execute("SELECT COUNT(*) FROM journal").fetchone()[0]
+            row = self._conn.execute("SELECT ultimo_erro FROM journal ORDER BY seq LIMIT 1").fetchone()
+            n_desc = self._conn.execute("SELECT COUNT(*) FROM descartadas").fetchone()[0]
+            desc = self._conn.execute(
+                "SELECT descricao, erro FROM descartadas ORDER BY seq DESC LIMIT 1"
+            ).fetchone()
+        return n, (row[0] if row else ""), n_desc, (f"{desc[0]}: {desc[1]}" if desc else "")
+
+
+# Mensagens do libsql (que levanta ValueError para tudo) e do SQLite que indicam
+# erro na própria transação: repetir não resolve
+_ERROS_SQL = (
+    "no such table", "no such column", "has no column named", "syntax error", "constraint failed",
+    "datatype mismatch", "values were supplied", "incomplete input", "sql logic error",
+    "too many sql variables", "misuse",
+)
+_ERROS_REDE = (
+    "connect", "connection", "timed out", "timeout", "network", "dns", "sending request",
+    "stream", "hrana", "http", "tls", "broken pipe", "unreachable", "reset by peer",
+    "locked", "busy",
+)
+
 
-    return conn
+def _classificar_erro(erro: Exception) -> str:
+    """'sql' (descarta na hora), 'rede' (espera a conexão voltar) ou 'desconhecido' (tenta até o limite)."""
+    if isinstance(erro, (ConnectionError, TimeoutError)):
+        return "rede"
+    msg = str(erro).lower()
+    if isinstance(erro, (sqlite3.IntegrityError, sqlite3.ProgrammingError, sqlite3.DataError)) or any(
+        m in msg for m in _ERROS_SQL
+    ):
+        return "sql"
+    if isinstance(erro, OSError) or any(m in msg for m in _ERROS_REDE):
+        return "rede"
+    return "desconhecido"
+
+
+def _aplicar_transacao(conn, entrada_id: str, ops: list):
+    """
+    Aplica uma entrada do diário numa transação só, junto com seu id em
+    diario_aplicado. Se o id já está lá, a entrada foi aplicada antes de uma
+    queda (o diário só não chegou a ser limpo) e não é repetida.
+    """
+    try:
+        if conn.execute("SELECT 1 FROM diario_aplicado WHERE id = ?", (entrada_id,)).fetchone():
+            return
+        for sql, params in ops:
+            conn.execute(sql, params)
+        conn.execute(
+            "INSERT INTO diario_aplicado (id, ts) VALUES (?, ?)", (entrada_id, int(time.time()))
+        )
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+
+
+class _ReplicaRemote:
+    """
+    Remoto real: a conexão de escrita libSQL (Embedded Replica com sync_url, ou
+    o arquivo local puro em modo desenvolvimento). Só é usado na thread de escrita.
+    """
+
+    def __init__(self):
+        self._conn = None
+        # Sem nuvem não há rede: uma falha é erro de SQL e não adianta repetir
+        self.transient = _using_cloud
+
+    def _get_conn(self):
+        if self._conn is None:
+            if _using_cloud:
+                self._conn = libsql.connect(
+                    LOCAL_DB_PATH,
+                    sync_url=TURSO_DATABASE_URL,
+                    auth_token=TURSO_AUTH_TOKEN,
+                )
+            else:
+                self._conn = libsql.connect(LOCAL_DB_PATH)
+            # WAL também na réplica: leitores não esperam o sync nem as escritas
+            self._conn.execute("PRAGMA journal_mode=WAL")
+        return self._conn
+
+    def apply(self, entrada_id: str, ops: list):
+        _aplicar_transacao(self._get_conn(), entrada_id, ops)
+
+    def sync(self):
+        if _using_cloud:
+            self._get_conn().sync()
+
+    def run_local(self, fn):
+        return fn(self._get_conn())
+
+
+class LocalRemote:
+    """
+    Stand-in local do Turso (arquivo libSQL sem sync_url) para testes e desenvolvimento.
+    `online = False` simula a rede caída: apply/sync falham na hora, sem timeout.
+    Ative no app com CAMDA_REMOTE_STANDIN=1 (grava em LOCAL_DB_PATH).
+
+    Usa a mesma biblioteca das conexões de leitura: com o sqlite3 da stdlib no
+    mesmo arquivo, fechar uma conexão libsql apaga o -wal ainda em uso pelo
+    sqlite3 (cada biblioteca tem sua tabela de locks POSIX) e as escritas somem.
+    """
+
+    transient = True
+
+    def __init__(self, path: str = ":memory:"):
+        self.online = True
+        self.conn = libsql.connect(path)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+
+    def _check(self):
+        if not self.online:
+            raise ConnectionError("remoto offline (simulado)")
+
+    def apply(self, entrada_id: str, ops: list):
+        self._check()
+        _aplicar_transacao(self.conn, entrada_id, ops)
+
+    def sync(self):
+        self._check()
+
+    def run_local(self, fn):
+        return fn(self.conn)
+
+
+class _ConnectionManager:
+    """
+    Conexões do processo — uma instância compartilhada por todas as sessões.
+
+    - Leitura: cada thread de script do Streamlit pega emprestada uma conexão
+      própria com a réplica local (camda_local.db). Sessões não disputam o mesmo
+      handle e, com WAL, leituras não bloqueiam umas às outras nem esperam
+      escritas. Cada rerun roda numa thread nova: quando a thread termina a
+      conexão volta ao pool (até LEITORES_MAX ociosas) em vez de ficar aberta.
+    - Escrita: toda transação vai primeiro para o WriteJournal (local, durável)
+      e depois é reaplicada no remoto, em ordem, por uma única thread de
+      escrita. Transações de sessões diferentes nunca se intercalam.
+    - Rede caída: após uma falha o remoto entra em backoff exponencial
+      (BACKOFF_BASE_S · 2^n, até BACKOFF_MAX_S). Durante o backoff escritas só
+      vão pro diário e retornam na hora; o replay é retomado em segundo plano.
+    """
+
+    def __init__(self, remote=None, journal_path: str = None, read_path: str = LOCAL_DB_PATH):
+        self._read_path = read_path
+        self._leitores_lock = threading.Lock()
+        self._em_uso = {}  # Thread → conexão emprestada
+        self._livres = []
+        self._remote = remote or _ReplicaRemote()
+        self._journal = WriteJournal(journal_path or JOURNAL_PATH)
+        self._writer = ThreadPoolExecutor(max_workers=1, thread_name_prefix="camda-writer")
+        self._bg_lock = threading.Lock()
+        self._last_sync = 0.0
+        self._falhas = 0
+        self._retry_at = 0.0
+        self.erro_vacuum = None  # da réplica desta máquina: não vai para o banco compartilhado
+        self._writer.submit(self._init_remote).result()
+
+    # ── Thread de escrita ──
+
+    def _init_remote(self):
+        try:
+            self._remote.run_local(_migrate_schema)
+            self._remote.sync()  # Sincroniza na inicialização
+            self._last_sync = time.monotonic()
+        except Exception as e:
+            if not self._remote.transient:
+                raise
+            self._backoff(e)  # Offline: segue com o que já existe na réplica
+        self._flush()
+
+    def _backoff(self, erro: Exception):
+        self._falhas += 1
+        espera = min(BACKOFF_MAX_S, BACKOFF_BASE_S * 2 ** (self._falhas - 1))
+        self._retry_at = time.monotonic() + espera
+
+    def _flush(self, seq_chamador: int = None) -> bool:
+        """
+        Reaplica o diário em ordem. True se ficou vazio. Entradas recusadas
+        pelo remoto por erro de SQL vão para descartadas e a fila continua;
+        se a recusada é a de `seq_chamador`, o erro sobe para quem escreveu.
+        """
+        erro_chamador = None
+        while True:
+            entry = self._journal.next()
+            if entry is None:
+                self._falhas = 0
+                self._retry_at = 0.0
+                break
+            seq, entrada_id, ops = entry
+            try:
+                self._remote.apply(entrada_id, ops)
+            except Exception as e:
+                # Sem nuvem não há rede: qualquer falha é da própria transação
+                tipo = _classificar_erro(e) if self._remote.transient else "sql"
+                tentativas = self._journal.mark_failure(seq, str(e))
+                if tipo == "rede" or (tipo == "desconhecido" and tentativas < DIARIO_TENTATIVAS_MAX):
+                    self._backoff(e)
+                    if erro_chamador is not None:
+                        raise erro_chamador
+                    return False
+                self._journal.discard(seq, str(e))
+                if seq == seq_chamador:
+                    erro_chamador = e
+                continue
+            self._journal.remove(seq)
+        if erro_chamador is not None:
+            raise erro_chamador
+        return True
+
+    def _flush_and_sync(self) -> bool:
+        if self.in_backoff():
+            return False
+        if not self._flush():
+            return False
+        try:
+            self._remote.sync()
+        except Exception as e:
+            self._backoff(e)
+            return False
+        self._last_sync = time.monotonic()
+        return True
+
+    def _background_flush(self):
+        try:
+            self._flush_and_sync()
+        except Exception:
+            pass
+        finally:
+            self._bg_lock.release()
+
+    # ── API ──
+
+    def in_backoff(self) -> bool:
+        return time.monotonic() < self._retry_at
+
+    def write(self, ops: list, descricao: str = "") -> bool:
+        """
+        Grava a transação no diário e tenta aplicá-la no remoto.
+        True = aplicada; False = ficou pendente no diário (rede em backoff).
+        """
+        if not ops:
+            return True
+        seq = self._journal.append(descricao, ops)
+        if self.in_backoff():
+            return False
+        return self._writer.submit(self._flush, seq).result()
+
+    def sync(self) -> bool:
+        """Replay do diário + sync com o Turso, serializado com as escritas."""
+        return self._writer.submit(self._flush_and_sync).result()
+
+    def sync_if_stale(self):
+        """
+        Agenda replay/pull em segundo plano se há pendências ou se o último sync
+        tem mais de SYNC_INTERVALO_S. Nunca bloqueia a leitura de quem chamou.
+        """
+        if self.in_backoff():
+            return
+        pendentes = self._journal.status()[0]
+        stale = _using_cloud and time.monotonic() - self._last_sync >= SYNC_INTERVALO_S
+        if not pendentes and not stale:
+            return
+        if not self._bg_lock.acquire(blocking=False):
+            return
+        self._writer.submit(self._background_flush)
+
+    def run_local(self, fn):
+        """Roda fn(conn) na conexão de escrita, fora do diário (manutenção local)."""
+        return self._writer.submit(self._remote.run_local, fn).result()
+
+    def vacuum_local(self):
+        """
+        incremental_vacuum na réplica local. O erro fica neste processo até um
+        VACUUM dar certo (a próxima compactação tenta de novo); retorna o erro ou None.
+        """
+        erro = self.run_local(_vacuum_incremental)
+        self.erro_vacuum = f"{datetime.now().strftime('%d/%m/%Y %H:%M')} · {erro}" if erro else None
+        return erro
+
+    def status(self) -> dict:
+        pendentes, erro, descartadas, erro_descartada = self._journal.status()
+        return {
+            "pendentes": pendentes,
+            "erro": erro,
+            "retry_em_s": max(0.0, self._retry_at - time.monotonic()),
+            "descartadas": descartadas,
+            "erro_descartada": erro_descartada,
+        }
+
+    def reader(self):
+        """Conexão de leitura exclusiva da thread atual (emprestada do pool)."""
+        thread = threading.current_thread()
+        with self._leitores_lock:
+            conn = self._em_uso.get(thread)
+            if conn is None:
+                self._recolher_leitores()
+                conn = self._livres.pop() if self._livres else libsql.connect(self._read_path)
+                self._em_uso[thread] = conn
+        return conn
+
+    def _recolher_leitores(self):
+        """Devolve ao pool as conexões de threads que já terminaram."""
+        for thread in [t for t in self._em_uso if not t.is_alive()]:
+            conn = self._em_uso.pop(thread)
+            if len(self._livres) < LEITORES_MAX:
+                self._livres.append(conn)
+            else:
+                conn.close()
+
+
+@st.cache_resource
+def _get_manager() -> _ConnectionManager:
+    if os.environ.get("CAMDA_REMOTE_STANDIN"):
+        return _ConnectionManager(remote=LocalRemote(LOCAL_DB_PATH))
+    return _ConnectionManager()
+
+
+def get_db():
+    """Retorna a conexão de leitura desta thread (réplica local, já com schema)."""
+    with perfil_span("db", "_get_manager"):
+        mgr = _get_manager()  # 1ª chamada do processo: schema + sync inicial
+    with perfil_span("sync", "sync_if_stale"):
+        mgr.sync_if_stale()  # Pega alterações de outros colegas
+    return _medir_conexao(mgr.reader())
+
+
+def run_write(ops: list, descricao: str = "") -> bool:
+    """
+    Executa uma transação [(sql, params), ...] via diário + fila de escrita.
+    Retorna False se a rede está fora e a transação ficou pendente no diário.
+    """
+    with perfil_span("escrita", f"{descricao or 'escrita'} ({len(ops)} ops)"):
+        return _get_manager().write(ops, descricao)
 
 
 # Categorias que VÃO para reposição na loja (whitelist)
@@ -223,92 +1017,969 @@ CATEGORIAS_REPOSICAO_LOJA = {
 def sync_db():
     """Força sincronização com o Turso (chamar após escritas)."""
     if _using_cloud:
+        mgr = _get_manager()
+        with perfil_span("sync", "sync_db"):
+            # Em backoff nem tenta (não espera o timeout), mas o aviso aparece
+            ok = not mgr.in_backoff() and mgr.sync()
+        if not ok:
+            st.warning("⚠️ Sync falhou. Os dados foram salvos localmente e serão sincronizados depois.")
+
+
+# ── Perfil por rerun (instrumentação opcional) ───────────────────────────────
+# Ligado com ?perfil=1 na URL (só nessa sessão) ou CAMDA_PERFIL=1 (todas). Cada
+# rerun — ou rerun de fragmento — guarda o tempo de cada consulta (agrupada por
+# SQL, com contagem), escrita, sync, etapa de parse e trecho de render. O painel
+# "🩺 Perfil" da sidebar mostra os últimos; com CAMDA_PERFIL_LOG eles também vão
+# para um arquivo JSON lines, para achar regressões em sessões reais.
+# Desligado, o custo é um getattr por trecho medido.
+
+PERFIL_GLOBAL = str(_get_secret("CAMDA_PERFIL")).strip().lower() in ("1", "true")
+PERFIL_LOG_PATH = _get_secret("CAMDA_PERFIL_LOG")
+PERFIL_HISTORICO = 20  # reruns guardados por sessão para o painel
+
+_perfil_local = threading.local()
+_perfil_log_lock = threading.Lock()
+
+
+class _Perfil:
+    """Spans de um rerun, coletados na thread do script que o executa."""
+
+    def __init__(self, origem: str):
+        self.origem = origem
+        self.quando = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+        self.inicio = time.perf_counter()
+        self.spans = []        # (tipo, nome, início ms, duração ms)
+        self.consultas = {}    # sql compactado → [execuções, total ms, máx ms]
+
+    def span(self, tipo: str, nome: str, t0: float, dur: float):
+        self.spans.append((tipo, nome, (t0 - self.inicio) * 1000, dur * 1000))
+
+    def consulta(self, sql: str, dur: float, execucoes: int = 1):
+        chave = " ".join(sql.split())[:160]
+        c = self.consultas.setdefault(chave, [0, 0.0, 0.0])
+        c[0] += execucoes
+        c[1] += dur * 1000
+        c[2] = max(c[2], dur * 1000)
+
+    def resumo(self, interrompido: bool = False) -> dict:
+        return {
+            "quando": self.quando,
+            "origem": self.origem,
+            "total_ms": round((time.perf_counter() - self.inicio) * 1000, 2),
+            "interrompido": interrompido,
+            "spans": [
+                {"tipo": t, "nome": n, "inicio_ms": round(i, 2), "ms": round(d, 2)}
+                for t, n, i, d in self.spans
+            ],
+            "consultas": [
+                {"sql": sql, "n": n, "ms": round(total, 2), "max_ms": round(mx, 2)}
+                for sql, (n, total, mx) in sorted(self.consultas.items(), key=lambda kv: -kv[1][1])
+            ],
+        }
+
+
+@contextmanager
+def perfil_span(tipo: str, nome: str):
+    """Mede o bloco no perfil do rerun atual (não faz nada com o perfil desligado)."""
+    perfil = getattr(_perfil_local, "atual", None)
+    if perfil is None:
+        yield
+        return
+    t0 = time.perf_counter()
+    try:
+        yield
+    finally:
+        perfil.span(tipo, nome, t0, time.perf_counter() - t0)
+
+
+def perfilado(tipo: str, nome: str = None):
+    """Decorador: a chamada inteira vira um span do perfil."""
+    def decorador(fn):
+        @wraps(fn)
+        def medido(*args, **kwargs):
+            with perfil_span(tipo, nome or fn.__name__):
+                return fn(*args, **kwargs)
+        return medido
+    return decorador
+
+
+def _perfil_ligado() -> bool:
+    return PERFIL_GLOBAL or st.query_params.get("perfil") == "1"
+
+
+def _gravar_perfil(resumo: dict):
+    historico = st.session_state.setdefault("perfil_reruns", [])
+    historico.append(resumo)
+    del historico[:-PERFIL_HISTORICO]
+    if PERFIL_LOG_PATH:
+        sessao = st.session_state.setdefault("perfil_sessao", os.urandom(4).hex())
+        linha = json.dumps({"sessao": sessao, **resumo}, ensure_ascii=False)
+        with _perfil_log_lock, open(PERFIL_LOG_PATH, "a", encoding="utf-8") as f:
+            f.write(linha + "\n")
+
+
+def perfil_rerun(origem: str):
+    """
+    Decorador para main() e para os fragmentos: se ainda não há perfil nesta
+    thread (rerun completo ou rerun só do fragmento), abre um e grava ao final;
+    chamado dentro de outro rerun, vira só um span de render.
+    """
+    def decorador(fn):
+        @wraps(fn)
+        def medido(*args, **kwargs):
+            if getattr(_perfil_local, "atual", None) is not None:
+                with perfil_span("render", origem):
+                    return fn(*args, **kwargs)
+            if not _perfil_ligado():
+                return fn(*args, **kwargs)
+            _perfil_local.atual = _Perfil(origem)
+            interrompido = True  # st.rerun()/st.stop() saem por exceção
+            try:
+                resultado = fn(*args, **kwargs)
+                interrompido = False
+                return resultado
+            finally:
+                perfil, _perfil_local.atual = _perfil_local.atual, None
+                _gravar_perfil(perfil.resumo(interrompido))
+        return medido
+    return decorador
+
+
+class _CursorMedido:
+    """Cursor que soma o tempo de fetch à consulta que o gerou."""
+
+    def __init__(self, cur, perfil: _Perfil, sql: str):
+        self._cur = cur
+        self._perfil = perfil
+        self._sql = sql
+
+    def _medir(self, fn, *args):
+        t0 = time.perf_counter()
         try:
-            conn = _get_connection()
-            conn.sync()
-        except Exception as e:
-            st.warning(f"⚠️ Sync falhou: {e}. Os dados foram salvos localmente e serão sincronizados depois.")
+            return fn(*args)
+        finally:
+            self._perfil.consulta(self._sql, time.perf_counter() - t0, execucoes=0)
+
+    def fetchone(self):
+        return self._medir(self._cur.fetchone)
+
+    def fetchmany(self, *args):
+        return self._medir(self._cur.fetchmany, *args)
+
+    def fetchall(self):
+        return self._medir(self._cur.fetchall)
+
+    def __iter__(self):
+        return iter(self.fetchall())
+
+    def __getattr__(self, nome):
+        return getattr(self._cur, nome)
+
+
+class _ConexaoMedida:
+    """Conexão de leitura que registra cada execute no perfil do rerun."""
+
+    def __init__(self, conn, perfil: _Perfil):
+        self._conn = conn
+        self._perfil = perfil
+
+    def execute(self, sql: str, *args):
+        t0 = time.perf_counter()
+        try:
+            cur = self._conn.execute(sql, *args)
+        finally:
+            self._perfil.consulta(sql, time.perf_counter() - t0)
+        return _CursorMedido(cur, self._perfil, sql)
+
+    def __getattr__(self, nome):
+        return getattr(self._conn, nome)
+
 
+def _medir_conexao(conn):
+    perfil = getattr(_perfil_local, "atual", None)
+    return conn if perfil is None else _ConexaoMedida(conn, perfil)
+
+
+ESTOQUE_COLS = ["codigo", "produto", "categoria", "qtd_sistema", "qtd_fisica",
+                "diferenca", "nota", "status", "ultima_contagem", "criado_em"]
+_ESTOQUE_SELECT = (
+    "SELECT codigo, produto, categoria, qtd_sistema, qtd_fisica, diferenca, nota, status, "
+    "ultima_contagem_ts, criado_em_ts FROM estoque_mestre"
+)
 
-def get_current_stock() -> pd.DataFrame:
+
+def agora() -> tuple:
+    """Instante atual como (TEXT legado 'YYYY-mm-dd HH:MM:SS', epoch em segundos)."""
+    ts = int(time.time())
+    return datetime.fromtimestamp(ts).strftime("%Y-%m-%d %H:%M:%S"), ts
+
+
+def _fuso_local():
+    """
+    Fuso do servidor com as regras de horário de verão — o mesmo de datetime.now()
+    e do 'localtime' do SQLite. Com nome (zoneinfo) a conversão é vetorizada;
+    sem nome cai no tzlocal do dateutil, certo mas bem mais lento.
+    """
+    nome = (_get_secret("CAMDA_TZ") or os.environ.get("TZ", "")).lstrip(":")
+    if not nome and os.path.islink("/etc/localtime"):
+        nome = os.path.realpath("/etc/localtime").partition("zoneinfo/")[2]
+    try:
+        return ZoneInfo(nome)
+    except (ZoneInfoNotFoundError, ValueError):
+        return dateutil_tz.tzlocal()
+
+
+FUSO_LOCAL = _fuso_local()
+
+
+def epoch_to_local(ts: pd.Series) -> pd.Series:
+    """Epoch (s) → datetime64 na hora local, vetorizado (NULL → NaT)."""
+    ts = pd.to_numeric(ts, errors="coerce")
+    # Offset de cada instante (não o de hoje): histórico antes/depois do horário de verão fica certo
+    return pd.to_datetime(ts, unit="s", utc=True).dt.tz_convert(FUSO_LOCAL).dt.tz_localize(None)
+
+
+# Versão das linhas do estoque_mestre, por filial:
+#   estoque_versao → incrementa a cada escrita; as linhas gravadas recebem o valor novo
+#   estoque_base   → muda quando o mestre inteiro é substituído/limpo (delta não serve)
+# O placeholder de _VERSAO_ATUAL recebe o loja_id.
+_VERSAO_ATUAL = "(SELECT valor FROM contadores WHERE loja_id = ? AND chave = 'estoque_versao')"
+
+
+def _bump_versao_ops(loja_id: str, nova_base: bool = False) -> list:
+    """Ops que abrem uma nova versão do estoque da filial (primeiras da transação)."""
+    ops = [(
+        "UPDATE contadores SET valor = valor + 1 WHERE loja_id = ? AND chave = 'estoque_versao'",
+        (loja_id,)
+    )]
+    if nova_base:
+        ops.append((
+            f"UPDATE contadores SET valor = {_VERSAO_ATUAL} WHERE loja_id = ? AND chave = 'estoque_base'",
+            (loja_id, loja_id)
+        ))
+    return ops
+
+
+def get_estoque_versao(loja_id: str, conn=None) -> tuple:
+    """(versão atual, versão base) do estoque_mestre da filial."""
+    conn = get_db() if conn is None else conn
+    rows = dict(conn.execute(
+        "SELECT chave, valor FROM contadores WHERE loja_id = ? AND chave IN ('estoque_versao', 'estoque_base')",
+        (loja_id,)
+    ).fetchall())
+    return rows.get("estoque_versao", 0), rows.get("estoque_base", 0)
+
+
+STATUS_CATEGORIAS = ["ok", "falta", "sobra", "danificado"]
+
+
+def _tipar_estoque(df: pd.DataFrame) -> pd.DataFrame:
+    """
+    Tipos compactos: categoria/status categóricos, quantidades int32 e
+    timestamps parseados (epoch do banco; NULL → NaT).
+    """
+    return df.assign(
+        categoria=df["categoria"].astype("category"),
+        status=pd.Categorical(df["status"], categories=STATUS_CATEGORIAS),
+        qtd_sistema=pd.to_numeric(df["qtd_sistema"], errors="coerce").fillna(0).astype("int32"),
+        qtd_fisica=pd.to_numeric(df["qtd_fisica"], errors="coerce").fillna(0).astype("int32"),
+        diferenca=pd.to_numeric(df["diferenca"], errors="coerce").fillna(0).astype("int32"),
+        ultima_contagem=epoch_to_local(df["ultima_contagem"]),
+        criado_em=epoch_to_local(df["criado_em"]),
+    )
+
+
+def _frame_from_cursor(cur, chunk: int = 5000) -> pd.DataFrame:
+    """Monta o frame do estoque lendo o cursor em blocos, direto em listas por coluna."""
+    colunas = [[] for _ in ESTOQUE_COLS]
+    while True:
+        rows = cur.fetchmany(chunk)
+        if not rows:
+            break
+        for col, valores in zip(colunas, zip(*rows)):
+            col.extend(valores)
+    return _tipar_estoque(pd.DataFrame(dict(zip(ESTOQUE_COLS, colunas))))
+
+
+def get_stock_delta(loja_id: str, desde: int, conn=None) -> pd.DataFrame:
+    """Só as linhas da filial gravadas depois da versão `desde`."""
+    conn = get_db() if conn is None else conn
+    return _frame_from_cursor(conn.execute(
+        f"{_ESTOQUE_SELECT} WHERE loja_id = ? AND versao > ?", (loja_id, desde)
+    ))
+
+
+def _patch_stock(df: pd.DataFrame, delta: pd.DataFrame) -> pd.DataFrame:
+    """
+    Substitui/insere as linhas do delta (já tipado) no frame, mantendo a ordem
+    categoria/produto. Só o delta é convertido; o resto do frame só é filtrado.
+    """
+    if delta.empty:
+        return df
+    resto = df[~df["codigo"].isin(delta["codigo"])]
+    # concat de categóricos com categorias diferentes vira object: alinha antes.
+    # A união fica em ordem alfabética, a mesma do ORDER BY categoria.
+    cats = resto["categoria"].cat.categories.union(delta["categoria"].cat.categories)
+    if not cats.equals(resto["categoria"].cat.categories):
+        resto = resto.assign(categoria=resto["categoria"].cat.set_categories(cats))
+    delta = delta.assign(categoria=delta["categoria"].cat.set_categories(cats))
+    df = pd.concat([resto, delta], ignore_index=True)
+    return df.sort_values(["categoria", "produto"], kind="stable", ignore_index=True)
+
+
+class _StockStore:
+    """
+    Frame do estoque de uma filial, compartilhado por todas as sessões do processo.
+    É somente leitura: as sessões filtram por máscara (o pandas devolve uma cópia
+    só das linhas filtradas) ou chamam .copy() antes de alterar, e uma escrita
+    só gera um frame novo — nunca altera o que já foi entregue.
+    """
+
+    def __init__(self, loja_id: str):
+        self._loja_id = loja_id
+        self._lock = threading.Lock()
+        self._df = None
+        self._versao = -1
+        self._base = -1
+        self._nomes = None
+        self._chaves = None
+
+    def get(self, conn=None) -> pd.DataFrame:
+        """Frame atual; `conn` é a conexão de leitura a usar (padrão: get_db())."""
+        conn = get_db() if conn is None else conn
+        versao, base = get_estoque_versao(self._loja_id, conn)
+        with self._lock:
+            if self._df is not None and self._base == base:
+                if self._versao == versao:
+                    return self._df
+                df = _patch_stock(self._df, get_stock_delta(self._loja_id, self._versao, conn))
+            else:
+                df = _frame_from_cursor(conn.execute(
+                    f"{_ESTOQUE_SELECT} WHERE loja_id = ? ORDER BY categoria, produto", (self._loja_id,)
+                ))
+            self._df, self._versao, self._base = df, versao, base
+            return df
+
+    def com_nomes_normalizados(self) -> tuple:
+        """(frame, normalizar_nome de cada produto) — calculado uma vez por versão."""
+        df = self.get()
+        with self._lock:
+            if self._nomes is None or self._nomes[0] is not df:
+                self._nomes = (df, df["produto"].map(normalizar_nome))
+            return self._nomes
+
+    def com_chaves_busca(self) -> tuple:
+        """(frame, chave_busca de cada linha) — a mesma chave gravada em estoque_mestre.busca."""
+        df = self.get()
+        with self._lock:
+            if self._chaves is None or self._chaves[0] is not df:
+                chaves = [chave_busca(c, p) for c, p in zip(df["codigo"].tolist(), df["produto"].tolist())]
+                self._chaves = (df, pd.Series(chaves, index=df.index, dtype=object))
+            return self._chaves
+
+
+@st.cache_resource
+def _get_stock_store(loja_id: str) -> _StockStore:
+    return _StockStore(loja_id)
+
+
+@perfilado("dados")
+def get_current_stock(loja_id: str) -> pd.DataFrame:
+    """
+    Estoque completo da filial, ordenado por categoria/produto — o mesmo frame
+    para todas as sessões dessa filial. Nos reruns só as linhas alteradas desde a última leitura vêm do
+    banco (SELECT completo só na primeira vez ou após um MESTRE/reset).
+    Não altere o frame retornado; filtre, use .assign() ou .copy().
+    """
+    return _get_stock_store(loja_id).get()
+
+
+def get_stock_count(loja_id: str) -> int:
     conn = get_db()
-    rows = conn.execute("SELECT * FROM estoque_mestre ORDER BY categoria, produto").fetchall()
-    cols = ["codigo", "produto", "categoria", "qtd_sistema", "qtd_fisica",
-            "diferenca", "nota", "status", "ultima_contagem", "criado_em"]
+    row = conn.execute("SELECT SUM(total_itens) FROM resumo_categoria WHERE loja_id = ?", (loja_id,)).fetchone()
+    return (row[0] or 0) if row else 0
+
+
+# ── Resumo por Categoria ─────────────────────────────────────────────────────
+# resumo_categoria é recalculado dentro da mesma transação de cada escrita no
+# mestre (só as categorias tocadas), então cabeçalho, filtro e ordem do mapa
+# leem algumas dezenas de linhas em vez do estoque inteiro.
+
+_RESUMO_SELECT = """
+    SELECT loja_id, categoria, COUNT(*),
+           SUM(CASE WHEN status = 'ok' THEN 1 ELSE 0 END),
+           SUM(CASE WHEN status = 'falta' THEN 1 ELSE 0 END),
+           SUM(CASE WHEN status = 'sobra' THEN 1 ELSE 0 END),
+           SUM(CASE WHEN status = 'danificado' THEN 1 ELSE 0 END),
+           SUM(CASE WHEN ultima_contagem_ts IS NULL THEN 1 ELSE 0 END),
+           COALESCE(SUM(qtd_sistema), 0), COALESCE(SUM(qtd_fisica), 0)
+    FROM estoque_mestre
+"""
+
+
+def _resumo_ops(loja_id: str = None, categorias=None) -> list:
+    """
+    Ops que recalculam resumo_categoria: todas as filiais (sem loja_id), uma
+    filial inteira, ou só as categorias dadas de uma filial.
+    """
+    if loja_id is None:
+        return [
+            ("DELETE FROM resumo_categoria", ()),
+            (f"INSERT INTO resumo_categoria {_RESUMO_SELECT} GROUP BY loja_id, categoria", ()),
+        ]
+    if categorias is None:
+        return [
+            ("DELETE FROM resumo_categoria WHERE loja_id = ?", (loja_id,)),
+            (f"INSERT INTO resumo_categoria {_RESUMO_SELECT} WHERE loja_id = ? GROUP BY loja_id, categoria",
+             (loja_id,)),
+        ]
+    cats = tuple(sorted(categorias))
+    if not cats:
+        return []
+    placeholders = ", ".join("?" for _ in cats)
+    return [
+        (f"DELETE FROM resumo_categoria WHERE loja_id = ? AND categoria IN ({placeholders})", (loja_id, *cats)),
+        (f"INSERT INTO resumo_categoria {_RESUMO_SELECT} "
+         f"WHERE loja_id = ? AND categoria IN ({placeholders}) GROUP BY loja_id, categoria", (loja_id, *cats)),
+    ]
+
+
+def get_resumo_categoria(loja_id: str, conn=None) -> pd.DataFrame:
+    """Resumo por categoria da filial, da maior para a menor quantidade em sistema."""
+    conn = get_db() if conn is None else conn
+    rows = conn.execute("""
+        SELECT categoria, total_itens, n_ok, n_falta, n_sobra, n_danificado,
+               n_sem_contagem, qtd_sistema, qtd_fisica
+        FROM resumo_categoria
+        WHERE loja_id = ?
+        ORDER BY qtd_sistema DESC, categoria
+    """, (loja_id,)).fetchall()
+    cols = ["categoria", "total_itens", "n_ok", "n_falta", "n_sobra", "n_danificado",
+            "n_sem_contagem", "qtd_sistema", "qtd_fisica"]
     return pd.DataFrame(rows, columns=cols)
 
 
-def get_stock_count() -> int:
+# ── Filiais ──────────────────────────────────────────────────────────────────
+
+def get_lojas(conn=None) -> list:
+    """[(loja_id, nome)] das filiais cadastradas."""
+    conn = get_db() if conn is None else conn
+    return conn.execute("SELECT loja_id, nome FROM lojas ORDER BY nome").fetchall()
+
+
+def cadastrar_loja(loja_id: str, nome: str) -> str:
+    """Cadastra uma filial nova (id normalizado em maiúsculas, sem espaços)."""
+    loja_id = re.sub(r"[^A-Z0-9_]", "", str(loja_id).upper())
+    if not loja_id:
+        raise ValueError("Código da filial inválido.")
+    run_write(_loja_seed_ops(loja_id, str(nome).strip() or loja_id), "loja")
+    sync_db()
+    return loja_id
+
+
+def get_resumo_lojas() -> pd.DataFrame:
+    """Agregado entre filiais (visão vw_resumo_lojas)."""
     conn = get_db()
-    row = conn.execute("SELECT COUNT(*) FROM estoque_mestre").fetchone()
-    return row[0] if row else 0
+    rows = conn.execute("""
+        SELECT loja_id, nome, total_itens, n_ok, n_falta, n_sobra, n_danificado, qtd_sistema, qtd_fisica
+        FROM vw_resumo_lojas ORDER BY nome
+    """).fetchall()
+    cols = ["loja_id", "nome", "total_itens", "n_ok", "n_falta", "n_sobra", "n_danificado",
+            "qtd_sistema", "qtd_fisica"]
+    return pd.DataFrame(rows, columns=cols)
+
+
+# ── Movimentos e tendência de divergências ──────────────────────────────────
+
+MOVIMENTO_CAMPOS = ("produto", "qtd_sistema", "qtd_fisica", "diferenca", "nota", "status")
+
+
+def _inicio_do_dia() -> tuple:
+    """(dia local 'YYYY-MM-DD', epoch da meia-noite local)."""
+    meia_noite = datetime.now().replace(hour=0, minute=0, second=0, microsecond=0)
+    return meia_noite.strftime("%Y-%m-%d"), int(meia_noite.timestamp())
+
+
+def _estado_estoque(conn, loja_id: str) -> dict:
+    """codigo → (categoria, *MOVIMENTO_CAMPOS) do estoque atual da filial."""
+    rows = conn.execute(
+        f"SELECT codigo, categoria, {', '.join(MOVIMENTO_CAMPOS)} FROM estoque_mestre WHERE loja_id = ?",
+        (loja_id,)
+    ).fetchall()
+    return {row[0]: tuple(row[1:]) for row in rows}
+
+
+# Colunas de cada registro no JSON de _lote_json, na ordem
+_LOTE_CAMPOS = ("codigo", "categoria") + MOVIMENTO_CAMPOS
+_LOTE_SELECT = "SELECT " + ", ".join(
+    f"json_extract(value, '$[{i}]') AS {c}" for i, c in enumerate(_LOTE_CAMPOS)
+) + " FROM json_each(?)"
+
+# Dois uploads no mesmo segundo caem na mesma linha: os campos se somam e um
+# item novo continua novo (A depois de N no mesmo segundo não vira A)
+_MOVIMENTO_CONFLITO = """
+    ON CONFLICT (loja_id, codigo, ts) DO UPDATE SET
+        evento = CASE WHEN excluded.evento = 'A' THEN evento ELSE excluded.evento END,
+        categoria = excluded.categoria,
+        produto = COALESCE(excluded.produto, produto),
+        qtd_sistema = COALESCE(excluded.qtd_sistema, qtd_sistema),
+        qtd_fisica = COALESCE(excluded.qtd_fisica, qtd_fisica),
+        diferenca = COALESCE(excluded.diferenca, diferenca),
+        nota = COALESCE(excluded.nota, nota),
+        status = COALESCE(excluded.status, status)
+"""
+
+
+def _lote_json(records: list) -> str:
+    """Registros como [[codigo, categoria, *MOVIMENTO_CAMPOS], ...] — parâmetro do json_each."""
+    return json.dumps(
+        [[r[c] for c in _LOTE_CAMPOS] for r in records], ensure_ascii=False, separators=(",", ":")
+    )
+
+
+def _movimento_ops(loja_id: str, records: list, now_ts: int, removidos: bool = False) -> list:
+    """
+    Ops que registram no razão só o que mudou. Rodam na transação da escrita,
+    ANTES do upsert no mestre: a comparação é com a linha atual do banco, não
+    com a réplica lida na sessão (que não vê escritas ainda no diário). Com
+    `removidos`, os códigos da filial fora do lote viram R (upload MESTRE).
+    """
+    lote = _lote_json(records)
+    campos = ",\n".join(
+        f"CASE WHEN m.codigo IS NULL OR m.{c} IS NOT e.{c} THEN e.{c} END" for c in MOVIMENTO_CAMPOS
+    )
+    mudou = " OR ".join(f"m.{c} IS NOT e.{c}" for c in ("categoria",) + MOVIMENTO_CAMPOS)
+    ops = [(f"""
+        INSERT INTO movimentos_estoque
+            (loja_id, codigo, ts, evento, categoria, produto, qtd_sistema, qtd_fisica, diferenca, nota, status)
+        SELECT ?, e.codigo, ?, CASE WHEN m.codigo IS NULL THEN 'N' ELSE 'A' END, e.categoria,
+               {campos}
+        FROM ({_LOTE_SELECT}) e
+        LEFT JOIN estoque_mestre m ON m.loja_id = ? AND m.codigo = e.codigo
+        WHERE m.codigo IS NULL OR {mudou}
+        {_MOVIMENTO_CONFLITO}
+    """, (loja_id, now_ts, lote, loja_id))]
+    if removidos:
+        ops.append((f"""
+            INSERT INTO movimentos_estoque (loja_id, codigo, ts, evento, categoria)
+            SELECT loja_id, codigo, ?, 'R', categoria FROM estoque_mestre
+            WHERE loja_id = ? AND codigo NOT IN (SELECT codigo FROM ({_LOTE_SELECT}))
+            {_MOVIMENTO_CONFLITO}
+        """, (now_ts, loja_id, lote)))
+    return ops
+
+
+def _divergencia_diaria_ops(loja_id: str, categorias=None) -> list:
+    """
+    Ops que recalculam a linha de hoje do resumo de divergências para as
+    categorias dadas (rodam depois das escritas no mestre e no razão). Sem
+    categorias, recalcula a filial inteira — toda categoria que já teve
+    histórico é zerada primeiro (upload MESTRE, que pode tirar categorias).
+    """
+    dia, inicio_ts = _inicio_do_dia()
+    if categorias is None:
+        filtro, cats = "", ()
+        status = " UNION ALL ".join("SELECT ? AS status" for _ in STATUS_CATEGORIAS)
+        zeros = (f"""
+            INSERT INTO divergencias_resumo_diario (loja_id, dia, categoria, status)
+            SELECT DISTINCT d.loja_id, ?, d.categoria, s.status
+            FROM divergencias_resumo_diario d CROSS JOIN ({status}) s
+            WHERE d.loja_id = ?
+            ON CONFLICT (loja_id, dia, categoria, status) DO UPDATE SET itens = 0, qtd_diferenca = 0
+        """, (dia, *STATUS_CATEGORIAS, loja_id))
+    else:
+        cats = tuple(sorted(categorias))
+        if not cats:
+            return []
+        filtro = f" AND categoria IN ({', '.join('?' for _ in cats)})"
+        valores = [(loja_id, dia, c, s) for c in cats for s in STATUS_CATEGORIAS]
+        zeros = (f"""
+            INSERT INTO divergencias_resumo_diario (loja_id, dia, categoria, status)
+            VALUES {", ".join("(?, ?, ?, ?)" for _ in valores)}
+            ON CONFLICT (loja_id, dia, categoria, status) DO UPDATE SET itens = 0, qtd_diferenca = 0
+        """, tuple(v for z in valores for v in z))
+    return [
+        zeros,  # Status que sumiram da categoria hoje ficam com zero (não herdam o dia anterior)
+        (f"""
+            INSERT INTO divergencias_resumo_diario (loja_id, dia, categoria, status, itens, qtd_diferenca)
+            SELECT loja_id, ?, categoria, status, COUNT(*), COALESCE(SUM(diferenca), 0)
+            FROM estoque_mestre
+            WHERE loja_id = ?{filtro}
+            GROUP BY loja_id, categoria, status
+            ON CONFLICT (loja_id, dia, categoria, status) DO UPDATE SET
+                itens = excluded.itens, qtd_diferenca = excluded.qtd_diferenca
+        """, (dia, loja_id, *cats)),
+        (f"""
+            INSERT INTO divergencias_resumo_diario (loja_id, dia, categoria, status, mudancas)
+            SELECT loja_id, ?, categoria, status, COUNT(*)
+            FROM movimentos_estoque
+            WHERE loja_id = ? AND ts >= ? AND status IS NOT NULL{filtro}
+            GROUP BY loja_id, categoria, status
+            ON CONFLICT (loja_id, dia, categoria, status) DO UPDATE SET mudancas = excluded.mudancas
+        """, (dia, loja_id, inicio_ts, *cats)),
+    ]
 
 
-def reset_db():
+def get_tendencia_divergencias(loja_id: str, dias: int = 180, categoria: str = None) -> pd.DataFrame:
+    """
+    Itens por status, um ponto por dia, lido só do resumo diário. Dias sem
+    upload repetem o último estado conhecido de cada categoria.
+    """
     conn = get_db()
-    conn.execute("DELETE FROM estoque_mestre")
-    conn.execute("DELETE FROM historico_uploads")
-    conn.execute("DELETE FROM reposicao_loja")
-    conn.commit()
+    inicio = (datetime.now() - pd.Timedelta(days=dias)).strftime("%Y-%m-%d")
+    filtro, params = "", ()
+    if categoria and categoria != "TODOS":
+        filtro, params = " AND categoria = ?", (categoria,)
+
+    # Último estado antes da janela (SQLite devolve itens da linha do MAX(dia))
+    rows = conn.execute(f"""
+        SELECT ?, categoria, status, itens, MAX(dia) FROM divergencias_resumo_diario
+        WHERE loja_id = ? AND dia < ?{filtro} GROUP BY categoria, status
+    """, (inicio, loja_id, inicio, *params)).fetchall()
+    rows = [row[:4] for row in rows]
+    rows += conn.execute(f"""
+        SELECT dia, categoria, status, itens FROM divergencias_resumo_diario
+        WHERE loja_id = ? AND dia >= ?{filtro}
+    """, (loja_id, inicio, *params)).fetchall()
+    if not rows:
+        return pd.DataFrame(columns=STATUS_CATEGORIAS)
+
+    df = pd.DataFrame(rows, columns=["dia", "categoria", "status", "itens"])
+    df["dia"] = pd.to_datetime(df["dia"])
+    serie = df.pivot_table(index="dia", columns=["categoria", "status"], values="itens", aggfunc="last")
+    serie = serie.reindex(pd.date_range(serie.index.min(), datetime.now().date(), freq="D")).ffill().fillna(0)
+    return serie.T.groupby(level="status").sum().T.reindex(columns=STATUS_CATEGORIAS, fill_value=0).astype(int)
+
+
+def get_movimentos_item(loja_id: str, codigo: str) -> pd.DataFrame:
+    """Histórico de um item no razão (só os campos que mudaram em cada upload)."""
+    conn = get_db()
+    rows = conn.execute(f"""
+        SELECT ts, evento, categoria, {", ".join(MOVIMENTO_CAMPOS)}
+        FROM movimentos_estoque WHERE loja_id = ? AND codigo = ? ORDER BY ts DESC
+    """, (loja_id, codigo)).fetchall()
+    df = pd.DataFrame(rows, columns=["ts", "evento", "categoria", *MOVIMENTO_CAMPOS])
+    df.insert(0, "quando", epoch_to_local(df.pop("ts")))
+    return df
+
+
+# ── Snapshots e reconstrução "como estava em" ────────────────────────────────
+
+SNAPSHOT_CAMPOS = ("codigo", "categoria") + MOVIMENTO_CAMPOS
+
+
+_SNAPSHOT_JSON = "json_object(" + ", ".join(f"'{c}', json_group_array({c})" for c in SNAPSHOT_CAMPOS) + ")"
+
+
+def _snapshot_ops(loja_id: str, ts: int, motivo: str) -> list:
+    """
+    Op que grava o estoque atual da filial como snapshot. O JSON é montado no
+    próprio SQL, na transação da escrita (antes do razão e do upsert): é o
+    estado do banco, incluindo escritas que a réplica da sessão ainda não via.
+    """
+    return [(f"""
+        INSERT OR IGNORE INTO snapshots_estoque (loja_id, ts, motivo, itens, dados)
+        SELECT ?, ?, ?, COUNT(*), {_SNAPSHOT_JSON} FROM estoque_mestre WHERE loja_id = ?
+    """, (loja_id, ts, motivo, loja_id))]
+
+
+def _snapshot_periodico_ops(loja_id: str, ts: int) -> list:
+    """Snapshot extra quando já há movimentos demais desde o último (limita o replay)."""
+    return [(f"""
+        INSERT OR IGNORE INTO snapshots_estoque (loja_id, ts, motivo, itens, dados)
+        SELECT ?, ?, 'PERIODICO', COUNT(*), {_SNAPSHOT_JSON} FROM estoque_mestre
+        WHERE loja_id = ? AND (
+            SELECT COUNT(*) FROM movimentos_estoque
+            WHERE loja_id = ? AND ts >= COALESCE((SELECT MAX(ts) FROM snapshots_estoque WHERE loja_id = ?), 0)
+        ) >= ?
+        HAVING COUNT(*) > 0
+    """, (loja_id, ts, loja_id, loja_id, loja_id, SNAPSHOT_A_CADA_MOVIMENTOS))]
+
+
+def get_snapshots(loja_id: str) -> pd.DataFrame:
+    """Snapshots disponíveis da filial, do mais recente ao mais antigo."""
+    conn = get_db()
+    rows = conn.execute(
+        "SELECT ts, motivo, itens FROM snapshots_estoque WHERE loja_id = ? ORDER BY ts DESC", (loja_id,)
+    ).fetchall()
+    return pd.DataFrame(rows, columns=["ts", "motivo", "itens"])
+
+
+def _decodificar_snapshot(blob: str) -> dict:
+    """Inverso de _snapshot_ops: codigo → [categoria, *MOVIMENTO_CAMPOS]."""
+    # JSON direto (gerado no SQL); snapshots de versões anteriores estão em zlib + base64
+    dados = json.loads(blob if blob.startswith("{") else zlib.decompress(base64.b64decode(blob)))
+    return {linha[0]: list(linha[1:]) for linha in zip(*(dados[c] for c in SNAPSHOT_CAMPOS))}
+
+
+def _frame_estado(estado: dict) -> pd.DataFrame:
+    df = pd.DataFrame([(codigo, *campos) for codigo, campos in estado.items()], columns=list(SNAPSHOT_CAMPOS))
+    return df.sort_values(["categoria", "produto"], ignore_index=True)
+
+
+def estoque_do_snapshot(loja_id: str, ts: int) -> pd.DataFrame:
+    """
+    O snapshot gravado em `ts`, decodificado direto: o estoque logo antes do
+    upload daquele instante. Não depende do razão (que a compactação apaga).
+    """
+    conn = get_db()
+    row = conn.execute(
+        "SELECT dados FROM snapshots_estoque WHERE loja_id = ? AND ts = ?", (loja_id, ts)
+    ).fetchone()
+    return _frame_estado(_decodificar_snapshot(row[0]) if row else {})
+
+
+def estoque_em(loja_id: str, ts: int) -> pd.DataFrame:
+    """
+    Estoque da filial como estava no instante `ts` (epoch): o snapshot mais
+    próximo antes dele mais os movimentos do razão até `ts`. Sem snapshot
+    anterior, parte do vazio e aplica o razão desde o começo (antes do snapshot
+    mais antigo guardado o razão já foi compactado e o resultado é parcial).
+    """
+    conn = get_db()
+    snap = conn.execute("""
+        SELECT ts, dados FROM snapshots_estoque WHERE loja_id = ? AND ts <= ?
+        ORDER BY ts DESC LIMIT 1
+    """, (loja_id, ts)).fetchone()
+    estado, desde = {}, 0
+    if snap:
+        desde = snap[0]
+        estado = _decodificar_snapshot(snap[1])
+
+    cur = conn.execute(f"""
+        SELECT codigo, evento, categoria, {", ".join(MOVIMENTO_CAMPOS)}
+        FROM movimentos_estoque WHERE loja_id = ? AND ts >= ? AND ts <= ?
+        ORDER BY ts
+    """, (loja_id, desde, ts))
+    while True:
+        rows = cur.fetchmany(5000)
+        if not rows:
+            break
+        for codigo, evento, categoria, *campos in rows:
+            if evento == "R":
+                estado.pop(codigo, None)
+                continue
+            atual = estado.get(codigo)
+            if evento == "N":
+                estado[codigo] = [categoria, *campos]
+                continue
+            if atual is None:
+                continue  # alteração de um item cujo estado anterior não está mais no razão
+            atual[0] = categoria
+            for i, valor in enumerate(campos, start=1):
+                if valor is not None:
+                    atual[i] = valor
+
+    return _frame_estado(estado)
+
+
+def reset_db(loja_id: str):
+    """Limpa todos os dados de uma filial (as outras não são tocadas)."""
+    run_write(_bump_versao_ops(loja_id, nova_base=True) + [
+        ("DELETE FROM estoque_mestre WHERE loja_id = ?", (loja_id,)),
+        ("DELETE FROM resumo_categoria WHERE loja_id = ?", (loja_id,)),
+        ("DELETE FROM historico_uploads WHERE loja_id = ?", (loja_id,)),
+        ("DELETE FROM reposicao_loja WHERE loja_id = ?", (loja_id,)),
+        ("DELETE FROM reposicao_resumo_diario WHERE loja_id = ?", (loja_id,)),
+        ("DELETE FROM uploads_resumo_diario WHERE loja_id = ?", (loja_id,)),
+        ("DELETE FROM movimentos_estoque WHERE loja_id = ?", (loja_id,)),
+        ("DELETE FROM divergencias_resumo_diario WHERE loja_id = ?", (loja_id,)),
+        ("DELETE FROM snapshots_estoque WHERE loja_id = ?", (loja_id,)),
+        ("DELETE FROM nomes_produto WHERE loja_id = ?", (loja_id,)),
+    ], "reset")
     sync_db()
+    pedir_publicacao(loja_id)
 
 
-def detectar_reposicao_loja(records: list, conn, now: str):
+def detectar_reposicao_loja(records: list, conn, loja_id: str, now: str, now_ts: int) -> tuple:
     """
-    Detecta produtos de categorias de loja (whitelist) e adiciona à lista de reposição.
-    Usa qtd_vendida se disponível, senão usa qtd_sistema.
-    Só adiciona se o produto não estiver já pendente (não reposto) na tabela.
+    Detecta produtos de categorias de loja (whitelist) e gera os INSERTs para a
+    lista de reposição. Usa qtd_vendida se disponível, senão usa qtd_sistema.
+    Só adiciona se o produto não estiver já pendente (não reposto) na tabela —
+    a checagem vai no próprio INSERT, então o replay do diário não duplica.
+    Retorna (ops, quantidade estimada de novos itens).
     """
-    count = 0
+    pendentes = {
+        row[0] for row in conn.execute(
+            "SELECT codigo FROM reposicao_loja WHERE loja_id = ? AND reposto = 0", (loja_id,)
+        ).fetchall()
+    }
+    ops = []
     for r in records:
         # Normaliza a categoria para comparação
         cat_upper = r["categoria"].upper().strip()
         if cat_upper not in CATEGORIAS_REPOSICAO_LOJA:
             continue
+        if r["codigo"] in pendentes:
+            continue
 
-        # Verifica se já existe pendente (não reposto) para esse código
-        existing = conn.execute(
-            "SELECT id FROM reposicao_loja WHERE codigo = ? AND reposto = 0",
-            (r["codigo"],)
-        ).fetchone()
-
-        if not existing:
-            # Usa qtd_vendida se existir, senão qtd_sistema
-            qtd_v = r.get("qtd_vendida", r["qtd_sistema"])
-            conn.execute("""
-                INSERT INTO reposicao_loja (codigo, produto, categoria, qtd_vendida, criado_em)
-                VALUES (?, ?, ?, ?, ?)
-            """, (r["codigo"], r["produto"], r["categoria"], qtd_v, now))
-            count += 1
+        # Usa qtd_vendida se existir, senão qtd_sistema
+        qtd_v = r.get("qtd_vendida", r["qtd_sistema"])
+        ops.append(("""
+            INSERT INTO reposicao_loja (loja_id, codigo, produto, categoria, qtd_vendida, criado_em, criado_em_ts)
+            SELECT ?, ?, ?, ?, ?, ?, ?
+            WHERE NOT EXISTS (SELECT 1 FROM reposicao_loja WHERE loja_id = ? AND codigo = ? AND reposto = 0)
+        """, (loja_id, r["codigo"], r["produto"], r["categoria"], qtd_v, now, now_ts, loja_id, r["codigo"])))
+        pendentes.add(r["codigo"])
 
-    return count
+    return ops, len(ops)
 
 
-def get_reposicao_pendente() -> pd.DataFrame:
-    """Retorna itens de reposição pendentes (não repostos E com menos de 7 dias)."""
-    conn = get_db()
-    cutoff = (datetime.now() - timedelta(days=7)).strftime("%Y-%m-%d %H:%M:%S")
+def get_reposicao_pendente(loja_id: str, conn=None) -> pd.DataFrame:
+    """
+    Retorna itens de reposição pendentes (não repostos E com menos de 7 dias).
+    A idade em dias já vem calculada do banco (coluna dias).
+    """
+    conn = get_db() if conn is None else conn
+    _, now_ts = agora()
     rows = conn.execute("""
-        SELECT id, codigo, produto, categoria, qtd_vendida, criado_em
+        SELECT id, codigo, produto, categoria, qtd_vendida, criado_em, (? - criado_em_ts) / 86400
         FROM reposicao_loja
-        WHERE reposto = 0 AND criado_em >= ?
-        ORDER BY criado_em DESC
-    """, (cutoff,)).fetchall()
-    cols = ["id", "codigo", "produto", "categoria", "qtd_vendida", "criado_em"]
+        WHERE loja_id = ? AND reposto = 0 AND criado_em_ts >= ?
+        ORDER BY criado_em_ts DESC
+    """, (now_ts, loja_id, now_ts - 7 * 86400)).fetchall()
+    cols = ["id", "codigo", "produto", "categoria", "qtd_vendida", "criado_em", "dias"]
     return pd.DataFrame(rows, columns=cols)
 
 
-def marcar_reposto(item_id: int):
-    """Marca um item como reposto na loja."""
+def marcar_repostos(item_ids: list, loja_id: str) -> int:
+    """
+    Marca vários itens como repostos na loja de uma vez.
+    Um único UPDATE ... WHERE id IN (...), um commit e um sync, independente
+    de quantos itens foram selecionados.
+    """
+    ids = sorted({int(i) for i in item_ids})
+    if not ids:
+        return 0
+    now, now_ts = agora()
+    placeholders = ", ".join("?" for _ in ids)
+
+    run_write([(
+        f"UPDATE reposicao_loja SET reposto = 1, reposto_em = ?, reposto_em_ts = ? "
+        f"WHERE loja_id = ? AND reposto = 0 AND id IN ({placeholders})",
+        (now, now_ts, loja_id, *ids)
+    )], "reposicao")
+    sync_db()
+    pedir_publicacao(loja_id)
+    return len(ids)
+
+
+def tempo_relativo(dias: pd.Series) -> pd.Series:
+    """Converte idade em dias em rótulos "hoje" / "ontem" / "Nd atrás" (vetorizado)."""
+    dias = pd.to_numeric(dias, errors="coerce").fillna(0).astype(int)
+    labels = dias.astype(str) + "d atrás"
+    labels[dias == 0] = "hoje"
+    labels[dias == 1] = "ontem"
+    return labels
+
+
+# ── Retenção e Compactação ──────────────────────────────────────────────────
+
+def compactar_historico(dias: int = RETENCAO_DIAS) -> dict:
+    """
+    Move linhas antigas de reposicao_loja e historico_uploads para os resumos
+    diários e apaga as originais, tudo numa transação (uma entrada do diário). Depois roda
+    incremental_vacuum na réplica local para devolver as páginas livres.
+
+    Nunca toca em itens de reposição ainda visíveis (janela de 7 dias).
+    """
+    dias = max(int(dias), 7)
+    _, now_ts = agora()
+    cutoff = now_ts - dias * 86400
+
     conn = get_db()
-    now = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-    conn.execute(
-        "UPDATE reposicao_loja SET reposto = 1, reposto_em = ? WHERE id = ?",
-        (now, item_id)
-    )
-    conn.commit()
+    n_repo = conn.execute("SELECT COUNT(*) FROM reposicao_loja WHERE criado_em_ts < ?", (cutoff,)).fetchone()[0]
+    n_hist = conn.execute("SELECT COUNT(*) FROM historico_uploads WHERE data_ts < ?", (cutoff,)).fetchone()[0]
+
+    run_write([
+        ("""
+            INSERT INTO reposicao_resumo_diario (loja_id, dia, categoria, itens, repostos, expirados, qtd_vendida)
+            SELECT loja_id, date(criado_em_ts, 'unixepoch', 'localtime'), categoria, COUNT(*),
+                   SUM(CASE WHEN reposto = 1 THEN 1 ELSE 0 END),
+                   SUM(CASE WHEN reposto = 0 THEN 1 ELSE 0 END),
+                   COALESCE(SUM(qtd_vendida), 0)
+            FROM reposicao_loja
+            WHERE criado_em_ts < ?
+            GROUP BY loja_id, date(criado_em_ts, 'unixepoch', 'localtime'), categoria
+            ON CONFLICT (loja_id, dia, categoria) DO UPDATE SET
+                itens = itens + excluded.itens,
+                repostos = repostos + excluded.repostos,
+                expirados = expirados + excluded.expirados,
+                qtd_vendida = qtd_vendida + excluded.qtd_vendida
+        """, (cutoff,)),
+        ("DELETE FROM reposicao_loja WHERE criado_em_ts < ?", (cutoff,)),
+        ("""
+            INSERT INTO uploads_resumo_diario
+                (loja_id, dia, tipo, uploads, total_produtos_lote, novos, atualizados, divergentes)
+            SELECT loja_id, date(data_ts, 'unixepoch', 'localtime'), tipo, COUNT(*),
+                   COALESCE(SUM(total_produtos_lote), 0), COALESCE(SUM(novos), 0),
+                   COALESCE(SUM(atualizados), 0), COALESCE(SUM(divergentes), 0)
+            FROM historico_uploads
+            WHERE data_ts < ?
+            GROUP BY loja_id, date(data_ts, 'unixepoch', 'localtime'), tipo
+            ON CONFLICT (loja_id, dia, tipo) DO UPDATE SET
+                uploads = uploads + excluded.uploads,
+                total_produtos_lote = total_produtos_lote + excluded.total_produtos_lote,
+                novos = novos + excluded.novos,
+                atualizados = atualizados + excluded.atualizados,
+                divergentes = divergentes + excluded.divergentes
+        """, (cutoff,)),
+        ("DELETE FROM historico_uploads WHERE data_ts < ?", (cutoff,)),
+        ("DELETE FROM diario_aplicado WHERE ts < ?", (cutoff,)),
+        # Só os SNAPSHOTS_MANTER snapshots mais recentes de cada filial; o razão
+        # anterior ao mais antigo que ficou já não serve para reconstruir nada
+        ("""
+            DELETE FROM snapshots_estoque WHERE (
+                SELECT COUNT(*) FROM snapshots_estoque s
+                WHERE s.loja_id = snapshots_estoque.loja_id AND s.ts > snapshots_estoque.ts
+            ) >= ?
+        """, (SNAPSHOTS_MANTER,)),
+        ("""
+            DELETE FROM movimentos_estoque WHERE ts < (
+                SELECT MIN(s.ts) FROM snapshots_estoque s WHERE s.loja_id = movimentos_estoque.loja_id
+            )
+        """, ()),
+        (
+            "INSERT OR REPLACE INTO manutencao (chave, valor) VALUES ('ultima_compactacao', ?)",
+            (datetime.now().strftime("%Y-%m-%d"),)
+        ),
+    ], "compactacao")
     sync_db()
 
+    erro_vacuum = _get_manager().vacuum_local()
+    return {"reposicao": n_repo, "uploads": n_hist, "erro_vacuum": erro_vacuum}
+
+
+def _vacuum_incremental(conn):
+    """
+    Devolve páginas livres do camda_local.db. Na primeira vez converte o
+    arquivo para auto_vacuum=INCREMENTAL (exige um VACUUM completo, uma vez só).
+    Retorna a mensagem de erro do banco (travado, disco cheio...) ou None.
+    """
+    try:
+        modo = conn.execute("PRAGMA auto_vacuum").fetchone()
+        if not modo or int(modo[0]) != 2:
+            conn.execute("PRAGMA auto_vacuum = INCREMENTAL")
+            conn.execute("VACUUM")
+        conn.execute("PRAGMA incremental_vacuum")
+    except (libsql.Error, sqlite3.Error, ValueError) as e:  # libsql levanta ValueError
+        return str(e)
+    return None
+
+
+def erro_manutencao():
+    """Último erro do VACUUM desta máquina ainda não resolvido (exibido na área de administração)."""
+    return _get_manager().erro_vacuum
+
+
+def manutencao_diaria():
+    """Roda compactar_historico no máximo uma vez por dia (primeira sessão do dia)."""
+    conn = get_db()
+    row = conn.execute("SELECT valor FROM manutencao WHERE chave = 'ultima_compactacao'").fetchone()
+    if row and row[0] == datetime.now().strftime("%Y-%m-%d"):
+        return
+    compactar_historico()
+
 
 # ── Classificação e Parsing ──────────────────────────────────────────────────
 
@@ -362,6 +2033,50 @@ def short_name(prod: str) -> str:
     return str(prod)
 
 
+def normalizar_nome(prod: str) -> str:
+    """
+    Chave de comparação de nomes: sem acento, maiúsculas, sem o prefixo de tipo
+    (short_name), só letras/números separados por um espaço e "20 L" → "20L".
+    """
+    sem_acento = unicodedata.normalize("NFKD", str(prod)).encode("ascii", "ignore").decode("ascii")
+    nome = re.sub(r"[^A-Z0-9]+", " ", short_name(sem_acento.upper().strip())).strip()
+    return re.sub(r"(\d) (?=[A-Z])", r"\1", nome)
+
+
+def dobrar_busca(texto: str) -> str:
+    """Texto sem acento e em maiúsculas — o que a busca do mestre compara."""
+    sem_acento = "".join(
+        c for c in unicodedata.normalize("NFKD", str(texto)) if not unicodedata.combining(c)
+    )
+    return sem_acento.upper()
+
+
+def chave_busca(codigo: str, produto: str) -> str:
+    """
+    Valor de estoque_mestre.busca: código e produto dobrados, numa linha cada.
+    O termo da busca passa por dobrar_busca e é procurado como substring, tanto
+    no SQL (instr) quanto no frame — os dois lados contam as mesmas linhas.
+    """
+    return f"{dobrar_busca(codigo)}\n{dobrar_busca(produto)}"
+
+
+def termo_busca(termo: str) -> str:
+    """Termo da busca já dobrado ('' = sem filtro). A quebra de linha separa código e produto."""
+    return dobrar_busca(str(termo).replace("\n", " ").strip())
+
+
+def codigo_auto(prod: str) -> str:
+    """
+    Código para linhas sem código. Nomes de até 20 caracteres mantêm o formato
+    antigo; nomes maiores ganham um hash do nome inteiro, para dois produtos com
+    o mesmo começo não caírem na mesma linha.
+    """
+    alnum = re.sub(r"[^A-Z0-9]", "", str(prod).upper())
+    if len(alnum) <= 20:
+        return "AUTO_" + alnum
+    return f"AUTO_{alnum[:20]}_{zlib.crc32(alnum.encode('ascii')) & 0xFFFFFF:06X}"
+
+
 # ══════════════════════════════════════════════════════════════════════════════
 # CORREÇÃO 1: parse_annotation com regex abrangente
 # ══════════════════════════════════════════════════════════════════════════════
@@ -515,7 +2230,7 @@ def parse_estoque_format(df_raw: pd.DataFrame) -> tuple:
             if codigo.upper() in ["NAN", "NONE", ""]:
                 codigo = ""
         if not codigo:
-            codigo = "AUTO_" + re.sub(r"[^A-Z0-9]", "", produto.upper())[:20]
+            codigo = codigo_auto(produto)
 
         nota_raw = ""
         if "nota" in col_map:
@@ -602,7 +2317,7 @@ def parse_vendas_format(df_raw: pd.DataFrame) -> tuple:
             codigo = m.group(1).strip()
             produto = m.group(2).strip()
         else:
-            codigo = "AUTO_" + re.sub(r"[^A-Z0-9]", "", raw_prod.upper())[:20]
+            codigo = codigo_auto(raw_prod)
             produto = raw_prod
 
         qtd_sistema = 0
@@ -655,21 +2370,27 @@ def parse_vendas_format(df_raw: pd.DataFrame) -> tuple:
 
 def read_excel_to_records(uploaded_file) -> tuple:
     try:
-        df_raw = pd.read_excel(uploaded_file, sheet_name=0, header=None)
+        with perfil_span("parse", "read_excel"):
+            df_raw = pd.read_excel(uploaded_file, sheet_name=0, header=None)
     except Exception as e:
         return (False, f"Erro ao ler arquivo: {e}")
 
-    fmt = detect_format(df_raw)
+    with perfil_span("parse", "detect_format"):
+        fmt = detect_format(df_raw)
 
     if fmt == "vendas":
-        return parse_vendas_format(df_raw)
+        with perfil_span("parse", "parse_vendas_format"):
+            return parse_vendas_format(df_raw)
     elif fmt == "estoque":
-        return parse_estoque_format(df_raw)
+        with perfil_span("parse", "parse_estoque_format"):
+            return parse_estoque_format(df_raw)
     else:
-        ok, result = parse_estoque_format(df_raw)
+        with perfil_span("parse", "parse_estoque_format"):
+            ok, result = parse_estoque_format(df_raw)
         if ok:
             return (ok, result)
-        ok2, result2 = parse_vendas_format(df_raw)
+        with perfil_span("parse", "parse_vendas_format"):
+            ok2, result2 = parse_vendas_format(df_raw)
         if ok2:
             return (ok2, result2)
         return (False, "Formato não reconhecido. Colunas esperadas:\n"
@@ -677,110 +2398,722 @@ def read_excel_to_records(uploaded_file) -> tuple:
                        "• Vendas: 'PRODUTO' + 'QTDD ESTOQUE' ou 'QTDD - VENDIDA'")
 
 
+# ── Índice de nomes (códigos AUTO_) ─────────────────────────────────────────
+# Planilhas sem coluna de código geram AUTO_<nome>. Antes de gravar, cada linha
+# AUTO_ é procurada no índice nome normalizado → código: primeiro exata (dict),
+# depois aproximada, comparando só com os nomes do mesmo bloco (primeira palavra).
+# A aproximada só aceita nomes com os mesmos números/medidas ("20L" ≠ "10L",
+# "390" ≠ "290": são outros produtos, não erros de digitação) e desiste se dois
+# códigos empatam no melhor resultado.
+
+NOME_SIMILARIDADE_MIN = 0.9
+NOMES_LOTE = 400
+
+
+def _bloco_nome(nome_norm: str) -> str:
+    return nome_norm.split(" ", 1)[0]
+
+
+def _medidas_nome(nome_norm: str) -> list:
+    """Números e medidas do nome normalizado (tamanho, variedade, concentração)."""
+    return re.findall(r"\d+[A-Z]*", nome_norm)
+
+
+def _nome_aproximado(nome: str, candidatos):
+    """
+    Código do candidato (nome, código) mais parecido com `nome`, com razão de
+    similaridade ≥ NOME_SIMILARIDADE_MIN e as mesmas medidas. None se nenhum
+    passa ou se códigos diferentes empatam no topo.
+    """
+    medidas = _medidas_nome(nome)
+    melhor, melhor_ratio, empate = None, NOME_SIMILARIDADE_MIN, False
+    matcher = SequenceMatcher(a=nome, autojunk=False)
+    for candidato, codigo in candidatos:
+        matcher.set_seq2(candidato)
+        if matcher.real_quick_ratio() < melhor_ratio or matcher.quick_ratio() < melhor_ratio:
+            continue
+        if _medidas_nome(candidato) != medidas:
+            continue
+        ratio = matcher.ratio()
+        if ratio > melhor_ratio or melhor is None and ratio == melhor_ratio:
+            melhor, melhor_ratio, empate = codigo, ratio, False
+        elif ratio == melhor_ratio and codigo != melhor:
+            empate = True
+    return None if empate else melhor
+
+
+def _nomes_ops(loja_id: str, records: list) -> list:
+    """
+    Ops que alimentam o índice com os pares nome → código do lote. Código real
+    sempre substitui um AUTO_; um AUTO_ nunca substitui um código real.
+    """
+    pares = {}
+    for r in records:
+        nome = normalizar_nome(r["produto"])
+        if nome and (nome not in pares or pares[nome].startswith("AUTO_")):
+            pares[nome] = r["codigo"]
+    itens = list(pares.items())
+    ops = []
+    for i in range(0, len(itens), NOMES_LOTE):
+        lote = itens[i:i + NOMES_LOTE]
+        ops.append((f"""
+            INSERT INTO nomes_produto (loja_id, nome_norm, codigo, bloco)
+            VALUES {", ".join("(?, ?, ?, ?)" for _ in lote)}
+            ON CONFLICT (loja_id, nome_norm) DO UPDATE SET codigo = excluded.codigo
+            WHERE substr(excluded.codigo, 1, 5) != 'AUTO_' OR substr(nomes_produto.codigo, 1, 5) = 'AUTO_'
+        """, tuple(v for nome, codigo in lote for v in (loja_id, nome, codigo, _bloco_nome(nome)))))
+    return ops
+
+
+@perfilado("parse")
+def resolver_codigos_auto(conn, loja_id: str, records: list) -> int:
+    """
+    Troca, no lugar, o código AUTO_ das linhas que batem com um produto já
+    conhecido da filial. Retorna quantas linhas foram resolvidas.
+    """
+    if not any(r["codigo"].startswith("AUTO_") for r in records):
+        return 0
+    indice = {}
+    blocos = {}
+    for nome, codigo, bloco in conn.execute(
+        "SELECT nome_norm, codigo, bloco FROM nomes_produto WHERE loja_id = ?", (loja_id,)
+    ).fetchall():
+        indice[nome] = codigo
+        if not codigo.startswith("AUTO_"):
+            blocos.setdefault(bloco, []).append((nome, codigo))
+
+    resolvidos = 0
+    for r in records:
+        if not r["codigo"].startswith("AUTO_"):
+            continue
+        nome = normalizar_nome(r["produto"])
+        codigo = indice.get(nome)
+        if codigo is None:
+            codigo = _nome_aproximado(nome, blocos.get(_bloco_nome(nome), ()))
+        if codigo and codigo != r["codigo"]:
+            r["codigo"] = codigo
+            resolvidos += 1
+    return resolvidos
+
+
 # ── Upload Mestre ────────────────────────────────────────────────────────────
 
-def upload_mestre(uploaded_file) -> tuple:
+def upload_mestre(uploaded_file, loja_id: str = LOJA_PADRAO) -> tuple:
     ok, result = read_excel_to_records(uploaded_file)
     if not ok:
         return (False, result)
 
-    records = result
     conn = get_db()
-    now = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-
-    conn.execute("DELETE FROM estoque_mestre")
+    n_resolvidos = resolver_codigos_auto(conn, loja_id, result)
+    records = list({r["codigo"]: r for r in result}.values())  # última linha de cada código vale
+    now, now_ts = agora()
+    n_div = sum(1 for r in records if r["status"] != "ok")
 
+    # Snapshot e razão leem o mestre dentro da transação, antes de ele ser apagado
+    ops = _snapshot_ops(loja_id, now_ts, "MESTRE") + _movimento_ops(loja_id, records, now_ts, removidos=True)
+    ops += _bump_versao_ops(loja_id, nova_base=True) + [("DELETE FROM estoque_mestre WHERE loja_id = ?", (loja_id,))]
     for r in records:
-        conn.execute("""
+        ops.append((f"""
             INSERT INTO estoque_mestre
-                (codigo, produto, categoria, qtd_sistema, qtd_fisica, diferenca, nota, status, ultima_contagem, criado_em)
-            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+                (loja_id, codigo, produto, categoria, qtd_sistema, qtd_fisica, diferenca, nota, status,
+                 ultima_contagem, criado_em, ultima_contagem_ts, criado_em_ts, busca, versao)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, {_VERSAO_ATUAL})
         """, (
-            r["codigo"], r["produto"], r["categoria"],
+            loja_id, r["codigo"], r["produto"], r["categoria"],
             r["qtd_sistema"], r["qtd_fisica"], r["diferenca"],
-            r["nota"], r["status"], now, now,
-        ))
-
-    n_div = sum(1 for r in records if r["status"] != "ok")
-    conn.execute("""
-        INSERT INTO historico_uploads (data, tipo, arquivo, total_produtos_lote, novos, atualizados, divergentes)
-        VALUES (?, ?, ?, ?, ?, ?, ?)
-    """, (now, "MESTRE", uploaded_file.name, len(records), len(records), 0, n_div))
-
-    conn.commit()
+            r["nota"], r["status"], now, now, now_ts, now_ts,
+            chave_busca(r["codigo"], r["produto"]), loja_id,
+        )))
+    ops.extend(_resumo_ops(loja_id))
+    ops.extend(_nomes_ops(loja_id, records))
+    ops.extend(_divergencia_diaria_ops(loja_id))
+    ops.append(("""
+        INSERT INTO historico_uploads
+            (loja_id, data, data_ts, tipo, arquivo, total_produtos_lote, novos, atualizados, divergentes)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+    """, (loja_id, now, now_ts, "MESTRE", uploaded_file.name, len(records), len(records), 0, n_div)))
+
+    aplicado = run_write(ops, "MESTRE")
     sync_db()  # ← Sincroniza com Turso após escrita
-    return (True, f"✅ Mestre carregado: {len(records)} produtos ({n_div} divergências)")
+    pedir_publicacao(loja_id)
+    if not aplicado:
+        return (True, f"⏳ Mestre salvo no diário local: {len(records)} produtos — será enviado quando a conexão voltar")
+    msg = f"✅ Mestre carregado: {len(records)} produtos ({n_div} divergências)"
+    if n_resolvidos:
+        msg += f" · 🔗 {n_resolvidos} sem código associados a produtos conhecidos"
+    return (True, msg)
 
 
 # ── Upload Parcial ───────────────────────────────────────────────────────────
 
-def upload_parcial(uploaded_file) -> tuple:
+def upload_parcial(uploaded_file, loja_id: str = LOJA_PADRAO) -> tuple:
     ok, result = read_excel_to_records(uploaded_file)
     if not ok:
         return (False, result)
 
-    records = result
     conn = get_db()
-    now = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    n_resolvidos = resolver_codigos_auto(conn, loja_id, result)
+    res = _gravar_parcial(conn, loja_id, result, "PARCIAL", uploaded_file.name)
+
+    msg = f"✅ Parcial processada: {res['produtos']} produtos"
+    if res["atualizados"]:
+        msg += f" · {res['atualizados']} atualizados"
+    if res["novos"]:
+        msg += f" · {res['novos']} novos"
+    if res["divergentes"]:
+        msg += f" · {res['divergentes']} divergências"
+    if res["repor"]:
+        msg += f" · 🏪 {res['repor']} para repor na loja"
+    if n_resolvidos:
+        msg += f" · 🔗 {n_resolvidos} sem código associados a produtos conhecidos"
+    if not res["aplicado"]:
+        msg += " · ⏳ salvo no diário local, será enviado quando a conexão voltar"
+    return (True, msg)
+
+
+def _gravar_parcial(conn, loja_id: str, result: list, tipo: str, arquivo: str, repor: bool = True) -> dict:
+    """
+    Upsert de um lote de registros no mestre da filial (uma transação, um sync).
+    Usado pelo upload PARCIAL e pela contagem no app.
+    """
+    records = list({r["codigo"]: r for r in result}.values())  # última linha de cada código vale
+    now, now_ts = agora()
+    n_div = sum(1 for r in records if r["status"] != "ok")
+
+    anteriores = _estado_estoque(conn, loja_id)
+    existentes = {codigo: campos[0] for codigo, campos in anteriores.items()}
+    categorias_tocadas = set()
     novos = 0
     atualizados = 0
 
+    # Snapshot e razão comparam com o mestre dentro da transação, antes do upsert
+    ops = _snapshot_periodico_ops(loja_id, now_ts) + _movimento_ops(loja_id, records, now_ts)
+    ops += _bump_versao_ops(loja_id)
     for r in records:
-        existing = conn.execute(
-            "SELECT codigo FROM estoque_mestre WHERE codigo = ?", (r["codigo"],)
-        ).fetchone()
-
-        if existing:
-            conn.execute("""
-                UPDATE estoque_mestre SET
-                    produto = ?, categoria = ?, qtd_sistema = ?, qtd_fisica = ?,
-                    diferenca = ?, nota = ?, status = ?, ultima_contagem = ?
-                WHERE codigo = ?
-            """, (
-                r["produto"], r["categoria"],
-                r["qtd_sistema"], r["qtd_fisica"], r["diferenca"],
-                r["nota"], r["status"], now, r["codigo"],
-            ))
+        if r["codigo"] in existentes:
             atualizados += 1
+            categorias_tocadas.add(existentes[r["codigo"]])  # pode ter mudado de categoria
         else:
-            conn.execute("""
-                INSERT INTO estoque_mestre
-                    (codigo, produto, categoria, qtd_sistema, qtd_fisica, diferenca, nota, status, ultima_contagem, criado_em)
-                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
-            """, (
-                r["codigo"], r["produto"], r["categoria"],
-                r["qtd_sistema"], r["qtd_fisica"], r["diferenca"],
-                r["nota"], r["status"], now, now,
-            ))
             novos += 1
+        existentes[r["codigo"]] = r["categoria"]
+        categorias_tocadas.add(r["categoria"])
 
-    n_div = sum(1 for r in records if r["status"] != "ok")
-    n_repo = detectar_reposicao_loja(records, conn, now)
-    conn.execute("""
-        INSERT INTO historico_uploads (data, tipo, arquivo, total_produtos_lote, novos, atualizados, divergentes)
-        VALUES (?, ?, ?, ?, ?, ?, ?)
-    """, (now, "PARCIAL", uploaded_file.name, len(records), novos, atualizados, n_div))
-
-    conn.commit()
+        # Upsert: mesmo resultado do SELECT + UPDATE/INSERT, e seguro no replay do diário
+        ops.append((f"""
+            INSERT INTO estoque_mestre
+                (loja_id, codigo, produto, categoria, qtd_sistema, qtd_fisica, diferenca, nota, status,
+                 ultima_contagem, criado_em, ultima_contagem_ts, criado_em_ts, busca, versao)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, {_VERSAO_ATUAL})
+            ON CONFLICT (loja_id, codigo) DO UPDATE SET
+                produto = excluded.produto, busca = excluded.busca, categoria = excluded.categoria,
+                qtd_sistema = excluded.qtd_sistema, qtd_fisica = excluded.qtd_fisica,
+                diferenca = excluded.diferenca, nota = excluded.nota,
+                status = excluded.status, ultima_contagem = excluded.ultima_contagem,
+                ultima_contagem_ts = excluded.ultima_contagem_ts, versao = excluded.versao
+        """, (
+            loja_id, r["codigo"], r["produto"], r["categoria"],
+            r["qtd_sistema"], r["qtd_fisica"], r["diferenca"],
+            r["nota"], r["status"], now, now, now_ts, now_ts,
+            chave_busca(r["codigo"], r["produto"]), loja_id,
+        )))
+
+    ops.extend(_resumo_ops(loja_id, categorias_tocadas))
+    ops.extend(_nomes_ops(loja_id, records))
+    ops.extend(_divergencia_diaria_ops(loja_id, categorias_tocadas))
+    n_repo = 0
+    if repor:
+        ops_repo, n_repo = detectar_reposicao_loja(records, conn, loja_id, now, now_ts)
+        ops.extend(ops_repo)
+    ops.append(("""
+        INSERT INTO historico_uploads
+            (loja_id, data, data_ts, tipo, arquivo, total_produtos_lote, novos, atualizados, divergentes)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+    """, (loja_id, now, now_ts, tipo, arquivo, len(records), novos, atualizados, n_div)))
+
+    aplicado = run_write(ops, tipo)
     sync_db()  # ← Sincroniza com Turso após escrita
+    pedir_publicacao(loja_id)
+    return {
+        "produtos": len(records), "novos": novos, "atualizados": atualizados,
+        "divergentes": n_div, "repor": n_repo, "aplicado": aplicado,
+    }
 
-    msg = f"✅ Parcial processada: {len(records)} produtos"
-    if atualizados:
-        msg += f" · {atualizados} atualizados"
-    if novos:
-        msg += f" · {novos} novos"
-    if n_div:
-        msg += f" · {n_div} divergências"
-    if n_repo:
-        msg += f" · 🏪 {n_repo} para repor na loja"
-    return (True, msg)
+
+# ── Contagem no app ──────────────────────────────────────────────────────────
+# As edições ficam num buffer da sessão e vão para o banco em lote: depois de
+# CONTAGEM_AUTOSAVE_S sem novas edições, ou no botão salvar. Cada lote passa
+# pelo mesmo parse_annotation das planilhas, então status/diferença/nota saem
+# exatamente como sairiam de um upload PARCIAL com a anotação equivalente.
+
+CONTAGEM_AUTOSAVE_S = float(_get_secret("CAMDA_CONTAGEM_AUTOSAVE_S") or 4)
+CONTAGEM_MAX_RESULTADOS = 30
+
+
+def registro_contagem(codigo: str, atual: tuple, qtd_fisica: int, obs: str) -> dict:
+    """
+    Registro de upload equivalente a uma contagem: a quantidade contada vira a
+    anotação "falta N" / "sobra N" (mais a observação) e passa pelo parse_annotation.
+    `atual` é a tupla de _estado_estoque para o código.
+    """
+    categoria, produto, qtd_sistema = atual[0], atual[1], atual[2]
+    obs = str(obs or "").strip()
+    diferenca = int(qtd_fisica) - int(qtd_sistema)
+    if diferenca < 0:
+        texto = f"falta {-diferenca} {obs}"
+    elif diferenca > 0:
+        texto = f"sobra {diferenca} {obs}"
+    else:
+        texto = obs
+    qtd_fisica, diferenca, observacao, status = parse_annotation(texto.strip(), qtd_sistema)
+    return {
+        "codigo": codigo, "produto": produto, "categoria": categoria,
+        "qtd_sistema": qtd_sistema, "qtd_fisica": qtd_fisica,
+        "diferenca": diferenca, "nota": observacao, "status": status,
+    }
+
+
+def salvar_contagem(loja_id: str, contagens: dict) -> dict:
+    """Grava {codigo: (qtd_fisica, obs)} num único upsert (códigos sumidos do mestre são ignorados)."""
+    conn = get_db()
+    estado = _estado_estoque(conn, loja_id)
+    records = [
+        registro_contagem(codigo, estado[codigo], qtd, obs)
+        for codigo, (qtd, obs) in contagens.items() if codigo in estado
+    ]
+    if not records:
+        return {"produtos": 0, "aplicado": True}
+    return _gravar_parcial(conn, loja_id, records, "CONTAGEM", "contagem no app", repor=False)
+
+
+def buscar_para_contagem(loja_id: str, termo: str) -> pd.DataFrame:
+    """Código exato primeiro, depois código/nome contendo o termo (nome normalizado)."""
+    df, nomes = _get_stock_store(loja_id).com_nomes_normalizados()
+    termo = str(termo).strip()
+    if not termo:
+        return df.iloc[0:0].copy()  # fatia vazia, mas não uma view do frame compartilhado
+    exato = df[df["codigo"] == termo]
+    if not exato.empty:
+        return exato
+    chave = normalizar_nome(termo)
+    mask = df["codigo"].str.contains(termo, case=False, regex=False, na=False)
+    if chave:
+        mask |= nomes.str.contains(chave, regex=False, na=False)
+    return df[mask].head(CONTAGEM_MAX_RESULTADOS)
+
+
+@st.fragment
+@perfil_rerun("render_contagem")
+def render_contagem(loja_id: str):
+    """Busca + edição das quantidades contadas (edições só reexecutam este trecho)."""
+    pendentes = st.session_state.setdefault(f"contagem_pendentes_{loja_id}", {})
+    termo = st.text_input(
+        "Buscar para contar", key=f"contagem_busca_{loja_id}",
+        placeholder="🔎 Código ou nome do produto", label_visibility="collapsed",
+    )
+    achados = buscar_para_contagem(loja_id, termo)
+    if termo and achados.empty:
+        st.info("Nenhum produto encontrado.")
+    if not achados.empty:
+        # Último valor salvo por esta sessão: vale até o frame compartilhado mostrar
+        # a escrita (offline ela fica só no diário; online a versão nova demora um rerun)
+        salvos = st.session_state.setdefault(f"contagem_salvos_{loja_id}", {})
+        codigos = achados["codigo"].tolist()
+        banco = list(zip(
+            achados["qtd_fisica"].fillna(achados["qtd_sistema"]).astype(int).tolist(),
+            achados["nota"].fillna("").astype(str).tolist(),
+        ))
+        for c, valor in zip(codigos, banco):
+            if salvos.get(c) == valor:
+                del salvos[c]
+        # Edições ainda no buffer (ou já salvas) continuam visíveis ao trocar a busca
+        atuais = [pendentes.get(c) or salvos.get(c) or valor for c, valor in zip(codigos, banco)]
+        base = pd.DataFrame({
+            "codigo": codigos,
+            "produto": achados["produto"].tolist(),
+            "qtd_sistema": achados["qtd_sistema"].astype(int).tolist(),
+            "qtd_fisica": [q for q, _ in atuais],
+            "nota": [n for _, n in atuais],
+        })
+        # edited_rows guarda posições de linha: a chave inclui os códigos, para uma
+        # edição nunca passar para outro produto se o resultado da busca mudar
+        lista = hashlib.sha256("\n".join(codigos).encode("utf-8")).hexdigest()[:16]
+        chave_editor = f"contagem_editor_{loja_id}_{termo}_{lista}"
+        editado = st.data_editor(
+            base,
+            hide_index=True,
+            use_container_width=True,
+            key=chave_editor,
+            disabled=["codigo", "produto", "qtd_sistema"],
+            column_config={
+                "codigo": st.column_config.TextColumn("Cod"),
+                "produto": st.column_config.TextColumn("Produto"),
+                "qtd_sistema": st.column_config.NumberColumn("Sistema"),
+                "qtd_fisica": st.column_config.NumberColumn("Contado", min_value=0, step=1),
+                "nota": st.column_config.TextColumn("Obs"),
+            },
+        )
+        # O delta do editor continua no widget depois do autosave: só entra no buffer
+        # o que difere do valor atual (buffer, último salvo ou banco) — senão cada
+        # rerun enfileiraria de novo as mesmas contagens
+        for i in st.session_state.get(chave_editor, {}).get("edited_rows", {}):
+            row = editado.iloc[int(i)]
+            if pd.isna(row["qtd_fisica"]):
+                continue
+            valor = (int(row["qtd_fisica"]), "" if pd.isna(row["nota"]) else str(row["nota"]))
+            if valor != atuais[int(i)]:
+                pendentes[row["codigo"]] = valor
+                st.session_state[f"contagem_editado_em_{loja_id}"] = time.time()
+    _autosave_contagem(loja_id)
+
+
+@st.fragment(run_every=CONTAGEM_AUTOSAVE_S)
+@perfil_rerun("_autosave_contagem")
+def _autosave_contagem(loja_id: str):
+    """Grava o buffer em lote quando a contagem fica parada (ou no botão)."""
+    pendentes = st.session_state.setdefault(f"contagem_pendentes_{loja_id}", {})
+    parado = time.time() - st.session_state.get(f"contagem_editado_em_{loja_id}", 0)
+    col_info, col_btn = st.columns([2, 1])
+    with col_btn:
+        salvar = st.button(
+            f"💾 Salvar ({len(pendentes)})", disabled=not pendentes,
+            use_container_width=True, key=f"contagem_salvar_{loja_id}",
+        )
+    if pendentes and (salvar or parado >= CONTAGEM_AUTOSAVE_S):
+        res = salvar_contagem(loja_id, dict(pendentes))
+        st.session_state.setdefault(f"contagem_salvos_{loja_id}", {}).update(pendentes)
+        pendentes.clear()
+        st.session_state[f"contagem_salvo_{loja_id}"] = (
+            datetime.now().strftime("%H:%M:%S"), res["produtos"], res["aplicado"]
+        )
+    with col_info:
+        salvo = st.session_state.get(f"contagem_salvo_{loja_id}")
+        if pendentes:
+            st.caption(f"✏️ {len(pendentes)} alteração(ões) — salva automaticamente em alguns segundos")
+        elif salvo and salvo[2]:
+            st.caption(f"✅ {salvo[1]} item(ns) salvos às {salvo[0]}")
+        elif salvo:
+            st.caption(f"⏳ {salvo[1]} item(ns) no diário local ({salvo[0]}) — sobem quando a conexão voltar")
+
+
+# ── Exportação ───────────────────────────────────────────────────────────────
+# Os arquivos são escritos direto do cursor SQL, em blocos (fetchmany), para um
+# arquivo temporário: nem o CSV nem o XLSX (xlsxwriter constant_memory) montam
+# a planilha inteira em memória. A geração roda numa thread separada, então a
+# página continua respondendo enquanto um catálogo grande é exportado.
+
+EXPORT_DIR = os.path.join(tempfile.gettempdir(), "camda_exports")
+EXPORT_MAX_IDADE_S = 3600
+EXPORT_POLL_S = 2  # intervalo da checagem de uma exportação em andamento
+EXPORT_FORMATOS = ["xlsx", "csv"] if xlsxwriter is not None else ["csv"]
+EXPORT_MIME = {
+    "csv": "text/csv",
+    "xlsx": "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
+}
+
+_EXPORT_ESTOQUE_COLS = (
+    "codigo, produto, categoria, qtd_sistema, qtd_fisica, diferenca, nota, status, ultima_contagem"
+)
+
+
+def _export_consultas(tipo: str, loja_id: str, busca: str = "") -> list:
+    """[(nome da aba, sql, params)] de cada exportação da filial. CSV usa só a primeira."""
+    filtro, params = "", (loja_id,)
+    termo = termo_busca(busca)
+    if termo:
+        filtro = " AND instr(busca, ?) > 0"
+        params = (loja_id, termo)
+
+    if tipo == "divergencias":
+        return [("Divergências", f"""
+            SELECT codigo, produto, categoria, qtd_sistema, qtd_fisica, diferenca, nota, ultima_contagem
+            FROM estoque_mestre WHERE loja_id = ? AND status IN ('falta', 'sobra'){filtro}
+            ORDER BY categoria, produto
+        """, params)]
+    if tipo == "danificados":
+        return [("Danificados", f"""
+            SELECT codigo, produto, categoria, qtd_sistema, nota, ultima_contagem
+            FROM estoque_mestre WHERE loja_id = ? AND status = 'danificado'{filtro}
+            ORDER BY categoria, produto
+        """, params)]
+    if tipo == "reposicao":
+        _, now_ts = agora()
+        return [("Repor na Loja", """
+            SELECT codigo, produto, categoria, qtd_vendida, criado_em
+            FROM reposicao_loja
+            WHERE loja_id = ? AND reposto = 0 AND criado_em_ts >= ?
+            ORDER BY categoria, produto
+        """, (loja_id, now_ts - 7 * 86400))]
+    if tipo == "mestre":
+        return [
+            ("Estoque", f"SELECT {_EXPORT_ESTOQUE_COLS} FROM estoque_mestre WHERE loja_id = ?{filtro} "
+                        "ORDER BY categoria, produto", params),
+            ("Uploads", "SELECT data, tipo, arquivo, total_produtos_lote, novos, atualizados, divergentes "
+                        "FROM historico_uploads WHERE loja_id = ? ORDER BY data_ts", (loja_id,)),
+            ("Uploads (resumo diário)", "SELECT dia, tipo, uploads, total_produtos_lote, novos, atualizados, "
+                                        "divergentes FROM uploads_resumo_diario WHERE loja_id = ? ORDER BY dia",
+             (loja_id,)),
+        ]
+    raise ValueError(f"Exportação desconhecida: {tipo}")
+
+
+def _stream_rows(conn, sql: str, params: tuple, chunk: int = 2000):
+    """(cabeçalho, gerador de blocos de linhas) de uma consulta."""
+    cur = conn.execute(sql, params)
+    header = [d[0] for d in cur.description]
+
+    def blocos():
+        while True:
+            rows = cur.fetchmany(chunk)
+            if not rows:
+                return
+            yield rows
+
+    return header, blocos()
+
+
+def exportar(conn, tipo: str, fmt: str, loja_id: str = LOJA_PADRAO, busca: str = "") -> str:
+    """Gera o arquivo de exportação e retorna o caminho."""
+    os.makedirs(EXPORT_DIR, exist_ok=True)
+    limite = time.time() - EXPORT_MAX_IDADE_S
+    for nome in os.listdir(EXPORT_DIR):
+        caminho = os.path.join(EXPORT_DIR, nome)
+        if os.path.getmtime(caminho) < limite:
+            os.remove(caminho)
+
+    consultas = _export_consultas(tipo, loja_id, busca)
+    fd, path = tempfile.mkstemp(prefix=f"camda_{loja_id}_{tipo}_", suffix=f".{fmt}", dir=EXPORT_DIR)
+    os.close(fd)
+
+    if fmt == "csv":
+        _, sql, params = consultas[0]
+        header, blocos = _stream_rows(conn, sql, params)
+        with open(path, "w", newline="", encoding="utf-8-sig") as f:  # BOM: Excel abre acentos certo
+            writer = csv.writer(f, delimiter=";")
+            writer.writerow(header)
+            for rows in blocos:
+                writer.writerows(rows)
+        return path
+
+    wb = xlsxwriter.Workbook(path, {"constant_memory": True})
+    bold = wb.add_format({"bold": True})
+    for aba, sql, params in consultas:
+        ws = wb.add_worksheet(aba[:31])
+        header, blocos = _stream_rows(conn, sql, params)
+        ws.write_row(0, 0, header, bold)
+        i = 1
+        for rows in blocos:
+            for row in rows:
+                ws.write_row(i, 0, row)
+                i += 1
+    wb.close()
+    return path
+
+
+@st.cache_resource
+def _get_export_executor() -> ThreadPoolExecutor:
+    return ThreadPoolExecutor(max_workers=2, thread_name_prefix="camda-export")
+
+
+@st.fragment
+@perfil_rerun("render_export")
+def render_export(tipo: str, rotulo: str, loja_id: str, busca: str = ""):
+    """Botões gerar/baixar de uma exportação (gera em segundo plano; reexecuta só este trecho)."""
+    col_fmt, col_btn = st.columns([1, 2])
+    with col_fmt:
+        fmt = st.radio(
+            "Formato", EXPORT_FORMATOS, horizontal=True,
+            key=f"export_fmt_{tipo}", label_visibility="collapsed",
+        )
+    chave = (tipo, fmt, loja_id, busca)
+    job = st.session_state.get(f"export_job_{tipo}")
+
+    with col_btn:
+        if job and job["chave"] == chave and not job["future"].done():
+            _aguardar_export(tipo)
+            return
+        if job and job["chave"] == chave:
+            try:
+                path = job["future"].result()
+            except Exception as e:
+                st.error(f"Erro na exportação: {e}")
+            else:
+                st.download_button(
+                    f"⬇️ Baixar {rotulo} ({fmt.upper()})", _ler_export(path),
+                    file_name=f"camda_{loja_id}_{tipo}_{job['quando']}.{fmt}",
+                    mime=EXPORT_MIME[fmt], key=f"export_dl_{tipo}",
+                )
+        label = "🔁 Gerar novamente" if job and job["chave"] == chave else f"📄 Exportar {rotulo}"
+        if st.button(label, key=f"export_go_{tipo}"):
+            mgr = _get_manager()
+            # A thread de exportação usa a própria conexão de leitura
+            future = _get_export_executor().submit(lambda: exportar(mgr.reader(), tipo, fmt, loja_id, busca))
+            st.session_state[f"export_job_{tipo}"] = {
+                "chave": chave, "future": future,
+                "quando": datetime.now().strftime("%Y%m%d_%H%M"),
+            }
+            st.rerun(scope="fragment")
+
+
+def _ler_export(path: str):
+    """
+    Conteúdo do arquivo só no toque em Baixar (download_button chama em outra
+    thread): os reruns do trecho não leem o arquivo para a memória.
+    """
+    def ler():
+        with open(path, "rb") as f:
+            return f.read()
+    return ler
+
+
+@st.fragment(run_every=EXPORT_POLL_S)
+def _aguardar_export(tipo: str):
+    """Confere a exportação em andamento sozinho; quando termina, redesenha a página com o botão Baixar."""
+    job = st.session_state.get(f"export_job_{tipo}")
+    if job and not job["future"].done():
+        st.caption("⏳ Gerando exportação...")
+        return
+    st.rerun()  # este trecho só existe enquanto gera; o de fora mostra o resultado
+
+
+# ── Tabelas paginadas ────────────────────────────────────────────────────────
+# Divergências, Danificados e o log de uploads não passam pelo frame em memória:
+# filtro, ordem e LIMIT/OFFSET vão para o SQL e só a página visível é lida.
+# As ordens são uma lista fechada (nada do usuário entra no ORDER BY) e sempre
+# terminam numa coluna única, para a paginação ser estável.
+
+TABELA_POR_PAGINA = 50
+
+TABELAS_PAGINADAS = {
+    "divergencias": {
+        "colunas": "codigo, produto, categoria, qtd_sistema, qtd_fisica, diferenca, nota, ultima_contagem",
+        "de": "estoque_mestre",
+        "onde": "loja_id = ? AND status IN ('falta', 'sobra')",
+        "ordens": {
+            "Categoria / produto": "categoria, produto, codigo",
+            "Maior falta": "diferenca, codigo",
+            "Maior sobra": "diferenca DESC, codigo DESC",
+            "Contagem mais recente": "ultima_contagem_ts DESC, codigo DESC",
+            "Contagem mais antiga": "ultima_contagem_ts, codigo",
+        },
+        "busca": True,
+    },
+    "danificados": {
+        "colunas": "codigo, produto, categoria, qtd_sistema, nota, ultima_contagem",
+        "de": "estoque_mestre",
+        "onde": "loja_id = ? AND status = 'danificado'",
+        "ordens": {
+            "Categoria / produto": "categoria, produto, codigo",
+            "Contagem mais recente": "ultima_contagem_ts DESC, codigo DESC",
+            "Contagem mais antiga": "ultima_contagem_ts, codigo",
+            "Maior quantidade": "qtd_sistema DESC, codigo DESC",
+        },
+        "busca": True,
+    },
+    "uploads": {
+        "colunas": "data, tipo, arquivo, total_produtos_lote, novos, atualizados, divergentes",
+        "de": "historico_uploads",
+        "onde": "loja_id = ?",
+        "ordens": {
+            "Mais recentes": "data_ts DESC, id DESC",
+            "Mais antigos": "data_ts, id",
+            "Mais divergências": "divergentes DESC, id DESC",
+        },
+        "busca": False,
+    },
+}
+
+
+def consultar_pagina(tabela: str, loja_id: str, ordem: str, pagina: int = 0,
+                     busca: str = "", categoria: str = "TODOS", tipo: str = "",
+                     por_pagina: int = TABELA_POR_PAGINA) -> tuple:
+    """
+    (página como DataFrame, total de linhas do filtro). `ordem` é uma das chaves
+    de TABELAS_PAGINADAS[tabela]["ordens"]; página começa em 0.
+    """
+    spec = TABELAS_PAGINADAS[tabela]
+    onde, params = spec["onde"], [loja_id]
+    if spec["busca"]:
+        termo = termo_busca(busca)
+        if termo:
+            # instr, não LIKE: sem curingas (% e _ valem literalmente) e com a mesma
+            # comparação sem acento/maiúsculas do filtro do dashboard
+            onde += " AND instr(busca, ?) > 0"
+            params.append(termo)
+        if categoria and categoria != "TODOS":
+            onde += " AND categoria = ?"
+            params.append(categoria)
+    elif tipo:
+        onde += " AND tipo = ?"
+        params.append(tipo)
+
+    conn = get_db()
+    total = conn.execute(f"SELECT COUNT(*) FROM {spec['de']} WHERE {onde}", params).fetchone()[0]
+    cur = conn.execute(
+        f"SELECT {spec['colunas']} FROM {spec['de']} WHERE {onde} "
+        f"ORDER BY {spec['ordens'][ordem]} LIMIT ? OFFSET ?",
+        (*params, por_pagina, max(int(pagina), 0) * por_pagina),
+    )
+    colunas = [d[0] for d in cur.description]
+    return pd.DataFrame(cur.fetchall(), columns=colunas), total
+
+
+@st.fragment
+@perfil_rerun("render_tabela_paginada")
+def render_tabela_paginada(tabela: str, loja_id: str, busca: str = "", categoria: str = "TODOS"):
+    """Ordem + ◀ ▶ de uma tabela paginada (trocar de página reexecuta só a tabela)."""
+    spec = TABELAS_PAGINADAS[tabela]
+    col_ordem, col_tipo = st.columns([2, 1])
+    with col_ordem:
+        ordem = st.selectbox(
+            "Ordenar por", list(spec["ordens"]), key=f"tabela_ordem_{tabela}", label_visibility="collapsed",
+        )
+    tipo = ""
+    if tabela == "uploads":
+        with col_tipo:
+            tipo = st.selectbox(
+                "Tipo", ["", "MESTRE", "PARCIAL", "CONTAGEM"], key=f"tabela_tipo_{tabela}",
+                format_func=lambda t: t or "Todos os tipos", label_visibility="collapsed",
+            )
+
+    # Filtro/ordem novos voltam para a primeira página
+    chave_pag = f"tabela_pagina_{tabela}"
+    filtro = (loja_id, busca, categoria, ordem, tipo)
+    if st.session_state.get(f"tabela_filtro_{tabela}") != filtro:
+        st.session_state[f"tabela_filtro_{tabela}"] = filtro
+        st.session_state[chave_pag] = 0
+    pagina = st.session_state.get(chave_pag, 0)
+
+    df, total = consultar_pagina(tabela, loja_id, ordem, pagina, busca, categoria, tipo)
+    n_paginas = max((total + TABELA_POR_PAGINA - 1) // TABELA_POR_PAGINA, 1)
+    if pagina >= n_paginas:  # a tabela encolheu (ex.: itens corrigidos)
+        st.session_state[chave_pag] = pagina = n_paginas - 1
+        df, total = consultar_pagina(tabela, loja_id, ordem, pagina, busca, categoria, tipo)
+
+    if df.empty:
+        st.info("Nada encontrado.")
+        return
+    st.dataframe(df, hide_index=True, use_container_width=True)
+
+    def _ir(delta: int):
+        st.session_state[chave_pag] = pagina + delta
+
+    col_ant, col_info, col_prox = st.columns([1, 2, 1])
+    with col_ant:
+        st.button("◀", key=f"tabela_ant_{tabela}", disabled=pagina == 0,
+                  on_click=_ir, args=(-1,), use_container_width=True)
+    with col_info:
+        st.caption(f"Página {pagina + 1} de {n_paginas} · {total} registro(s)")
+    with col_prox:
+        st.button("▶", key=f"tabela_prox_{tabela}", disabled=pagina >= n_paginas - 1,
+                  on_click=_ir, args=(1,), use_container_width=True)
 
 
 # ══════════════════════════════════════════════════════════════════════════════
 # CORREÇÃO 2: Treemap — cards de danificado mostram qtd do sistema
 # ══════════════════════════════════════════════════════════════════════════════
 
-def build_css_treemap(df: pd.DataFrame, filter_cat: str = "TODOS") -> str:
+@perfilado("render")
+def build_css_treemap(df: pd.DataFrame, filter_cat: str = "TODOS", ordem_categorias: list = None) -> str:
     if df.empty:
         return '<div style="color:#64748b; text-align:center; padding:40px;">Nenhum produto para exibir</div>'
 
@@ -789,9 +3122,6 @@ def build_css_treemap(df: pd.DataFrame, filter_cat: str = "TODOS") -> str:
     if df.empty:
         return '<div style="color:#64748b; text-align:center; padding:40px;">Nenhum produto nesta categoria</div>'
 
-    df = df.copy()
-    df["qtd_sistema"] = pd.to_numeric(df["qtd_sistema"], errors="coerce").fillna(0)
-
     categories = {}
     for _, row in df.iterrows():
         cat = row["categoria"]
@@ -799,11 +3129,16 @@ def build_css_treemap(df: pd.DataFrame, filter_cat: str = "TODOS") -> str:
             categories[cat] = []
         categories[cat].append(row)
 
-    sorted_cats = sorted(
-        categories.keys(),
-        key=lambda c: sum(int(r["qtd_sistema"]) for r in categories[c]),
-        reverse=True,
-    )
+    if ordem_categorias is not None:
+        # Ordem já calculada (resumo_categoria); categorias fora dela vão pro fim
+        sorted_cats = [c for c in ordem_categorias if c in categories]
+        sorted_cats += sorted(c for c in categories if c not in set(sorted_cats))
+    else:
+        sorted_cats = sorted(
+            categories.keys(),
+            key=lambda c: sum(int(r["qtd_sistema"]) for r in categories[c]),
+            reverse=True,
+        )
     blocks_html = ""
 
     for cat in sorted_cats:
@@ -837,9 +3172,8 @@ def build_css_treemap(df: pd.DataFrame, filter_cat: str = "TODOS") -> str:
                 bg, txt = "#ffa502", "#fff"
                 info = f"{qf} (S {diff})"
 
-            contagem = str(r.get("ultima_contagem", ""))
             border_extra = ""
-            if not contagem or contagem in ["", "nan", "None"]:
+            if pd.isna(r.get("ultima_contagem")):
                 border_extra = "border: 2px dashed #64748b !important; opacity: 0.6;"
 
             tooltip = f"{r['produto']} | Cod: {cod} | Sist: {qs} | Fis: {qf}"
@@ -876,29 +3210,256 @@ def build_css_treemap(df: pd.DataFrame, filter_cat: str = "TODOS") -> str:
     return f'<div style="display: flex; flex-direction: column; min-height: 450px;">{blocks_html}</div>'
 
 
-# ── MAIN APP ─────────────────────────────────────────────────────────────────
+# ── Publicação estática (visualizadores) ─────────────────────────────────────
+# A maioria dos celulares só olha o mapa. Depois de cada upload, contagem ou
+# reposição, o mapa, os cartões e um JSON compacto do estoque são gerados uma
+# vez (em segundo plano) e gravados em PUBLICACAO_DIR/<loja>/ como arquivos
+# gzip com nome = hash do conteúdo (imutáveis: um nginx com gzip_static ou uma
+# CDN serve direto, com ETag). manifesto.json aponta para a versão atual.
+# No app, ?modo=mapa mostra a publicação sem tocar no banco: cada leitura é um
+# stat do manifesto; o conteúdo só é relido quando o ETag muda.
 
-st.markdown('<div class="main-title">CAMDA ESTOQUE</div>', unsafe_allow_html=True)
-st.markdown('<div class="sub-title">ESTOQUE MESTRE · QUIRINÓPOLIS</div>', unsafe_allow_html=True)
+PUBLICACAO_ATIVA = (_get_secret("CAMDA_PUBLICACAO") or "1") != "0"
+PUBLICACAO_DIR = _get_secret("CAMDA_PUBLICACAO_DIR") or os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), "camda_publicado"
+)
+PUBLICACAO_MANTER = int(_get_secret("CAMDA_PUBLICACAO_MANTER") or 5)
+VISUALIZADOR_ATUALIZA_S = 30
+PUBLICACAO_COLS = ["codigo", "produto", "categoria", "qtd_sistema", "qtd_fisica", "diferenca", "nota", "status"]
 
-# Indicador de conexão
-if _using_cloud:
-    st.markdown(
-        '<div class="sync-badge">☁️ CONECTADO AO TURSO · BANCO COMPARTILHADO</div>',
-        unsafe_allow_html=True,
-    )
-else:
-    st.markdown(
-        '<div class="sync-badge">⚠️ MODO LOCAL · Configure TURSO_DATABASE_URL e TURSO_AUTH_TOKEN para compartilhar</div>',
-        unsafe_allow_html=True,
+
+def _stat_cards_html(n_total: int, n_ok: int, n_falta: int, n_sobra: int, n_danificado: int, n_repor: int) -> str:
+    return f"""
+    <div class="stat-row">
+        <div class="stat-card">
+            <div class="stat-value">{n_total}</div>
+            <div class="stat-label">Total</div>
+        </div>
+        <div class="stat-card">
+            <div class="stat-value">{n_ok}</div>
+            <div class="stat-label">OK</div>
+        </div>
+        <div class="stat-card">
+            <div class="stat-value red">{n_falta}</div>
+            <div class="stat-label">Faltas</div>
+        </div>
+        <div class="stat-card">
+            <div class="stat-value amber">{n_sobra}</div>
+            <div class="stat-label">Sobras</div>
+        </div>
+        <div class="stat-card">
+            <div class="stat-value purple">{n_danificado}</div>
+            <div class="stat-label">Danificados</div>
+        </div>
+        <div class="stat-card">
+            <div class="stat-value blue">{n_repor}</div>
+            <div class="stat-label">Repor Loja</div>
+        </div>
+    </div>
+    """
+
+
+def _dir_publicacao(loja_id: str) -> str:
+    return os.path.join(PUBLICACAO_DIR, re.sub(r"[^A-Z0-9_]", "_", loja_id.upper()))
+
+
+def _gravar_atomico(caminho: str, dados: bytes):
+    tmp = f"{caminho}.tmp{threading.get_ident()}"
+    with open(tmp, "wb") as f:
+        f.write(dados)
+    os.replace(tmp, caminho)
+
+
+def _estoque_json(conn, loja_id: str) -> dict:
+    """
+    Estoque em colunas ({coluna: [valores]}), com a contagem no epoch gravado
+    (int, ou None sem contagem) — o formato dos snapshots. Lido do banco, não
+    do frame: a hora local do frame não volta ao epoch sem ambiguidade.
+    """
+    cur = conn.execute("""
+        SELECT codigo, produto, categoria, COALESCE(qtd_sistema, 0), COALESCE(qtd_fisica, 0),
+               COALESCE(diferenca, 0), nota, status, ultima_contagem_ts
+        FROM estoque_mestre WHERE loja_id = ? ORDER BY categoria, produto, codigo
+    """, (loja_id,))
+    dados = {c: [] for c in PUBLICACAO_COLS + ["ultima_contagem_ts"]}
+    while True:
+        rows = cur.fetchmany(5000)
+        if not rows:
+            break
+        for col, valores in zip(dados.values(), zip(*rows)):
+            col.extend(valores)
+    return dados
+
+
+def publicar_mapa(loja_id: str, mgr: _ConnectionManager = None, store: _StockStore = None) -> dict:
+    """
+    Gera e grava a publicação da filial. Conteúdo igual ao publicado (mesmo
+    ETag) não regrava nada. Retorna o manifesto.
+    Na thread do publicador não há sessão: gerenciador e frame vêm por parâmetro
+    e tudo é lido da conexão de leitura dessa thread, sem st.*.
+    """
+    mgr = _get_manager() if mgr is None else mgr
+    store = _get_stock_store(loja_id) if store is None else store
+    conn = mgr.reader()
+    df = store.get(conn)
+    df_resumo = get_resumo_categoria(loja_id, conn)
+    n_repor = len(get_reposicao_pendente(loja_id, conn))
+    versao, base = get_estoque_versao(loja_id, conn)
+    lojas = dict(get_lojas(conn))
+
+    cards = _stat_cards_html(
+        int(df_resumo["total_itens"].sum()), int(df_resumo["n_ok"].sum()), int(df_resumo["n_falta"].sum()),
+        int(df_resumo["n_sobra"].sum()), int(df_resumo["n_danificado"].sum()), n_repor,
     )
+    html_mapa = (cards + build_css_treemap(df, "TODOS", df_resumo["categoria"].tolist())).encode("utf-8")
+    json_estoque = json.dumps({
+        "loja_id": loja_id, "versao": versao, "base": base, "repor": n_repor, "itens": len(df),
+        "estoque": _estoque_json(conn, loja_id),
+    }, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+
+    etag = hashlib.sha256(html_mapa + b"\0" + json_estoque).hexdigest()[:16]
+    pasta = _dir_publicacao(loja_id)
+    os.makedirs(pasta, exist_ok=True)
+    caminho_manifesto = os.path.join(pasta, "manifesto.json")
+    try:
+        with open(caminho_manifesto, encoding="utf-8") as f:
+            anterior = json.load(f)
+    except (OSError, ValueError):
+        anterior = {}
+
+    now, now_ts = agora()
+    manifesto = {
+        "loja_id": loja_id, "loja_nome": lojas.get(loja_id, loja_id), "etag": etag,
+        "versao": versao, "base": base, "itens": len(df),
+        "publicado_em": now, "publicado_em_ts": now_ts,
+        "mapa": f"mapa-{etag}.html.gz", "estoque": f"estoque-{etag}.json.gz",
+    }
+    if (anterior.get("etag"), anterior.get("versao"), anterior.get("base")) == (etag, versao, base):
+        return anterior
+    for nome, dados in ((manifesto["mapa"], html_mapa), (manifesto["estoque"], json_estoque)):
+        caminho = os.path.join(pasta, nome)
+        if not os.path.exists(caminho):
+            _gravar_atomico(caminho, gzip.compress(dados, 9, mtime=0))
+    _gravar_atomico(caminho_manifesto, json.dumps(manifesto, ensure_ascii=False).encode("utf-8"))
+
+    # Mantém as últimas PUBLICACAO_MANTER versões (quem ainda lê uma antiga não quebra)
+    for prefixo in ("mapa-", "estoque-"):
+        antigos = sorted(
+            (e for e in os.scandir(pasta) if e.name.startswith(prefixo) and e.name.endswith(".gz")),
+            key=lambda e: e.stat().st_mtime_ns, reverse=True,
+        )
+        for e in antigos[PUBLICACAO_MANTER:]:
+            try:
+                os.remove(e.path)
+            except OSError:
+                pass
+    return manifesto
+
+
+class _Publicador:
+    """
+    Publica numa thread própria, uma filial por vez. Pedidos que chegam enquanto
+    a filial já está na fila viram um só (a publicação lê o estado mais recente).
+    """
+
+    def __init__(self):
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="camda-publicador")
+        self._lock = threading.Lock()
+        self._na_fila = set()
+
+    def pedir(self, loja_id: str):
+        with self._lock:
+            if loja_id in self._na_fila:
+                return
+            self._na_fila.add(loja_id)
+        # Os objetos compartilhados saem daqui (thread do script); a thread de
+        # publicação não chama nada do Streamlit
+        self._executor.submit(self._publicar, loja_id, _get_manager(), _get_stock_store(loja_id))
+
+    def _publicar(self, loja_id: str, mgr: _ConnectionManager, store: _StockStore):
+        with self._lock:
+            self._na_fila.discard(loja_id)
+        try:
+            publicar_mapa(loja_id, mgr, store)
+        except Exception:
+            pass  # Visualizadores ficam com a versão anterior; a próxima escrita tenta de novo
+
+
+@st.cache_resource
+def _get_publicador() -> _Publicador:
+    return _Publicador()
+
+
+def pedir_publicacao(loja_id: str):
+    """Agenda a publicação da filial (chamar depois de escritas que mudam mapa ou cartões)."""
+    if PUBLICACAO_ATIVA:
+        _get_publicador().pedir(loja_id)
+
+
+class _LeitorPublicacao:
+    """
+    Última publicação lida de cada filial, compartilhada pelas sessões. Cada
+    leitura é um stat do manifesto; manifesto novo com o mesmo ETag não relê o
+    mapa, e o mapa descomprimido fica em memória uma vez por processo.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._cache = {}  # loja_id → (mtime_ns do manifesto, manifesto, html)
+
+    def get(self, loja_id: str):
+        """(manifesto, html do mapa) ou None se a filial nunca foi publicada."""
+        pasta = _dir_publicacao(loja_id)
+        caminho = os.path.join(pasta, "manifesto.json")
+        try:
+            mtime = os.stat(caminho).st_mtime_ns
+        except OSError:
+            return None
+        with self._lock:
+            atual = self._cache.get(loja_id)
+        if atual and atual[0] == mtime:
+            return atual[1], atual[2]
+        try:
+            with open(caminho, encoding="utf-8") as f:
+                manifesto = json.load(f)
+            if atual and atual[1]["etag"] == manifesto["etag"]:
+                html_mapa = atual[2]
+            else:
+                with open(os.path.join(pasta, manifesto["mapa"]), "rb") as f:
+                    html_mapa = gzip.decompress(f.read()).decode("utf-8")
+        except (OSError, ValueError, KeyError):
+            return (atual[1], atual[2]) if atual else None  # publicação no meio da troca
+        with self._lock:
+            self._cache[loja_id] = (mtime, manifesto, html_mapa)
+        return manifesto, html_mapa
+
+
+@st.cache_resource
+def _get_leitor_publicacao() -> _LeitorPublicacao:
+    return _LeitorPublicacao()
 
-stock_count = get_stock_count()
-has_mestre = stock_count > 0
 
-# ── Upload Section ───────────────────────────────────────────────────────────
-with st.expander("📤 Upload de Planilha", expanded=not has_mestre):
+def publicacao_desatualizada(loja_id: str) -> bool:
+    """True se não há publicação ou se ela é de outra versão do estoque (ex.: escrita em outra instância)."""
+    if not PUBLICACAO_ATIVA:
+        return False
+    pub = _get_leitor_publicacao().get(loja_id)
+    if pub is None:
+        return True
+    versao, base = get_estoque_versao(loja_id)
+    return (pub[0].get("versao"), pub[0].get("base")) != (versao, base)
 
+
+# ── MAIN APP ─────────────────────────────────────────────────────────────────
+# O script inteiro só roda de novo ao trocar de filial, enviar planilha ou em
+# ações que mudam o estoque. Cada região abaixo é um st.fragment: busca, filtro,
+# abas, contagem, reposição e exportações reexecutam só o próprio trecho, lendo
+# o que precisam (frame compartilhado, resumo, reposição) a cada execução.
+
+@st.fragment
+@perfil_rerun("render_upload")
+def render_upload(loja_id: str, has_mestre: bool):
+    """Upload de planilhas e área de administração."""
     if not has_mestre:
         st.info("👋 Nenhum estoque cadastrado. Faça o upload da planilha mestre para começar.")
 
@@ -948,9 +3509,9 @@ with st.expander("📤 Upload de Planilha", expanded=not has_mestre):
         if st.button("🚀 Processar", type="primary"):
             with st.spinner("Processando e sincronizando..."):
                 if is_mestre_upload:
-                    ok, msg = upload_mestre(uploaded)
+                    ok, msg = upload_mestre(uploaded, loja_id)
                 else:
-                    ok, msg = upload_parcial(uploaded)
+                    ok, msg = upload_parcial(uploaded, loja_id)
 
             if ok:
                 st.success(msg)
@@ -963,8 +3524,30 @@ with st.expander("📤 Upload de Planilha", expanded=not has_mestre):
     # Área de administração
     if has_mestre:
         st.markdown("---")
+        st.caption("Exportar o estoque mestre completo (com histórico de uploads)")
+        render_export("mestre", "Estoque Completo", loja_id)
         col_adm1, col_adm2, col_adm3 = st.columns([2, 1, 1])
+        with col_adm1:
+            if st.button(f"🧹 Compactar histórico (> {RETENCAO_DIAS} dias)"):
+                res = compactar_historico()
+                st.success(
+                    f"Compactado: {res['reposicao']} itens de reposição · {res['uploads']} uploads"
+                )
+            erro_vacuum = erro_manutencao()
+            if erro_vacuum:
+                st.warning(f"VACUUM da réplica local falhou ({erro_vacuum}); será tentado de novo.")
         with col_adm2:
+            with st.popover("➕ Nova filial"):
+                with st.form("nova_loja", clear_on_submit=True):
+                    novo_id = st.text_input("Código", placeholder="ex.: RIOVERDE")
+                    novo_nome = st.text_input("Nome", placeholder="ex.: Rio Verde")
+                    if st.form_submit_button("Cadastrar"):
+                        try:
+                            st.session_state.loja_id = cadastrar_loja(novo_id, novo_nome)
+                            st.query_params["loja"] = st.session_state.loja_id
+                            st.rerun()
+                        except ValueError as e:
+                            st.error(str(e))
             if _using_cloud:
                 if st.button("🔄 Sincronizar"):
                     sync_db()
@@ -975,175 +3558,387 @@ with st.expander("📤 Upload de Planilha", expanded=not has_mestre):
                 c1, c2 = st.columns(2)
                 with c1:
                     if st.button("Sim, limpar"):
-                        reset_db()
+                        reset_db(loja_id)
                         st.session_state.confirm_reset = False
                         st.rerun()
                 with c2:
                     if st.button("Cancelar"):
                         st.session_state.confirm_reset = False
-                        st.rerun()
+                        st.rerun(scope="fragment")
             else:
                 if st.button("🗑️ Limpar BD"):
                     st.session_state.confirm_reset = True
-                    st.rerun()
+                    st.rerun(scope="fragment")
 
 
-# ── Dashboard ────────────────────────────────────────────────────────────────
-if has_mestre:
-    df_mestre = get_current_stock()
+@st.fragment
+@perfil_rerun("render_reposicao")
+def render_reposicao(loja_id: str):
+    """Checkout da lista de reposição (marcar os checkboxes não reexecuta o resto)."""
+    df_reposicao = get_reposicao_pendente(loja_id)
+    n_repor = len(df_reposicao)
+    if df_reposicao.empty:
+        st.success("Nenhum produto pendente de reposição na loja! 🎉")
+    else:
+        st.caption(
+            f"{n_repor} produto(s) para levar/repor na loja. "
+            "Itens somem após 7 dias ou quando marcados como repostos."
+        )
+        df_checkout = pd.DataFrame({
+            "repor": False,
+            "produto": df_reposicao["produto"].values,
+            "codigo": df_reposicao["codigo"].values,
+            "categoria": df_reposicao["categoria"].values,
+            "qtd_vendida": pd.to_numeric(df_reposicao["qtd_vendida"], errors="coerce").fillna(0).astype(int).values,
+            "quando": tempo_relativo(df_reposicao["dias"]).values,
+        }, index=df_reposicao["id"].astype(int).values)
+
+        edited = st.data_editor(
+            df_checkout,
+            hide_index=True,
+            use_container_width=True,
+            key="checkout_reposicao",
+            disabled=["produto", "codigo", "categoria", "qtd_vendida", "quando"],
+            column_config={
+                "repor": st.column_config.CheckboxColumn("✅", help="Marcar como reposto", default=False),
+                "produto": st.column_config.TextColumn("Produto"),
+                "codigo": st.column_config.TextColumn("Cod"),
+                "categoria": st.column_config.TextColumn("Categoria"),
+                "qtd_vendida": st.column_config.NumberColumn("Repor"),
+                "quando": st.column_config.TextColumn("Quando"),
+            },
+        )
+        selecionados = edited.index[edited["repor"].astype(bool)].tolist()
+
+        col_sel, col_cat = st.columns(2)
+        with col_sel:
+            if st.button(
+                f"✅ Marcar {len(selecionados)} selecionado(s)",
+                disabled=not selecionados,
+                type="primary",
+                use_container_width=True,
+            ):
+                marcar_repostos(selecionados, loja_id)
+                st.rerun()
+        with col_cat:
+            cats_repo = sorted(df_reposicao["categoria"].unique().tolist())
+            cat_done = st.selectbox(
+                "Categoria", cats_repo, label_visibility="collapsed", key="checkout_categoria",
+            )
+            if st.button("🏷️ Categoria inteira reposta", use_container_width=True):
+                ids_cat = df_reposicao.loc[df_reposicao["categoria"] == cat_done, "id"].tolist()
+                marcar_repostos(ids_cat, loja_id)
+                st.rerun()
 
-    search_term = st.text_input(
-        "🔍 Buscar no Mestre",
-        placeholder="Nome ou Código...",
-        label_visibility="collapsed",
-    )
+        render_export("reposicao", "Lista de Reposição", loja_id)
 
-    df_view = df_mestre.copy()
-    if search_term:
-        mask = (
-            df_view["produto"].astype(str).str.contains(search_term, case=False, na=False)
-            | df_view["codigo"].astype(str).str.contains(search_term, case=False, na=False)
-        )
-        df_view = df_view[mask]
 
-    n_ok = len(df_view[df_view["status"] == "ok"])
-    n_falta = len(df_view[df_view["status"] == "falta"])
-    n_sobra = len(df_view[df_view["status"] == "sobra"])
-    n_danificado = len(df_view[df_view["status"] == "danificado"])
+@st.fragment
+@perfil_rerun("render_dashboard")
+def render_dashboard(loja_id: str, lojas: dict):
+    """Busca, cartões, filtro de categoria e abas do estoque."""
+    df_mestre = get_current_stock(loja_id)
 
-    n_sem_contagem = len(
-        df_view[
-            (df_view["ultima_contagem"].isna())
-            | (df_view["ultima_contagem"].astype(str).isin(["", "nan", "None"]))
-        ]
-    )
+    col_busca, col_cat = st.columns([3, 2])
+    with col_busca:
+        search_term = st.text_input(
+            "🔍 Buscar no Mestre",
+            placeholder="Nome ou Código...",
+            label_visibility="collapsed",
+        )
 
-    df_reposicao = get_reposicao_pendente()
+    df_view = df_mestre
+    termo = termo_busca(search_term)
+    if termo:
+        df_mestre, chaves = _get_stock_store(loja_id).com_chaves_busca()
+        df_view = df_mestre[chaves.str.contains(termo, regex=False)]
+
+    df_resumo = get_resumo_categoria(loja_id)
+    if termo:
+        status_counts = df_view["status"].value_counts()
+        n_total = len(df_view)
+        n_ok = int(status_counts.get("ok", 0))
+        n_falta = int(status_counts.get("falta", 0))
+        n_sobra = int(status_counts.get("sobra", 0))
+        n_danificado = int(status_counts.get("danificado", 0))
+        n_sem_contagem = int(df_view["ultima_contagem"].isna().sum())
+        cats_view = sorted(df_view["categoria"].unique().tolist())
+    else:
+        # Sem busca: cabeçalho e filtro saem do resumo (poucas linhas)
+        n_total = int(df_resumo["total_itens"].sum())
+        n_ok = int(df_resumo["n_ok"].sum())
+        n_falta = int(df_resumo["n_falta"].sum())
+        n_sobra = int(df_resumo["n_sobra"].sum())
+        n_danificado = int(df_resumo["n_danificado"].sum())
+        n_sem_contagem = int(df_resumo["n_sem_contagem"].sum())
+        cats_view = sorted(df_resumo["categoria"].tolist())
+
+    df_reposicao = get_reposicao_pendente(loja_id)
     n_repor = len(df_reposicao)
 
-    st.markdown(f"""
-    <div class="stat-row">
-        <div class="stat-card">
-            <div class="stat-value">{len(df_view)}</div>
-            <div class="stat-label">Total</div>
-        </div>
-        <div class="stat-card">
-            <div class="stat-value">{n_ok}</div>
-            <div class="stat-label">OK</div>
-        </div>
-        <div class="stat-card">
-            <div class="stat-value red">{n_falta}</div>
-            <div class="stat-label">Faltas</div>
-        </div>
-        <div class="stat-card">
-            <div class="stat-value amber">{n_sobra}</div>
-            <div class="stat-label">Sobras</div>
-        </div>
-        <div class="stat-card">
-            <div class="stat-value purple">{n_danificado}</div>
-            <div class="stat-label">Danificados</div>
-        </div>
-        <div class="stat-card">
-            <div class="stat-value blue">{n_repor}</div>
-            <div class="stat-label">Repor Loja</div>
-        </div>
-    </div>
-    """, unsafe_allow_html=True)
+    st.markdown(
+        _stat_cards_html(n_total, n_ok, n_falta, n_sobra, n_danificado, n_repor),
+        unsafe_allow_html=True,
+    )
 
-    cats = ["TODOS"] + sorted(df_view["categoria"].unique().tolist())
-    with st.sidebar:
-        st.markdown("### 🏷️ Filtro por Categoria")
-        f_cat = st.radio("Categoria", cats, label_visibility="collapsed")
+    # O filtro fica junto da busca (widgets de fragmento não podem ir para a sidebar)
+    cats = ["TODOS"] + cats_view
+    with col_cat:
+        f_cat = st.selectbox("🏷️ Categoria", cats, label_visibility="collapsed", key=f"filtro_cat_{loja_id}")
 
-    t1, t2, t3, t4, t5 = st.tabs([
+    t1, t_contagem, t2, t3, t4, t5, t6 = st.tabs([
         "🗺️ Mapa Estoque",
+        "✍️ Contagem",
         "⚠️ Divergências",
         "💔 Danificados",
         "🏪 Repor na Loja",
+        "📈 Tendência",
         "📝 Log de Uploads",
     ])
 
     with t1:
-        st.markdown(build_css_treemap(df_view, f_cat), unsafe_allow_html=True)
+        st.markdown(
+            build_css_treemap(df_view, f_cat, df_resumo["categoria"].tolist()),
+            unsafe_allow_html=True,
+        )
+
+    with t_contagem:
+        st.caption("Busque pelo código ou nome e digite a quantidade contada.")
+        render_contagem(loja_id)
 
     with t2:
-        df_div = df_view[(df_view["status"] == "falta") | (df_view["status"] == "sobra")]
-        if df_div.empty:
+        if n_falta + n_sobra == 0:
             st.info("Nenhuma divergência encontrada.")
         else:
-            st.dataframe(
-                df_div[["codigo", "produto", "categoria", "qtd_sistema", "qtd_fisica", "diferenca", "nota", "ultima_contagem"]],
-                hide_index=True, use_container_width=True,
-            )
+            render_tabela_paginada("divergencias", loja_id, search_term, f_cat)
+            render_export("divergencias", "Divergências", loja_id, search_term)
 
     with t3:
-        df_dan = df_view[df_view["status"] == "danificado"]
-        if df_dan.empty:
+        if n_danificado == 0:
             st.info("Nenhum produto danificado.")
         else:
-            st.dataframe(
-                df_dan[["codigo", "produto", "qtd_sistema", "nota", "ultima_contagem"]],
-                hide_index=True, use_container_width=True,
-            )
+            render_tabela_paginada("danificados", loja_id, search_term, f_cat)
+            render_export("danificados", "Danificados", loja_id, search_term)
 
     with t4:
-        if df_reposicao.empty:
-            st.success("Nenhum produto pendente de reposição na loja! 🎉")
-        else:
-            st.caption(
-                f"{n_repor} produto(s) para levar/repor na loja. "
-                "Itens somem após 7 dias ou quando marcados como repostos."
-            )
-            for _, item in df_reposicao.iterrows():
-                dias_atras = (datetime.now() - datetime.strptime(item["criado_em"], "%Y-%m-%d %H:%M:%S")).days
-                if dias_atras == 0:
-                    tempo = "hoje"
-                elif dias_atras == 1:
-                    tempo = "ontem"
-                else:
-                    tempo = f"{dias_atras}d atrás"
-
-                qtd_v = int(item["qtd_vendida"]) if pd.notnull(item["qtd_vendida"]) else 0
-
-                col_info, col_btn = st.columns([5, 1])
-                with col_info:
-                    st.markdown(
-                        f'<div style="background:#111827; border:1px solid #1e293b; border-radius:8px; '
-                        f'padding:10px 14px; margin-bottom:4px;">'
-                        f'<div style="display:flex; justify-content:space-between; align-items:center;">'
-                        f'<span style="color:#e0e6ed; font-weight:700; font-size:0.85rem;">{item["produto"]}</span>'
-                        f'<span style="color:#3b82f6; font-size:0.6rem; font-family:monospace;">{tempo}</span>'
-                        f'</div>'
-                        f'<div style="margin-top:4px; display:flex; gap:12px;">'
-                        f'<span style="color:#64748b; font-size:0.65rem;">Cod: <b style="color:#94a3b8;">{item["codigo"]}</b></span>'
-                        f'<span style="color:#64748b; font-size:0.65rem;">{item["categoria"]}</span>'
-                        f'<span style="color:#ffa502; font-size:0.65rem; font-weight:700;">Repor: {qtd_v}</span>'
-                        f'</div>'
-                        f'</div>',
-                        unsafe_allow_html=True,
-                    )
-                with col_btn:
-                    if st.button("✅", key=f"repor_{item['id']}", help="Marcar como reposto"):
-                        marcar_reposto(int(item["id"]))
-                        st.rerun()
+        render_reposicao(loja_id)
 
     with t5:
-        conn = get_db()
-        rows_hist = conn.execute(
-            "SELECT data, tipo, arquivo, total_produtos_lote, novos, atualizados, divergentes "
-            "FROM historico_uploads ORDER BY id DESC LIMIT 20"
-        ).fetchall()
-        cols_hist = ["data", "tipo", "arquivo", "total_produtos_lote", "novos", "atualizados", "divergentes"]
-        df_hist = pd.DataFrame(rows_hist, columns=cols_hist)
-        if df_hist.empty:
-            st.info("Nenhum upload registrado.")
+        df_tend = get_tendencia_divergencias(loja_id, categoria=f_cat)
+        if len(df_tend) < 2:
+            st.info("A tendência aparece depois de uploads em dias diferentes.")
         else:
-            st.dataframe(df_hist, hide_index=True, use_container_width=True)
+            st.caption("Itens por status ao fim de cada dia (últimos 180 dias)")
+            st.line_chart(df_tend[["falta", "sobra", "danificado"]])
+        if search_term and len(df_view) == 1:
+            codigo_item = df_view["codigo"].iloc[0]
+            st.caption(f"Movimentos de {codigo_item}")
+            st.dataframe(get_movimentos_item(loja_id, codigo_item), hide_index=True, use_container_width=True)
+
+    with t6:
+        render_tabela_paginada("uploads", loja_id)
+
+        df_snaps = get_snapshots(loja_id)
+        if not df_snaps.empty:
+            with st.expander("🕰️ Estoque como estava antes de um upload"):
+                render_snapshot_antes(loja_id, df_snaps)
+
+    if len(lojas) > 1:
+        with st.expander("🏬 Comparativo entre filiais"):
+            st.dataframe(get_resumo_lojas(), hide_index=True, use_container_width=True)
+
 
-else:
+@st.fragment
+@perfil_rerun("render_snapshot_antes")
+def render_snapshot_antes(loja_id: str, df_snaps: pd.DataFrame):
+    """
+    Escolha de um snapshot e o estoque de antes daquele upload. Só descomprime
+    no botão Ver (o frame fica na sessão até fechar ou trocar); os reruns do
+    dashboard não tocam no snapshot, e o CSV só é montado no toque em Baixar.
+    """
+    chave = f"snapshot_visto_{loja_id}"
+    col_sel, col_ver = st.columns([3, 1])
+    with col_sel:
+        snap_ts = st.selectbox(
+            "Snapshot", df_snaps["ts"].tolist(), label_visibility="collapsed", key=f"snapshot_ts_{loja_id}",
+            format_func=lambda ts: (
+                f"Antes de {datetime.fromtimestamp(ts).strftime('%d/%m/%Y %H:%M')} · "
+                f"{df_snaps.loc[df_snaps['ts'] == ts, 'motivo'].iloc[0]}"
+            ),
+        )
+    with col_ver:
+        if st.button("🔍 Ver", use_container_width=True, key=f"snapshot_ver_{loja_id}"):
+            st.session_state[chave] = (int(snap_ts), estoque_do_snapshot(loja_id, int(snap_ts)))
+
+    visto = st.session_state.get(chave)
+    if not visto or visto[0] != int(snap_ts):
+        st.caption("Escolha o snapshot e toque em Ver.")
+        return
+    df_antes = visto[1]
+    st.caption(f"{len(df_antes)} produto(s)")
+    st.dataframe(df_antes, hide_index=True, use_container_width=True, height=300)
+    col_dl, col_fechar = st.columns([3, 1])
+    with col_dl:
+        st.download_button(
+            "⬇️ Baixar (CSV)", _csv_snapshot(df_antes),
+            file_name=f"camda_{loja_id}_estoque_{snap_ts}.csv", mime="text/csv",
+            key=f"snapshot_dl_{loja_id}",
+        )
+    with col_fechar:
+        st.button(
+            "✖️ Fechar", use_container_width=True, key=f"snapshot_fechar_{loja_id}",
+            on_click=st.session_state.pop, args=(chave, None),
+        )
+
+
+def _csv_snapshot(df: pd.DataFrame):
+    """CSV do snapshot só no toque em Baixar (mesmo esquema de _ler_export)."""
+    def gerar():
+        return df.to_csv(index=False, sep=";").encode("utf-8-sig")
+    return gerar
+
+
+@st.fragment
+def render_perfil():
+    """Painel de depuração (sidebar, só com o perfil ligado): últimos reruns desta sessão."""
+    historico = list(st.session_state.get("perfil_reruns", []))[::-1]  # cópia: o rerun atual ainda vai gravar
+    col_t, col_b = st.columns([3, 1])
+    col_t.markdown("### 🩺 Perfil")
+    if col_b.button("🔄", help="Atualizar (inclui reruns de fragmentos)"):
+        st.rerun(scope="fragment")
+    if not historico:
+        st.caption("Nenhum rerun medido ainda.")
+        return
+    idx = st.selectbox(
+        "Rerun", range(len(historico)), label_visibility="collapsed",
+        format_func=lambda i: (
+            f"{historico[i]['quando'][11:]} · {historico[i]['origem']} · {historico[i]['total_ms']:.0f} ms"
+            + (" · interrompido" if historico[i]["interrompido"] else "")
+        ),
+    )
+    rerun = historico[idx]
+    df_spans = pd.DataFrame(rerun["spans"], columns=["tipo", "nome", "inicio_ms", "ms"])
+    if not df_spans.empty:
+        st.caption("Tempo por tipo (ms, spans aninhados somam em mais de um)")
+        st.dataframe(df_spans.groupby("tipo")["ms"].agg(["count", "sum"]).round(1), use_container_width=True)
+        st.dataframe(df_spans, hide_index=True, use_container_width=True, height=220)
+    df_sql = pd.DataFrame(rerun["consultas"], columns=["sql", "n", "ms", "max_ms"])
+    st.caption(f"{int(df_sql['n'].sum())} consulta(s) de leitura · {df_sql['ms'].sum():.1f} ms")
+    st.dataframe(df_sql, hide_index=True, use_container_width=True, height=220)
+    if PERFIL_LOG_PATH:
+        st.caption(f"Gravando em {PERFIL_LOG_PATH}")
+
+
+@st.fragment(run_every=VISUALIZADOR_ATUALIZA_S)
+@perfil_rerun("render_visualizador")
+def render_visualizador(loja_id: str):
+    """Modo somente leitura (?modo=mapa): mostra a última publicação, sem banco nem sync."""
+    publicacao = _get_leitor_publicacao().get(loja_id)
+    if publicacao is None:
+        # Publicação apagada (reset, limpeza, novo deploy): volta para o app normal,
+        # que lê do banco e pede uma publicação nova
+        st.info("Mapa publicado indisponível — abrindo o app completo.")
+        st.rerun()
+    manifesto, html_mapa = publicacao
     st.markdown(
-        '<div style="text-align:center; color:#64748b; padding:60px 20px; font-size:1rem;">'
-        "Faça o upload da planilha mestre acima para começar ☝️"
-        "</div>",
+        f'<div class="sub-title">ESTOQUE MESTRE · {html.escape(manifesto["loja_nome"].upper())}</div>',
         unsafe_allow_html=True,
     )
+    publicado = datetime.fromtimestamp(manifesto["publicado_em_ts"]).strftime("%d/%m %H:%M")
+    st.markdown(
+        f'<div class="update-badge">🗺️ SOMENTE LEITURA · ATUALIZADO EM {publicado}</div>',
+        unsafe_allow_html=True,
+    )
+    st.markdown(html_mapa, unsafe_allow_html=True)
+
+
+@perfil_rerun("main")
+def main():
+    # Visualizador: com publicação disponível, nem abre o banco
+    if st.query_params.get("modo") == "mapa":
+        loja_pub = str(st.query_params.get("loja", LOJA_PADRAO)).upper()
+        if _get_leitor_publicacao().get(loja_pub) is not None:
+            st.markdown('<div class="main-title">CAMDA ESTOQUE</div>', unsafe_allow_html=True)
+            render_visualizador(loja_pub)
+            return
+
+    # Filial ativa: ?loja=... na URL > escolha da sessão > filial padrão
+    lojas = dict(get_lojas())
+    loja_id = str(st.query_params.get("loja", st.session_state.get("loja_id", LOJA_PADRAO))).upper()
+    if loja_id not in lojas:
+        loja_id = LOJA_PADRAO
+    if len(lojas) > 1:
+        with st.sidebar:
+            st.markdown("### 🏬 Filial")
+            ids_lojas = list(lojas)
+            loja_id = st.selectbox(
+                "Filial", ids_lojas, index=ids_lojas.index(loja_id),
+                format_func=lambda i: lojas[i], label_visibility="collapsed",
+            )
+    st.session_state.loja_id = loja_id
+    st.query_params["loja"] = loja_id
+    loja_nome = lojas.get(loja_id, LOJA_PADRAO_NOME)
+
+    st.markdown('<div class="main-title">CAMDA ESTOQUE</div>', unsafe_allow_html=True)
+    st.markdown(f'<div class="sub-title">ESTOQUE MESTRE · {html.escape(loja_nome.upper())}</div>', unsafe_allow_html=True)
+
+    # Indicador de conexão
+    _status_sync = _get_manager().status()
+    if _using_cloud:
+        if _status_sync["pendentes"]:
+            st.markdown(
+                f'<div class="sync-badge" title="{html.escape(_status_sync["erro"])}">'
+                f'⏳ SEM CONEXÃO COM O TURSO · {_status_sync["pendentes"]} OPERAÇÃO(ÕES) PENDENTE(S) · '
+                f'nova tentativa em {int(_status_sync["retry_em_s"])}s</div>',
+                unsafe_allow_html=True,
+            )
+        else:
+            st.markdown(
+                '<div class="sync-badge">☁️ CONECTADO AO TURSO · BANCO COMPARTILHADO</div>',
+                unsafe_allow_html=True,
+            )
+    else:
+        st.markdown(
+            '<div class="sync-badge">⚠️ MODO LOCAL · Configure TURSO_DATABASE_URL e TURSO_AUTH_TOKEN para compartilhar</div>',
+            unsafe_allow_html=True,
+        )
+    # Escritas recusadas pelo banco (erro de SQL): saíram da fila, mas não foram gravadas
+    if _status_sync["descartadas"]:
+        st.markdown(
+            f'<div class="sync-badge" title="{html.escape(_status_sync["erro_descartada"])}">'
+            f'❌ {_status_sync["descartadas"]} OPERAÇÃO(ÕES) RECUSADA(S) PELO BANCO · '
+            f'guardadas em descartadas no diário local</div>',
+            unsafe_allow_html=True,
+        )
+
+    try:
+        with perfil_span("db", "manutencao_diaria"):
+            manutencao_diaria()
+    except Exception:
+        pass  # Manutenção nunca deve impedir o app de abrir
+
+    stock_count = get_stock_count(loja_id)
+    has_mestre = stock_count > 0
+    if has_mestre and publicacao_desatualizada(loja_id):
+        pedir_publicacao(loja_id)  # escrita feita em outra instância, ou primeira publicação
+
+    with st.expander("📤 Upload de Planilha", expanded=not has_mestre):
+        render_upload(loja_id, has_mestre)
+
+    if has_mestre:
+        render_dashboard(loja_id, lojas)
+    else:
+        st.markdown(
+            '<div style="text-align:center; color:#64748b; padding:60px 20px; font-size:1rem;">'
+            "Faça o upload da planilha mestre acima para começar ☝️"
+            "</div>",
+            unsafe_allow_html=True,
+        )
+
+    if _perfil_ligado():
+        with st.sidebar:
+            render_perfil()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,283 @@
+"""
+Benchmarks do CAMDA Estoque.
+
+Gera planilhas sintéticas no formato do BI (estoque e vendas), mede as etapas
+do pipeline contra um SQLite local descartável e guarda o resultado em JSON
+lines, comparando com a rodada anterior de mesma semente.
+
+    python bench.py                          # 1k, 10k e 50k linhas
+    python bench.py --linhas 1000,200000 --repeticoes 5
+    python bench.py --etapas parse_estoque,upload_mestre
+
+Tempos: mediana de N repetições sem tracemalloc. Pico de memória: uma
+execução extra de cada etapa com tracemalloc ligado (alocações Python e numpy).
+"""
+
+import argparse
+import gc
+import io
+import json
+import logging
+import os
+import platform
+import random
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+from datetime import datetime
+
+LOJA_BENCH = "BENCH"
+
+GRUPOS = {
+    "HERBICIDAS": ("HERBICIDA", ["ROUNDUP", "GLIFOSATO", "ZAPP", "ELITE", "DIQUAT", "FLUMYZIN", "VERDICT"]),
+    "FUNGICIDAS": ("FUNGICIDA", ["PRIORI XTRA", "FOX", "ELATUS", "SPHERE MAX", "ABACUS", "ORKESTRA"]),
+    "INSETICIDAS": ("INSETICIDA", ["ENGEO PLENO", "CONNECT", "PREMIO", "GALIL", "AMPLIGO", "CURBIX"]),
+    "ADUBOS FOLIARES": ("ADUBO FOLIAR", ["BORO", "ZINCO", "MANGANES", "COBALTO MOLIBDENIO", "CALCIO"]),
+    "OLEO MINERAL E VEGETAL": ("OLEO VEGETAL", ["AUREO", "NATUR OIL", "ASSIST", "MINERAL OIL"]),
+    "SEMENTES": ("SEMENTE", ["SOJA BRASMAX", "MILHO DKB", "SORGO", "BRACHIARIA"]),
+    "LUBRIFICANTES": ("OLEO", ["LUBRAX 15W40", "MOBIL DELVAC", "GRAXA AZUL", "HIDRAULICO 68"]),
+    "EPI": ("EPI", ["LUVA NITRILICA", "MASCARA PFF2", "BOTA PVC", "OCULOS AMPLA VISAO"]),
+    "ACESSORIOS DE FAZENDA": ("", ["ARAME FARPADO", "GRAMPO CERCA", "MANGUEIRA 1/2", "BALDE 20L"]),
+}
+TAMANHOS = ["1L", "5L", "10L", "20L", "1KG", "5KG", "25KG", "200L", "UN", "PAR"]
+
+# Notas de conferência, do jeito que aparecem nas planilhas (a maioria vazia)
+NOTAS = [
+    ("", 70), ("falta 2", 4), ("faltando 3 caixas", 3), ("falt. 1", 2), ("falta de 5 no deposito", 2),
+    ("sobra 1", 3), ("sobrando 2", 2), ("passou 4", 1), ("2 a mais", 1), ("avariado 1", 3),
+    ("embalagem rasgada", 2), ("vazando", 1), ("conferido", 3), ("12", 3),
+]
+
+
+def _nomes(n: int, rng: random.Random) -> list:
+    """n produtos (grupo, codigo, nome) com códigos únicos e nomes plausíveis."""
+    grupos = list(GRUPOS)
+    produtos = []
+    for i in range(n):
+        grupo = grupos[rng.randrange(len(grupos))]
+        prefixo, marcas = GRUPOS[grupo]
+        nome = f"{prefixo} {rng.choice(marcas)} {rng.choice(TAMANHOS)} L{i % 97:02d}".strip()
+        produtos.append((grupo, str(100000 + i), nome))
+    return produtos
+
+
+def _nota(rng: random.Random) -> str:
+    textos, pesos = zip(*NOTAS)
+    return rng.choices(textos, weights=pesos)[0]
+
+
+def _gravar_xlsx(linhas: list, caminho: str):
+    import xlsxwriter
+
+    wb = xlsxwriter.Workbook(caminho, {"constant_memory": True})
+    ws = wb.add_worksheet()
+    for i, linha in enumerate(linhas):
+        ws.write_row(i, 0, linha)
+    wb.close()
+
+
+def gerar_estoque(n: int, seed: int, caminho: str):
+    """Planilha formato estoque: título, cabeçalho, linhas de TOTAL por grupo e notas variadas."""
+    rng = random.Random(seed)
+    linhas = [["CAMDA BI - Estoque", "", "", "", ""], ["Emitido em", datetime(2024, 1, 1).isoformat(), "", "", ""],
+              ["Código", "Produto", "Local", "Quantidade", "Obs"]]
+    atual = None
+    for grupo, codigo, nome in sorted(_nomes(n, rng)):
+        if grupo != atual:
+            if atual is not None:
+                linhas.append(["", "TOTAL", "", rng.randint(100, 9000), ""])
+            atual = grupo
+        linhas.append([codigo, nome, rng.choice(["DEP 1", "DEP 2", "LOJA"]), rng.randint(1, 400), _nota(rng)])
+    linhas.append(["", "TOTAL", "", 0, ""])
+    _gravar_xlsx(linhas, caminho)
+
+
+def gerar_vendas(n: int, seed: int, caminho: str):
+    """
+    Planilha formato vendas: grupo só na primeira linha do bloco, "CODIGO - NOME",
+    linhas ROLLUP por grupo. Metade dos códigos coincide com os do estoque.
+    """
+    rng = random.Random(seed + 1)
+    base = _nomes(n, random.Random(seed))
+    escolhidos = rng.sample(base, n // 2) + [(g, str(900000 + i), nm) for i, (g, _, nm) in enumerate(_nomes(n - n // 2, rng))]
+    linhas = [["RELATÓRIO DE VENDAS", "", "", "", ""],
+              ["GRUPO DE PRODUTO", "PRODUTO", "QTDD - VENDIDA", "QTDD ESTOQUE", "OBS"]]
+    atual = None
+    for grupo, codigo, nome in sorted(escolhidos):
+        if grupo != atual:
+            if atual is not None:
+                linhas.append(["", "ROLLUP", rng.randint(10, 500), "", ""])
+            atual = grupo
+            coluna_grupo = grupo
+        else:
+            coluna_grupo = ""
+        linhas.append([coluna_grupo, f"{codigo} - {nome}", rng.randint(0, 30), rng.randint(1, 400), _nota(rng)])
+    _gravar_xlsx(linhas, caminho)
+
+
+def _arquivo(caminho: str) -> io.BytesIO:
+    """Cópia em memória com .name, como o UploadedFile do Streamlit."""
+    with open(caminho, "rb") as f:
+        buf = io.BytesIO(f.read())
+    buf.name = os.path.basename(caminho)
+    return buf
+
+
+def _medir(fn, repeticoes: int, preparar=None) -> dict:
+    """Mediana/mínimo de `repeticoes` execuções e pico de memória numa execução extra."""
+    tempos = []
+    for _ in range(repeticoes):
+        if preparar:
+            preparar()
+        gc.collect()
+        t0 = time.perf_counter()
+        fn()
+        tempos.append(time.perf_counter() - t0)
+
+    if preparar:
+        preparar()
+    gc.collect()
+    tracemalloc.start()
+    fn()
+    _, pico = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return {"mediana_s": statistics.median(tempos), "min_s": min(tempos), "pico_mb": pico / 2 ** 20}
+
+
+def _ambiente() -> dict:
+    import pandas as pd
+    import streamlit as st
+
+    raiz = os.path.dirname(os.path.abspath(__file__))
+    try:
+        commit = subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                                cwd=raiz).stdout.strip()
+        alterado = bool(subprocess.run(["git", "status", "--porcelain", "--untracked-files=no"],
+                                       capture_output=True, text=True, cwd=raiz).stdout.strip())
+    except OSError:
+        commit, alterado = "", False
+    try:
+        import libsql as _libsql
+        from importlib.metadata import version
+        libsql = getattr(_libsql, "__version__", "") or version("libsql")
+    except Exception:
+        libsql = ""
+    return {
+        "python": platform.python_version(), "pandas": pd.__version__, "streamlit": st.__version__,
+        "libsql": libsql, "plataforma": platform.platform(), "cpu": platform.processor() or platform.machine(),
+        "commit": commit, "alterado": alterado,
+    }
+
+
+def _rodada_anterior(saida: str, seed: int) -> dict:
+    """{(etapa, linhas): mediana_s} da última rodada gravada com a mesma semente."""
+    if not os.path.exists(saida):
+        return {}
+    anterior = None
+    with open(saida, encoding="utf-8") as f:
+        for linha in f:
+            rodada = json.loads(linha)
+            if rodada.get("seed") == seed:
+                anterior = rodada
+    if not anterior:
+        return {}
+    return {(r["etapa"], r["linhas"]): r["mediana_s"] for r in anterior["resultados"]}
+
+
+ETAPAS = [
+    "ler_planilha", "detect_format", "parse_estoque", "parse_vendas", "parse_annotation",
+    "upload_mestre", "upload_parcial", "build_css_treemap", "publicar_mapa",
+]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--linhas", default="1000,10000,50000", help="tamanhos separados por vírgula (até 200000)")
+    parser.add_argument("--repeticoes", type=int, default=3)
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--etapas", default=",".join(ETAPAS))
+    parser.add_argument("--saida", default="bench_resultados.jsonl")
+    args = parser.parse_args()
+
+    tamanhos = [min(int(x), 200000) for x in args.linhas.split(",") if x.strip()]
+    etapas = [e for e in args.etapas.split(",") if e in ETAPAS]
+
+    # Banco descartável e nada de Turso: o app lê os caminhos do ambiente no import
+    tmp = tempfile.mkdtemp(prefix="camda_bench_")
+    os.environ["CAMDA_DB_PATH"] = os.path.join(tmp, "bench.db")
+    os.environ["CAMDA_JOURNAL_PATH"] = os.path.join(tmp, "bench_journal.db")
+    os.environ["CAMDA_LOJA"] = LOJA_BENCH
+    # Publicação em segundo plano desligada (disputaria CPU com as medições); ela
+    # é medida à parte, síncrona, na etapa publicar_mapa
+    os.environ["CAMDA_PUBLICACAO"] = "0"
+    os.environ["CAMDA_PUBLICACAO_DIR"] = os.path.join(tmp, "publicado")
+    for chave in ("TURSO_DATABASE_URL", "TURSO_AUTH_TOKEN", "CAMDA_REMOTE_STANDIN"):
+        os.environ.pop(chave, None)
+    logging.disable(logging.WARNING)  # avisos de "bare mode" do Streamlit
+    import pandas as pd
+    import app_turso as app
+
+    resultados = []
+    print(f"{'etapa':<20}{'linhas':>9}{'mediana':>11}{'mínimo':>11}{'linhas/s':>13}{'pico MB':>10}")
+    for n in tamanhos:
+        xlsx_estoque = os.path.join(tmp, f"estoque_{n}.xlsx")
+        xlsx_vendas = os.path.join(tmp, f"vendas_{n}.xlsx")
+        gerar_estoque(n, args.seed, xlsx_estoque)
+        gerar_vendas(n, args.seed, xlsx_vendas)
+        df_estoque = pd.read_excel(xlsx_estoque, sheet_name=0, header=None)
+        df_vendas = pd.read_excel(xlsx_vendas, sheet_name=0, header=None)
+        notas = [str(v) for v in df_estoque[4].tolist()[3:]]
+
+        def _limpar():
+            app.reset_db(LOJA_BENCH)
+
+        def _limpar_publicacao():  # conteúdo já publicado não é regravado; mede a publicação inteira
+            shutil.rmtree(os.environ["CAMDA_PUBLICACAO_DIR"], ignore_errors=True)
+
+        def _com_mestre():
+            app.reset_db(LOJA_BENCH)
+            app.upload_mestre(_arquivo(xlsx_estoque), LOJA_BENCH)
+
+        casos = {
+            "ler_planilha": (lambda: pd.read_excel(xlsx_estoque, sheet_name=0, header=None), None),
+            "detect_format": (lambda: (app.detect_format(df_estoque), app.detect_format(df_vendas)), None),
+            "parse_estoque": (lambda: app.parse_estoque_format(df_estoque), None),
+            "parse_vendas": (lambda: app.parse_vendas_format(df_vendas), None),
+            "parse_annotation": (lambda: [app.parse_annotation(t, 10) for t in notas], None),
+            "upload_mestre": (lambda: app.upload_mestre(_arquivo(xlsx_estoque), LOJA_BENCH), _limpar),
+            "upload_parcial": (lambda: app.upload_parcial(_arquivo(xlsx_vendas), LOJA_BENCH), _com_mestre),
+            "build_css_treemap": (lambda: app.build_css_treemap(app.get_current_stock(LOJA_BENCH)), None),
+            "publicar_mapa": (lambda: app.publicar_mapa(LOJA_BENCH), _limpar_publicacao),
+        }
+        for etapa in etapas:
+            if etapa in ("build_css_treemap", "publicar_mapa"):
+                _com_mestre()
+            fn, preparar = casos[etapa]
+            medida = _medir(fn, args.repeticoes, preparar)
+            medida.update(etapa=etapa, linhas=n, linhas_por_s=n / medida["mediana_s"] if medida["mediana_s"] else 0)
+            resultados.append(medida)
+            print(f"{etapa:<20}{n:>9}{medida['mediana_s']:>10.3f}s{medida['min_s']:>10.3f}s"
+                  f"{medida['linhas_por_s']:>13.0f}{medida['pico_mb']:>10.1f}")
+
+    anterior = _rodada_anterior(args.saida, args.seed)
+    if anterior:
+        print("\nVariação da mediana em relação à rodada anterior (mesma semente):")
+        for r in resultados:
+            antes = anterior.get((r["etapa"], r["linhas"]))
+            if antes:
+                print(f"  {r['etapa']:<20}{r['linhas']:>9}{(r['mediana_s'] / antes - 1) * 100:>+9.1f}%")
+
+    with open(args.saida, "a", encoding="utf-8") as f:
+        f.write(json.dumps({
+            "quando": datetime.now().isoformat(timespec="seconds"), "seed": args.seed,
+            "repeticoes": args.repeticoes, "ambiente": _ambiente(), "resultados": resultados,
+        }, ensure_ascii=False) + "\n")
+    print(f"\nResultados em {args.saida}")
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,311 @@
+"""
+Teste de carga do CAMDA Estoque: N sessões simultâneas pelo AppTest.
+
+Cada sessão é um AppTest próprio (session_state, widgets e reruns de um
+celular) rodando numa thread; todas compartilham o processo — o mesmo
+_ConnectionManager, a mesma fila de escrita e o mesmo frame de estoque, como no
+servidor. O banco é um SQLite local descartável com o stand-in do Turso
+(CAMDA_REMOTE_STANDIN=1), então a rede não entra na conta.
+
+    python loadtest.py                         # 1, 2, 4 e 8 sessões
+    python loadtest.py --sessoes 1,4,16 --acoes 30 --linhas 20000
+
+Ações sorteadas por sessão: digitar na busca (um rerun por tecla), trocar
+categoria, marcar uma categoria como reposta e enviar uma planilha parcial
+(preview ao escolher o arquivo, depois o processamento). Com --visualizadores,
+cada nível ganha também sessões só de leitura (?modo=mapa) recarregando o mapa
+publicado.
+Para cada nível de concorrência: p50/p95 da latência de rerun (por ação e no
+total) e a disputa pelo banco, lida do perfil por rerun (CAMDA_PERFIL): tempo
+em consultas de leitura e em escritas (espera na fila + aplicação), e quantos
+reruns falharam com banco bloqueado.
+"""
+
+import argparse
+import glob
+import json
+import logging
+import os
+import random
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
+RAIZ = os.path.dirname(os.path.abspath(__file__))
+APP = os.path.join(RAIZ, "app_turso.py")
+MIME_XLSX = "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
+
+# Peso de cada ação no sorteio: quase tudo é leitura, como no depósito
+ACOES = {"busca": 5, "categoria": 3, "repor": 1, "upload": 1}
+BUSCAS = ["GLIFOSATO", "ROUNDUP", "LUVA", "OLEO", "FOX", "BORO", "100"]
+
+
+def _percentil(valores: list, p: float) -> float:
+    if not valores:
+        return 0.0
+    valores = sorted(valores)
+    return valores[min(len(valores) - 1, int(round(p / 100 * (len(valores) - 1))))]
+
+
+class Sessao:
+    """Um celular: AppTest próprio, latência de cada rerun e o perfil gravado pelo app."""
+
+    def __init__(self, n: int, seed: int, parciais: list, timeout: float, visualizador: bool = False):
+        from streamlit.testing.v1 import AppTest
+
+        self.rng = random.Random(seed * 1000 + n)
+        self.parciais = parciais
+        self.visualizador = visualizador
+        self.at = AppTest.from_file(APP, default_timeout=timeout)
+        if visualizador:
+            self.at.query_params["modo"] = "mapa"
+        self.latencias = []  # (ação, segundos)
+        self.erros = []
+
+    def _rodar(self, acao: str, fn=None):
+        t0 = time.perf_counter()
+        try:
+            if fn:
+                fn()
+            self.at.run()
+        except Exception as e:
+            self.erros.append(f"{acao}: {e}")
+            return
+        self.latencias.append((acao, time.perf_counter() - t0))
+        for exc in self.at.exception:
+            self.erros.append(f"{acao}: {exc.value}")
+
+    def _widget(self, lista, **filtro):
+        for w in lista:
+            if all(getattr(w, k, None) == v for k, v in filtro.items()):
+                return w
+        return None
+
+    def busca(self):
+        termo = self.rng.choice(BUSCAS)
+        campo = self._widget(self.at.text_input, label="🔍 Buscar no Mestre")
+        if campo is None:
+            return
+        for texto in [termo[:i] for i in range(1, min(len(termo), 4) + 1)] + [""]:  # um rerun por tecla
+            self._rodar("busca", lambda: campo.input(texto))
+            campo = self._widget(self.at.text_input, label="🔍 Buscar no Mestre")
+            if campo is None:
+                return
+
+    def categoria(self):
+        filtro = next((s for s in self.at.selectbox if (s.key or "").startswith("filtro_cat_")), None)
+        if filtro is not None:
+            self._rodar("categoria", lambda: filtro.select(self.rng.choice(filtro.options)))
+
+    def repor(self):
+        cat = self._widget(self.at.selectbox, key="checkout_categoria")
+        botao = self._widget(self.at.button, label="🏷️ Categoria inteira reposta")
+        if cat is None or botao is None:
+            return
+        cat.select(self.rng.choice(cat.options))
+        self._rodar("repor", botao.click)
+
+    def upload(self):
+        nome, dados = self.rng.choice(self.parciais)
+        campo = self._widget(self.at.file_uploader, key="upload_main")
+        if campo is None:
+            return
+        self._rodar("preview", lambda: campo.set_value((nome, dados, MIME_XLSX)))
+        botao = self._widget(self.at.button, label="🚀 Processar")
+        if botao is not None:
+            self._rodar("upload", botao.click)
+        campo = self._widget(self.at.file_uploader, key="upload_main")
+        if campo is not None:
+            self._rodar("preview", lambda: campo.set_value(None))
+
+    def perfil(self) -> list:
+        try:
+            return list(self.at.session_state["perfil_reruns"])
+        except KeyError:
+            return []
+
+    def executar(self, n_acoes: int, inicio: threading.Barrier):
+        self._rodar("abrir")
+        inicio.wait()  # todas as sessões começam a agir juntas
+        acoes, pesos = zip(*ACOES.items())
+        for _ in range(n_acoes):
+            if self.visualizador:
+                self._rodar("mapa")
+            else:
+                getattr(self, self.rng.choices(acoes, weights=pesos)[0])()
+
+
+def _preparar_apptest():
+    """
+    Ajustes para vários AppTest rodarem ao mesmo tempo num processo, como as
+    sessões de um servidor:
+    - o servidor compila o script uma vez por processo; o AppTest cria um
+      ScriptCache novo a cada run. Sem isso cada rerun medido pagaria a
+      compilação do app inteiro, e compilações simultâneas em threads quebram o
+      parser do CPython 3.11 ("AST constructor recursion depth mismatch");
+    - o AppTest liga global.appTest trocando config.get_option só durante o
+      run; com runs sobrepostos um restaura o original no meio do run do outro
+      e os widgets deixam de registrar format_func. Ligado de vez, tanto faz;
+    - cada run instala um Runtime falso e o apaga ao terminar, derrubando os
+      runs ainda em andamento. Fica valendo o primeiro, para todas as sessões
+      (como o Runtime único do servidor: um cache_data, um media_file_mgr).
+    """
+    from streamlit import config
+    from streamlit.runtime.runtime import Runtime
+    from streamlit.runtime.scriptrunner import script_cache
+
+    config.set_option("global.appTest", True)
+
+    unico = []
+
+    def instancia(cls):
+        if not unico:
+            if cls._instance is None:
+                raise RuntimeError("Runtime hasn't been created!")
+            unico.append(cls._instance)
+        return unico[0]
+
+    Runtime.instance = classmethod(instancia)
+    Runtime.exists = classmethod(lambda cls: bool(unico) or cls._instance is not None)
+
+    compartilhado = script_cache.ScriptCache()
+    original = script_cache.ScriptCache.get_bytecode
+    script_cache.ScriptCache.get_bytecode = lambda self, caminho: original(compartilhado, caminho)
+
+
+def _carregar_mestre(caminho: str, timeout: float):
+    """Carga MESTRE pelo próprio app (mesmo caminho de um usuário)."""
+    from streamlit.testing.v1 import AppTest
+
+    at = AppTest.from_file(APP, default_timeout=timeout)
+    at.run()
+    with open(caminho, "rb") as f:
+        at.file_uploader(key="upload_main").set_value((os.path.basename(caminho), f.read(), MIME_XLSX))
+    at.run()
+    radio = at.radio[0]
+    radio.set_value(next(o for o in radio.options if o.startswith("MESTRE"))).run()
+    next(b for b in at.button if b.label == "🚀 Processar").click().run()
+    if at.exception:
+        raise RuntimeError(f"carga do mestre falhou: {at.exception[0].value}")
+
+
+def _esperar_publicacao(pasta: str, timeout: float):
+    """A publicação roda em segundo plano depois do upload; visualizadores precisam dela pronta."""
+    limite = time.monotonic() + timeout
+    while not glob.glob(os.path.join(pasta, "*", "manifesto.json")):
+        if time.monotonic() > limite:
+            raise RuntimeError("publicação do mapa não apareceu")
+        time.sleep(0.2)
+
+
+def _nivel(n: int, args, parciais: list) -> dict:
+    sessoes = [Sessao(i, args.seed, parciais, args.timeout) for i in range(n)]
+    sessoes += [Sessao(n + i, args.seed, parciais, args.timeout, visualizador=True) for i in range(args.visualizadores)]
+    inicio = threading.Barrier(len(sessoes))
+    t0 = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=len(sessoes)) as pool:
+        for f in [pool.submit(s.executar, args.acoes, inicio) for s in sessoes]:
+            f.result()
+    duracao = time.perf_counter() - t0
+
+    latencias = [(a, t) for s in sessoes for a, t in s.latencias if a != "abrir"]
+    por_acao = {}
+    for a, t in latencias:
+        por_acao.setdefault(a, []).append(t * 1000)
+    tempos = [t * 1000 for _, t in latencias]
+
+    reruns = [r for s in sessoes for r in s.perfil()]
+    leitura = [sum(c["ms"] for c in r["consultas"]) for r in reruns]
+    escrita = [sp["ms"] for r in reruns for sp in r["spans"] if sp["tipo"] == "escrita"]
+    erros = [e for s in sessoes for e in s.erros]
+    return {
+        "sessoes": n,
+        "visualizadores": args.visualizadores,
+        "reruns": len(tempos),
+        "duracao_s": round(duracao, 2),
+        "reruns_por_s": round(len(tempos) / duracao, 2) if duracao else 0,
+        "p50_ms": round(_percentil(tempos, 50), 1),
+        "p95_ms": round(_percentil(tempos, 95), 1),
+        "max_ms": round(max(tempos, default=0), 1),
+        "por_acao": {
+            a: {"n": len(v), "p50_ms": round(_percentil(v, 50), 1), "p95_ms": round(_percentil(v, 95), 1)}
+            for a, v in sorted(por_acao.items())
+        },
+        "leitura_ms_p50": round(_percentil(leitura, 50), 1),
+        "leitura_ms_p95": round(_percentil(leitura, 95), 1),
+        "escrita_ms_p50": round(_percentil(escrita, 50), 1),
+        "escrita_ms_p95": round(_percentil(escrita, 95), 1),
+        "escritas": len(escrita),
+        "bloqueios": sum(1 for e in erros if "locked" in e or "busy" in e),
+        "erros": len(erros),
+        "exemplo_erro": erros[0][:300] if erros else "",
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--sessoes", default="1,2,4,8", help="níveis de concorrência separados por vírgula")
+    parser.add_argument("--acoes", type=int, default=15, help="ações sorteadas por sessão")
+    parser.add_argument("--visualizadores", type=int, default=0, help="sessões só de mapa (?modo=mapa) em cada nível")
+    parser.add_argument("--linhas", type=int, default=5000, help="produtos no mestre")
+    parser.add_argument("--linhas-parcial", type=int, default=200, help="produtos em cada planilha parcial")
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--timeout", type=float, default=120, help="limite por rerun (s)")
+    parser.add_argument("--saida", default="loadtest_resultados.jsonl")
+    args = parser.parse_args()
+
+    # Banco descartável, stand-in do Turso e perfil ligado em todas as sessões
+    tmp = tempfile.mkdtemp(prefix="camda_carga_")
+    os.environ.update({
+        "CAMDA_DB_PATH": os.path.join(tmp, "carga.db"),
+        "CAMDA_JOURNAL_PATH": os.path.join(tmp, "carga_journal.db"),
+        "CAMDA_REMOTE_STANDIN": "1",
+        "CAMDA_PERFIL": "1",
+        "CAMDA_PUBLICACAO_DIR": os.path.join(tmp, "publicado"),
+    })
+    for chave in ("TURSO_DATABASE_URL", "TURSO_AUTH_TOKEN", "CAMDA_PERFIL_LOG", "CAMDA_LOJA"):
+        os.environ.pop(chave, None)
+    logging.disable(logging.WARNING)
+    sys.path.insert(0, RAIZ)
+    from bench import gerar_estoque, gerar_vendas
+    _preparar_apptest()
+
+    mestre = os.path.join(tmp, "mestre.xlsx")
+    gerar_estoque(args.linhas, args.seed, mestre)
+    parciais = []
+    for i in range(4):
+        caminho = os.path.join(tmp, f"parcial_{i}.xlsx")
+        gerar_vendas(args.linhas_parcial, args.seed + i, caminho)
+        with open(caminho, "rb") as f:
+            parciais.append((os.path.basename(caminho), f.read()))
+
+    resultados = []
+    print(f"{'sessões':>8}{'reruns':>8}{'rerun/s':>9}{'p50 ms':>9}{'p95 ms':>9}{'máx ms':>9}"
+          f"{'leit p95':>10}{'escr p50':>10}{'escr p95':>10}{'bloq':>6}{'erros':>7}")
+    for n in [int(x) for x in args.sessoes.split(",") if x.strip()]:
+        _carregar_mestre(mestre, args.timeout)  # mesmo ponto de partida em cada nível
+        if args.visualizadores:
+            _esperar_publicacao(os.environ["CAMDA_PUBLICACAO_DIR"], args.timeout)
+        r = _nivel(n, args, parciais)
+        resultados.append(r)
+        print(f"{r['sessoes']:>8}{r['reruns']:>8}{r['reruns_por_s']:>9.1f}{r['p50_ms']:>9.0f}{r['p95_ms']:>9.0f}"
+              f"{r['max_ms']:>9.0f}{r['leitura_ms_p95']:>10.1f}{r['escrita_ms_p50']:>10.1f}"
+              f"{r['escrita_ms_p95']:>10.1f}{r['bloqueios']:>6}{r['erros']:>7}")
+        for acao, v in r["por_acao"].items():
+            print(f"{'':>8}  {acao:<10} n={v['n']:<4} p50={v['p50_ms']:.0f} ms  p95={v['p95_ms']:.0f} ms")
+        if r["exemplo_erro"]:
+            print(f"{'':>8}  erro: {r['exemplo_erro']}")
+
+    with open(args.saida, "a", encoding="utf-8") as f:
+        f.write(json.dumps({
+            "quando": datetime.now().isoformat(timespec="seconds"), "seed": args.seed, "acoes": args.acoes,
+            "linhas": args.linhas, "linhas_parcial": args.linhas_parcial, "resultados": resultados,
+        }, ensure_ascii=False) + "\n")
+    print(f"\nResultados em {args.saida}")
+
+
+if __name__ == "__main__":
+    sys.exit(main())
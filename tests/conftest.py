@@ -0,0 +1,41 @@
+import logging
+import os
+import sys
+import tempfile
+
+import pytest
+
+# Banco descartável e stand-in do Turso antes de importar o app (lê o ambiente no import)
+_TMP = tempfile.mkdtemp(prefix="camda_testes_")
+os.environ.update({
+    "CAMDA_DB_PATH": os.path.join(_TMP, "camda_local.db"),
+    "CAMDA_JOURNAL_PATH": os.path.join(_TMP, "camda_journal.db"),
+    "CAMDA_REMOTE_STANDIN": "1",
+    "CAMDA_PUBLICACAO": "0",
+    "CAMDA_PUBLICACAO_DIR": os.path.join(_TMP, "publicado"),
+})
+for chave in ("TURSO_DATABASE_URL", "TURSO_AUTH_TOKEN", "CAMDA_PERFIL", "CAMDA_PERFIL_LOG", "CAMDA_LOJA"):
+    os.environ.pop(chave, None)
+logging.disable(logging.WARNING)  # avisos do Streamlit fora de `streamlit run`
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import app_turso  # noqa: E402
+
+
+@pytest.fixture
+def app():
+    return app_turso
+
+
+@pytest.fixture
+def gerenciador(tmp_path, monkeypatch):
+    """_ConnectionManager próprio do teste sobre um LocalRemote num arquivo novo."""
+    monkeypatch.setattr(app_turso, "BACKOFF_BASE_S", 0.0)  # sem espera entre tentativas
+    caminho = str(tmp_path / "remoto.db")
+    remoto = app_turso.LocalRemote(caminho)
+    mgr = app_turso._ConnectionManager(
+        remote=remoto, journal_path=str(tmp_path / "diario.db"), read_path=caminho
+    )
+    yield mgr, remoto
+    mgr._writer.shutdown(wait=True)
@@ -0,0 +1,51 @@
+"""Busca do mestre: paginação (SQL) e cartões do dashboard (frame) contam as mesmas linhas."""
+import pytest
+
+
+def _registro(codigo, produto, status):
+    return {
+        "codigo": codigo, "produto": produto, "categoria": "OLEOS",
+        "qtd_sistema": 10, "qtd_fisica": 9 if status == "falta" else 10,
+        "diferenca": -1 if status == "falta" else 0, "nota": "", "status": status,
+    }
+
+
+@pytest.fixture
+def loja(app):
+    loja = app.cadastrar_loja("BUSCATESTE", "Busca")
+    app._gravar_parcial(app.get_db(), loja, [
+        _registro("100", "ÓLEO MINERAL 20L", "falta"),
+        _registro("101", "oleo de motor", "falta"),
+        _registro("102", "GRAXA 50%", "falta"),
+        _registro("103", "GRAXA 50 KG", "falta"),
+        _registro("104", "ÓLEO HIDRÁULICO", "ok"),
+    ], "PARCIAL", "teste", repor=False)
+    return loja
+
+
+def _no_frame(app, loja, busca):
+    df, chaves = app._get_stock_store(loja).com_chaves_busca()
+    vistos = df[chaves.str.contains(app.termo_busca(busca), regex=False)]
+    return sorted(vistos.loc[vistos["status"] == "falta", "codigo"])
+
+
+@pytest.mark.parametrize("busca, esperado", [
+    ("óleo", ["100", "101"]),
+    ("OLEO", ["100", "101"]),
+    ("Óleo Mineral", ["100"]),
+    ("50%", ["102"]),
+    ("5_", []),
+    ("10", ["100", "101", "102", "103"]),
+])
+def test_paginacao_e_cartoes_contam_o_mesmo(app, loja, busca, esperado):
+    df, total = app.consultar_pagina("divergencias", loja, "Categoria / produto", busca=busca)
+    assert sorted(df["codigo"]) == esperado
+    assert total == len(esperado)
+    assert _no_frame(app, loja, busca) == esperado
+
+
+def test_migracao_preenche_busca(app, loja):
+    app.run_write([("UPDATE estoque_mestre SET busca = NULL WHERE loja_id = ?", (loja,))])
+    app._get_manager().run_local(app._migrate_schema)
+    df, total = app.consultar_pagina("divergencias", loja, "Categoria / produto", busca="óleo")
+    assert total == 2
@@ -0,0 +1,40 @@
+"""Timestamps em epoch: conversão para hora local e backfill das colunas *_ts."""
+from datetime import datetime
+from zoneinfo import ZoneInfo
+
+import libsql
+import pandas as pd
+
+
+def test_epoch_to_local_usa_o_offset_de_cada_instante(app, monkeypatch):
+    fuso = ZoneInfo("America/New_York")
+    monkeypatch.setattr(app, "FUSO_LOCAL", fuso)
+    inverno, verao = 1_710_000_000, 1_720_000_000  # antes e depois do horário de verão
+    convertido = app.epoch_to_local(pd.Series([inverno, verao, None]))
+    esperado = [datetime.fromtimestamp(ts, fuso).replace(tzinfo=None) for ts in (inverno, verao)]
+    assert convertido.iloc[:2].tolist() == esperado
+    assert pd.isna(convertido.iloc[2])
+
+
+def test_backfill_roda_uma_vez_so(app, tmp_path):
+    conn = libsql.connect(str(tmp_path / "banco.db"))
+    inserir = (
+        "INSERT INTO historico_uploads (loja_id, data, tipo) VALUES ('QUIRINOPOLIS', ?, 'MESTRE')"
+    )
+    # Linha de uma versão antiga do app: só o TEXT
+    conn.execute(app.SCHEMA_TABLES["historico_uploads"])
+    conn.execute(inserir, ("2026-01-01 08:00:00",))
+    conn.commit()
+
+    app._migrate_schema(conn)
+    esperado = int(datetime(2026, 1, 1, 8).timestamp())
+    assert conn.execute("SELECT data_ts FROM historico_uploads").fetchall() == [(esperado,)]
+    marca = conn.execute("SELECT valor FROM manutencao WHERE chave = 'backfill_ts'").fetchone()
+    assert marca
+
+    # Próximas inicializações não varrem as tabelas de novo
+    conn.execute(inserir, ("2026-01-02 08:00:00",))
+    conn.commit()
+    app._migrate_schema(conn)
+    assert conn.execute("SELECT data_ts FROM historico_uploads ORDER BY id").fetchall() == [(esperado,), (None,)]
+    assert conn.execute("SELECT valor FROM manutencao WHERE chave = 'backfill_ts'").fetchone() == marca
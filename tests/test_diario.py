@@ -0,0 +1,124 @@
+"""Diário de escritas (WriteJournal) e replay para o remoto."""
+import pytest
+
+
+def _log_upload(arquivo: str, ts: int):
+    return (
+        "INSERT INTO historico_uploads (loja_id, data, data_ts, tipo, arquivo) VALUES (?, ?, ?, ?, ?)",
+        ("QUIRINOPOLIS", "2026-01-01 08:00:00", ts, "PARCIAL", arquivo),
+    )
+
+
+def _uploads(remoto):
+    return remoto.conn.execute("SELECT arquivo FROM historico_uploads ORDER BY id").fetchall()
+
+
+def test_escrita_online_aplica_e_limpa_o_diario(gerenciador):
+    mgr, remoto = gerenciador
+    assert mgr.write([_log_upload("a.xlsx", 1)], "PARCIAL")
+    assert _uploads(remoto) == [("a.xlsx",)]
+    assert mgr.status()["pendentes"] == 0
+
+
+def test_offline_fica_no_diario_e_replay_quando_volta(gerenciador):
+    mgr, remoto = gerenciador
+    remoto.online = False
+    assert not mgr.write([_log_upload("a.xlsx", 1)], "PARCIAL")
+    assert mgr.status()["pendentes"] == 1
+    assert "offline" in mgr.status()["erro"]
+    assert _uploads(remoto) == []
+
+    remoto.online = True
+    assert mgr.sync()
+    assert _uploads(remoto) == [("a.xlsx",)]
+    assert mgr.status()["pendentes"] == 0
+
+
+def test_replay_offline_mantem_a_ordem(gerenciador):
+    mgr, remoto = gerenciador
+    remoto.online = False
+    upsert = """
+        INSERT INTO manutencao (chave, valor) VALUES ('teste', ?)
+        ON CONFLICT (chave) DO UPDATE SET valor = excluded.valor
+    """
+    for i in range(5):
+        mgr.write([(upsert, (str(i),)), _log_upload(f"{i}.xlsx", i)], "PARCIAL")
+    mgr.write([("DELETE FROM historico_uploads WHERE arquivo = ?", ("0.xlsx",))], "limpeza")
+    assert mgr.status()["pendentes"] == 6
+
+    remoto.online = True
+    assert mgr.sync()
+    assert remoto.conn.execute("SELECT valor FROM manutencao WHERE chave = 'teste'").fetchone() == ("4",)
+    assert _uploads(remoto) == [(f"{i}.xlsx",) for i in range(1, 5)]
+
+
+def test_queda_entre_commit_remoto_e_limpeza_nao_duplica(gerenciador):
+    mgr, remoto = gerenciador
+    remoto.online = False
+    mgr.write([_log_upload("a.xlsx", 1)], "PARCIAL")
+    # A entrada chega ao remoto, mas o processo cai antes de limpar o diário
+    _, entrada_id, ops = mgr._journal.next()
+    remoto.online = True
+    remoto.apply(entrada_id, ops)
+    assert mgr.status()["pendentes"] == 1
+
+    assert mgr.sync()
+    assert mgr.status()["pendentes"] == 0
+    assert _uploads(remoto) == [("a.xlsx",)]
+
+
+def test_falha_no_meio_da_entrada_nao_aplica_nada(gerenciador):
+    mgr, remoto = gerenciador
+    remoto.online = False
+    mgr.write([_log_upload("a.xlsx", 1), ("INSERT INTO tabela_que_nao_existe VALUES (1)", ())], "PARCIAL")
+    mgr.write([_log_upload("b.xlsx", 2)], "PARCIAL")
+    remoto.online = True
+    # A entrada com erro de SQL sai da fila; a seguinte não fica presa atrás dela
+    assert mgr.sync()
+    assert _uploads(remoto) == [("b.xlsx",)]
+    status = mgr.status()
+    assert status["pendentes"] == 0
+    assert status["descartadas"] == 1
+    assert "tabela_que_nao_existe" in status["erro_descartada"]
+
+
+def test_erro_de_sql_sobe_para_quem_escreveu(gerenciador):
+    mgr, remoto = gerenciador
+    with pytest.raises(ValueError, match="tabela_que_nao_existe"):
+        mgr.write([("INSERT INTO tabela_que_nao_existe VALUES (1)", ())], "PARCIAL")
+    assert mgr.write([_log_upload("a.xlsx", 1)], "PARCIAL")
+    assert _uploads(remoto) == [("a.xlsx",)]
+    assert mgr.status()["descartadas"] == 1
+
+
+def test_erro_desconhecido_sai_da_fila_depois_do_limite(app, gerenciador, monkeypatch):
+    mgr, remoto = gerenciador
+    monkeypatch.setattr(app, "DIARIO_TENTATIVAS_MAX", 3)
+    aplicar = remoto.apply
+
+    def apply_estranho(entrada_id, ops):
+        if ops[0][1][-1] == "a.xlsx":
+            raise RuntimeError("falha estranha")
+        aplicar(entrada_id, ops)
+    monkeypatch.setattr(remoto, "apply", apply_estranho)
+
+    assert not mgr.write([_log_upload("a.xlsx", 1)], "PARCIAL")  # 1ª tentativa
+    assert not mgr.write([_log_upload("b.xlsx", 2)], "PARCIAL")  # 2ª (b espera atrás de a)
+    assert mgr.status()["pendentes"] == 2
+    assert mgr.sync()  # 3ª: a é descartada e b segue
+    assert _uploads(remoto) == [("b.xlsx",)]
+    assert mgr.status()["descartadas"] == 1
+
+
+def test_erro_de_rede_nunca_descarta(app, gerenciador, monkeypatch):
+    mgr, remoto = gerenciador
+    monkeypatch.setattr(app, "DIARIO_TENTATIVAS_MAX", 2)
+    remoto.online = False
+    mgr.write([_log_upload("a.xlsx", 1)], "PARCIAL")
+    for _ in range(5):
+        assert not mgr.sync()
+    assert mgr.status()["pendentes"] == 1
+    assert mgr.status()["descartadas"] == 0
+    remoto.online = True
+    assert mgr.sync()
+    assert _uploads(remoto) == [("a.xlsx",)]
@@ -0,0 +1,41 @@
+"""Frame compartilhado do estoque: tipagem e patch incremental."""
+import pandas as pd
+
+
+def _linha(codigo, produto, categoria, qtd=10, status="ok", contagem=None):
+    return (codigo, produto, categoria, qtd, qtd, 0, "", status, contagem, 1_700_000_000)
+
+
+def _frame(app, linhas):
+    return app._tipar_estoque(pd.DataFrame(linhas, columns=app.ESTOQUE_COLS))
+
+
+def test_patch_so_tipa_o_delta_e_mantem_dtypes_e_ordem(app):
+    base = _frame(app, [
+        _linha("1", "ADUBO A", "ADUBOS QUÍMICOS"),
+        _linha("2", "GLIFOSATO", "HERBICIDAS"),
+        _linha("3", "LUVA", "EPI"),
+    ])
+    base = base.sort_values(["categoria", "produto"], ignore_index=True)
+    delta = _frame(app, [
+        _linha("2", "GLIFOSATO", "HERBICIDAS", qtd=7, status="falta", contagem=1_700_000_500),
+        _linha("4", "ESPALHANTE", "ADJUVANTES"),  # categoria nova
+    ])
+
+    df = app._patch_stock(base, delta)
+
+    assert df["codigo"].tolist() == ["4", "1", "3", "2"]
+    assert isinstance(df["categoria"].dtype, pd.CategoricalDtype)
+    assert list(df["categoria"].cat.categories) == sorted(df["categoria"].unique())
+    assert isinstance(df["status"].dtype, pd.CategoricalDtype)
+    assert df["qtd_sistema"].dtype == "int32"
+    assert pd.api.types.is_datetime64_any_dtype(df["ultima_contagem"])
+    linha = df[df["codigo"] == "2"].iloc[0]
+    assert (linha["qtd_sistema"], linha["status"]) == (7, "falta")
+    # O frame entregue antes do patch não muda
+    assert base.loc[base["codigo"] == "2", "qtd_sistema"].item() == 10
+
+
+def test_patch_vazio_devolve_o_mesmo_frame(app):
+    base = _frame(app, [_linha("1", "ADUBO A", "ADUBOS QUÍMICOS")])
+    assert app._patch_stock(base, base.iloc[0:0]) is base
@@ -0,0 +1,15 @@
+"""Manutenção local: o erro do VACUUM é da réplica desta máquina."""
+
+
+def test_erro_do_vacuum_fica_no_processo(app, gerenciador, monkeypatch):
+    mgr, remoto = gerenciador
+    monkeypatch.setattr(app, "_vacuum_incremental", lambda conn: "database is locked")
+    assert mgr.vacuum_local() == "database is locked"
+    assert mgr.erro_vacuum.endswith("database is locked")
+    # Nada no diário nem na tabela replicada
+    assert mgr.status()["pendentes"] == 0
+    assert remoto.conn.execute("SELECT COUNT(*) FROM manutencao WHERE chave = 'erro_vacuum'").fetchone() == (0,)
+
+    monkeypatch.setattr(app, "_vacuum_incremental", lambda conn: None)
+    assert mgr.vacuum_local() is None
+    assert mgr.erro_vacuum is None
@@ -0,0 +1,68 @@
+"""Migração de bancos de antes do loja_id."""
+import libsql
+import pytest
+
+_ESTOQUE_SEM_LOJA = """
+    CREATE TABLE estoque_mestre (
+        codigo TEXT PRIMARY KEY, produto TEXT NOT NULL, categoria TEXT NOT NULL,
+        qtd_sistema INTEGER NOT NULL DEFAULT 0, qtd_fisica INTEGER DEFAULT 0,
+        diferenca INTEGER DEFAULT 0, nota TEXT DEFAULT '', status TEXT DEFAULT 'ok',
+        ultima_contagem TEXT DEFAULT '', criado_em TEXT NOT NULL
+    )
+"""
+
+
+def _banco_antigo(tmp_path, n=3):
+    conn = libsql.connect(str(tmp_path / "antigo.db"))
+    conn.execute(_ESTOQUE_SEM_LOJA)
+    for i in range(n):
+        conn.execute(
+            "INSERT INTO estoque_mestre (codigo, produto, categoria, criado_em) VALUES (?, ?, 'EPI', '2025-01-01 08:00:00')",
+            (str(i), f"LUVA {i}"),
+        )
+    conn.commit()
+    return conn
+
+
+def _tabelas(conn):
+    return {r[0] for r in conn.execute("SELECT name FROM sqlite_master WHERE type = 'table'").fetchall()}
+
+
+def test_recria_estoque_com_loja_padrao(app, tmp_path):
+    conn = _banco_antigo(tmp_path)
+    app._migrate_schema(conn)
+    assert "estoque_mestre_sem_loja" not in _tabelas(conn)
+    assert conn.execute("SELECT DISTINCT loja_id FROM estoque_mestre").fetchall() == [(app.LOJA_PADRAO,)]
+    assert conn.execute("SELECT COUNT(*) FROM estoque_mestre").fetchone() == (3,)
+
+
+def test_falha_no_meio_volta_a_tabela_original(app, tmp_path, monkeypatch):
+    conn = _banco_antigo(tmp_path)
+    tabelas = dict(app.SCHEMA_TABLES, estoque_mestre="CREATE TABLE estoque_mestre (loja_id TEXT, codigo TEXT)")
+    monkeypatch.setattr(app, "SCHEMA_TABLES", tabelas)  # INSERT da cópia falha (faltam colunas)
+    with pytest.raises(Exception):
+        app._migrate_schema(conn)
+    colunas = [r[1] for r in conn.execute("PRAGMA table_info(estoque_mestre)").fetchall()]
+    assert "loja_id" not in colunas and "estoque_mestre_sem_loja" not in _tabelas(conn)
+    assert conn.execute("SELECT COUNT(*) FROM estoque_mestre").fetchone() == (3,)
+
+    monkeypatch.undo()
+    app._migrate_schema(conn)  # próxima inicialização refaz
+    assert conn.execute("SELECT COUNT(*) FROM estoque_mestre WHERE loja_id = ?", (app.LOJA_PADRAO,)).fetchone() == (3,)
+
+
+def test_termina_recriacao_que_ficou_pela_metade(app, tmp_path):
+    conn = _banco_antigo(tmp_path)
+    # Estado deixado pela versão sem transação: renomeada, nova criada e só uma linha copiada
+    conn.execute("ALTER TABLE estoque_mestre RENAME TO estoque_mestre_sem_loja")
+    conn.execute(app.SCHEMA_TABLES["estoque_mestre"])
+    conn.execute(
+        "INSERT INTO estoque_mestre (loja_id, codigo, produto, categoria, criado_em) "
+        "SELECT ?, codigo, produto, categoria, criado_em FROM estoque_mestre_sem_loja WHERE codigo = '0'",
+        (app.LOJA_PADRAO,),
+    )
+    conn.commit()
+
+    app._migrate_schema(conn)
+    assert "estoque_mestre_sem_loja" not in _tabelas(conn)
+    assert conn.execute("SELECT codigo FROM estoque_mestre ORDER BY codigo").fetchall() == [("0",), ("1",), ("2",)]
@@ -0,0 +1,44 @@
+"""Índice de nomes: resolução aproximada de códigos AUTO_."""
+
+
+def _resolver(app, nome, conhecidos):
+    return app._nome_aproximado(
+        app.normalizar_nome(nome), [(app.normalizar_nome(n), c) for n, c in conhecidos]
+    )
+
+
+def test_embalagem_diferente_nao_casa(app):
+    assert _resolver(app, "ROUNDUP ORIGINAL 20L", [("ROUNDUP ORIGINAL 10L", "111")]) is None
+
+
+def test_variedade_diferente_nao_casa(app):
+    assert _resolver(app, "MILHO DKB 390 PRO3", [("MILHO DKB 290 PRO3", "222")]) is None
+
+
+def test_erro_de_digitacao_com_mesmas_medidas_casa(app):
+    conhecidos = [("ROUNDUP ORIGINAL 20L", "111"), ("ROUNDUP ORIGINAL 10L", "112")]
+    assert _resolver(app, "ROUNDUP ORIGNAL 20 L", conhecidos) == "111"
+
+
+def test_empate_entre_codigos_diferentes_nao_casa(app):
+    conhecidos = [("LUVA NITRILICA G", "301"), ("LUVA NITRILICA P", "302")]
+    assert _resolver(app, "LUVA NITRILICA M", conhecidos) is None
+
+
+def test_resolver_codigos_auto_nao_troca_por_outra_embalagem(app, tmp_path):
+    import libsql
+
+    conn = libsql.connect(str(tmp_path / "nomes.db"))
+    app._migrate_schema(conn)
+    for sql, params in app._nomes_ops("QUIRINOPOLIS", [
+        {"codigo": "111", "produto": "HERBICIDA ROUNDUP ORIGINAL 10L"},
+    ]):
+        conn.execute(sql, params)
+    conn.commit()
+    records = [
+        {"codigo": app.codigo_auto("ROUNDUP ORIGINAL 20L"), "produto": "HERBICIDA ROUNDUP ORIGINAL 20L"},
+        {"codigo": app.codigo_auto("ROUNDUP ORIGINAL 10L"), "produto": "HERBICIDA ROUNDUP ORIGINAL 10L"},
+    ]
+    assert app.resolver_codigos_auto(conn, "QUIRINOPOLIS", records) == 1
+    assert records[0]["codigo"].startswith("AUTO_")
+    assert records[1]["codigo"] == "111"
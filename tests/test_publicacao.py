@@ -0,0 +1,45 @@
+"""Publicação estática: roda fora da sessão e grava a contagem no epoch do banco."""
+import gzip
+import json
+import os
+import threading
+
+
+def _registro(codigo, produto):
+    return {
+        "codigo": codigo, "produto": produto, "categoria": "EPI", "qtd_sistema": 5,
+        "qtd_fisica": 4, "diferenca": -1, "nota": "", "status": "falta",
+    }
+
+
+def test_publica_em_thread_sem_sessao_com_epoch_gravado(app, monkeypatch):
+    loja = app.cadastrar_loja("PUBTESTE", "Publicação")
+    app._gravar_parcial(app.get_db(), loja, [_registro("1", "LUVA"), _registro("2", "BOTA")],
+                        "PARCIAL", "teste", repor=False)
+    app.run_write([(
+        "UPDATE estoque_mestre SET ultima_contagem_ts = NULL WHERE loja_id = ? AND codigo = '2'", (loja,)
+    )])
+    gravados = dict(app.get_db().execute(
+        "SELECT codigo, ultima_contagem_ts FROM estoque_mestre WHERE loja_id = ?", (loja,)
+    ).fetchall())
+    mgr, store = app._get_manager(), app._get_stock_store(loja)
+
+    # Na thread do publicador nada passa por get_db / st.cache_resource
+    def proibido(*args, **kwargs):
+        raise AssertionError("publicação chamou o Streamlit")
+    monkeypatch.setattr(app, "get_db", proibido)
+    monkeypatch.setattr(app, "_get_manager", proibido)
+    monkeypatch.setattr(app, "_get_stock_store", proibido)
+
+    resultado = {}
+    t = threading.Thread(target=lambda: resultado.update(app.publicar_mapa(loja, mgr, store)))
+    t.start()
+    t.join()
+    assert resultado, "publicação falhou"
+
+    caminho = os.path.join(app._dir_publicacao(loja), resultado["estoque"])
+    with gzip.open(caminho) as f:
+        estoque = json.load(f)["estoque"]
+    publicados = dict(zip(estoque["codigo"], estoque["ultima_contagem_ts"]))
+    assert publicados == gravados
+    assert isinstance(publicados["1"], int) and publicados["2"] is None
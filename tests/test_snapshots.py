@@ -0,0 +1,110 @@
+"""Snapshots do estoque e reconstrução "como estava antes de um upload"."""
+import io
+
+import bench
+
+
+def _carregar(app, tmp_path, monkeypatch, loja, seed, ts):
+    caminho = str(tmp_path / f"mestre_{seed}.xlsx")
+    bench.gerar_estoque(40, seed, caminho)
+    monkeypatch.setattr(app, "agora", lambda: (f"2026-01-01 00:00:{seed:02d}", ts))
+    ok, msg = app.upload_mestre(bench._arquivo(caminho), loja)
+    assert ok, msg
+    return _estado(app.get_current_stock(loja))
+
+
+def _estado(df):
+    return sorted(zip(df["codigo"], df["qtd_sistema"].astype(int), df["status"].astype(str)))
+
+
+def test_snapshot_mais_antigo_sobrevive_a_compactacao(app, tmp_path, monkeypatch):
+    loja = app.cadastrar_loja("SNAPTESTE", "Snapshots")
+    monkeypatch.setattr(app, "SNAPSHOTS_MANTER", 2)
+    agora = app.agora
+    cargas = {ts: _carregar(app, tmp_path, monkeypatch, loja, seed, ts)
+              for seed, ts in enumerate([1_000, 2_000, 3_000, 4_000], start=1)}
+    monkeypatch.setattr(app, "agora", agora)
+
+    app.compactar_historico()
+    snaps = app.get_snapshots(loja)
+    assert sorted(snaps["ts"]) == [3_000, 4_000]
+
+    # O mais antigo que ficou guarda o estoque de antes do upload de 3000 (a carga de 2000)
+    antes = app.estoque_do_snapshot(loja, 3_000)
+    assert _estado(antes) == cargas[2_000]
+    assert antes.notna().all().all()
+
+
+def test_replay_ignora_alteracao_sem_estado_anterior(app):
+    loja = app.cadastrar_loja("RAZAOTESTE", "Razão")
+    app.run_write([(
+        "INSERT INTO movimentos_estoque (loja_id, codigo, ts, evento, categoria, qtd_sistema) "
+        "VALUES (?, '1', 10, 'A', 'EPI', 5)", (loja,)
+    )])
+    assert app.estoque_em(loja, 20).empty
+
+
+def _registro(codigo, qtd_fisica, categoria="EPI"):
+    return {
+        "codigo": codigo, "produto": f"ITEM {codigo}", "categoria": categoria, "qtd_sistema": 10,
+        "qtd_fisica": qtd_fisica, "diferenca": qtd_fisica - 10, "nota": "",
+        "status": "ok" if qtd_fisica == 10 else "falta",
+    }
+
+
+def _no_mestre(app, loja):
+    rows = app.get_db().execute(
+        "SELECT codigo, qtd_fisica, status FROM estoque_mestre WHERE loja_id = ?", (loja,)
+    ).fetchall()
+    return sorted((c, int(q), s) for c, q, s in rows)
+
+
+def _reconstruido(df):
+    return sorted(zip(df["codigo"], df["qtd_fisica"].astype(int), df["status"].astype(str)))
+
+
+def test_razao_de_escritas_offline_bate_com_o_mestre_depois_do_replay(app, monkeypatch):
+    loja = app.cadastrar_loja("RAZAOOFFLINE", "Razão offline")
+    mgr = app._get_manager()
+    monkeypatch.setattr(app, "BACKOFF_BASE_S", 0.0)
+
+    def gravar(ts, registros):
+        monkeypatch.setattr(app, "agora", lambda: (f"2026-01-01 00:00:{ts:02d}", ts))
+        return app._gravar_parcial(app.get_db(), loja, registros, "PARCIAL", "teste", repor=False)
+
+    assert gravar(10, [_registro("1", 10)])["aplicado"]
+    mgr._remote.online = False
+    try:
+        # A réplica não vê nenhuma das duas: as duas comparariam com 10/ok
+        assert not gravar(20, [_registro("1", 7)])["aplicado"]
+        assert not gravar(30, [_registro("1", 10), _registro("2", 10)])["aplicado"]
+        # MESTRE offline sem o item 2: o R e o snapshot também vêm do banco
+        monkeypatch.setattr(app, "agora", lambda: ("2026-01-01 00:00:40", 40))
+        monkeypatch.setattr(app, "read_excel_to_records", lambda arquivo: (True, [_registro("1", 8)]))
+        monkeypatch.setattr(app, "resolver_codigos_auto", lambda conn, loja_id, registros: 0)
+        arquivo = io.BytesIO()
+        arquivo.name = "mestre.xlsx"
+        ok, msg = app.upload_mestre(arquivo, loja)
+        assert ok and "diário" in msg, msg
+    finally:
+        mgr._remote.online = True
+    assert mgr.sync()
+
+    assert _no_mestre(app, loja) == [("1", 8, "falta")]
+    assert _reconstruido(app.estoque_em(loja, 35)) == [("1", 10, "ok"), ("2", 10, "ok")]
+    assert _reconstruido(app.estoque_em(loja, 50)) == _no_mestre(app, loja)
+    # O snapshot do MESTRE guarda o estado de logo antes dele, com as escritas offline
+    assert _reconstruido(app.estoque_do_snapshot(loja, 40)) == [("1", 10, "ok"), ("2", 10, "ok")]
+
+
+def test_snapshot_periodico_le_o_banco_na_transacao(app, monkeypatch):
+    loja = app.cadastrar_loja("SNAPPERIODICO", "Periódico")
+    monkeypatch.setattr(app, "SNAPSHOT_A_CADA_MOVIMENTOS", 2)
+    for ts, qtd in ((10, 10), (20, 9), (30, 8)):
+        monkeypatch.setattr(app, "agora", lambda ts=ts: (f"2026-01-01 00:00:{ts:02d}", ts))
+        app._gravar_parcial(app.get_db(), loja, [_registro("1", qtd)], "PARCIAL", "teste", repor=False)
+    snaps = app.get_snapshots(loja)
+    assert snaps["motivo"].tolist() == ["PERIODICO"]
+    assert snaps["ts"].tolist() == [30]
+    assert _reconstruido(app.estoque_do_snapshot(loja, 30)) == [("1", 9, "falta")]
+    assert _reconstruido(app.estoque_em(loja, 30)) == [("1", 8, "falta")]